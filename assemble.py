@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Turns register programs back into command buffers: EMIT(...) text as
+# printed by decode.py, or lists of (register, fields) pairs, become
+# regdump records and 64-bit NPU command words.
+
+import sys
+import re
+import argparse
+import numpy as np
+from gen_parser import load_parser, mask, Error
+from emit import RegIndex
+from decode import RECORD_DTYPE, lookup_regs
+
+# Command words carry the target in bits 48..63: the domain of the
+# register with bit 48 (PC_OP_01 in npu_hw.h) set, ie. INSTR(0x0201, value,
+# offset) for CNA. The two PC writes that start a task aren't addressed to
+# an engine: the write to offset 0 goes out as OP_40 (0x0041) and
+# OPERATION_ENABLE as OP_ENABLE (0x0081), as in every capture. GLOBAL
+# doesn't fit in 16 bits and its OPERATION_ENABLE is addressed the same.
+CMD_OP_01 = 0x0001
+CMD_OP_40 = 0x0041
+CMD_OP_ENABLE = 0x0081
+CMD_REG_TARGETS = {
+	("PC", 0x0000): CMD_OP_40,
+	("PC", 0x0008): CMD_OP_ENABLE,
+	("GLOBAL", 0xf008): CMD_OP_ENABLE,
+}
+PC_OPERATION_ENABLE = 0x0008
+
+def cmd_target(reg, domain_value):
+	return CMD_REG_TARGETS.get((reg.domain, reg.offset), domain_value | CMD_OP_01)
+
+EMIT_RE = re.compile(r"EMIT\(\s*(\w+)\s*,\s*(.*?)\s*\);")
+RAW_RE = re.compile(r"^\s*([0-9a-f]+) (-?[0-9a-f]+) ([0-9a-f]+)\s*$")
+WARNING_RE = re.compile(r"WARNING: target 0x(-?[0-9a-f]+) doesn't match")
+TERM_RE = re.compile(r"^(\w+)(?:\(\s*(\w+)\s*\))?$")
+
+def command_words(offsets, values, targets):
+	return (targets.astype(np.uint64) << np.uint64(48)) | \
+	       (values.astype(np.uint64) << np.uint64(16)) | \
+	       (offsets.astype(np.uint64) & np.uint64(0xffff))
+
+# Command word targets of regdump records. Records without any target
+# (dump2.py writes 0) get their register's. Records converted from command
+# words (cmdbuf.py) only keep the engine bit: the words without one are
+# the OP_40 and OP_ENABLE pair ending a task, or data the PC doesn't
+# decode (the task table), which stays at 0.
+def command_targets(records, tables):
+	targets = records["target"].astype(np.int64) & 0xffff
+	if not targets.any():
+		reg = lookup_regs(records, tables)
+		reg_cmd = np.array([cmd_target(r, d) for r, d in zip(tables.regs, tables.index.reg_domain)] + [0],
+				   dtype=np.int64)
+		return np.where(reg >= 0, reg_cmd[reg], 0)
+
+	offsets = records["offset"].view(np.uint16)
+	cmd = np.where(targets != 0, targets | CMD_OP_01, 0)
+	enable = np.flatnonzero((targets == 0) & (offsets == PC_OPERATION_ENABLE))
+	cmd[enable] = CMD_OP_ENABLE
+	op_40 = enable[enable > 0] - 1
+	op_40 = op_40[(targets[op_40] == 0) & (offsets[op_40] == 0)]
+	cmd[op_40] = CMD_OP_40
+	return cmd
+
+def record_commands(records, tables):
+	return command_words(records["offset"].view(np.uint16), records["value"], command_targets(records, tables))
+
+class Packer(object):
+	def __init__(self, reg, domain_value):
+		self.reg = reg
+		self.name = reg.full_name.upper()
+		self.offset = reg.offset
+		self.target = domain_value
+		self.cmd_target = cmd_target(reg, domain_value)
+
+		# The fields of the generated packers (gen_parser.py py-pack), by
+		# name either short (DATAIN_WIDTH) or as the full macro name printed
+		# by decode.py (CNA_DATA_SIZE0_DATAIN_WIDTH)
+		self.layout = [(name.upper(), field.low, mask(0, field.high - field.low))
+			       for name, field in reg.bitset.py_fields(reg)]
+		self.fields = {}
+		for name, shift, m in self.layout:
+			self.fields[name] = (shift, m)
+			self.fields["%s_%s" % (self.name, name)] = (shift, m)
+
+	def field(self, name):
+		try:
+			return self.fields[name.upper()]
+		except KeyError:
+			raise Error("%s has no field %s" % (self.name, name))
+
+	def pack(self, fields):
+		if isinstance(fields, int):
+			return fields & 0xffffffff
+		value = 0
+		for name, v in fields.items():
+			shift, m = self.field(name)
+			if v & ~m:
+				raise Error("value %d doesn't fit in %s.%s" % (v, self.name, name))
+			value |= v << shift
+		return value
+
+	# Same as pack(), but with arrays of field values, one per variant
+	def pack_array(self, fields):
+		value = None
+		for name, v in fields.items():
+			shift, m = self.field(name)
+			v = np.asarray(v, dtype=np.uint32)
+			if (v & np.uint32(~m & 0xffffffff)).any():
+				raise Error("values don't fit in %s.%s" % (self.name, name))
+			v = v << np.uint32(shift)
+			value = v if value is None else value | v
+		return value
+
+	def unpack(self, value):
+		return dict((name, (value >> shift) & m) for name, shift, m in self.layout)
+
+class Program(object):
+	# A register program as three parallel arrays, plus the command word
+	# target of every write.
+	def __init__(self, offsets, values, targets, cmd_targets, names):
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.values = np.asarray(values, dtype=np.int64)
+		self.targets = np.asarray(targets, dtype=np.int64)
+		self.cmd_targets = np.asarray(cmd_targets, dtype=np.int64)
+		self.names = names
+
+	def __len__(self):
+		return len(self.offsets)
+
+	def find(self, name):
+		name = name.upper()
+		if not name.startswith("REG_"):
+			name = "REG_" + name
+		return np.array([i for i, n in enumerate(self.names) if n == name], dtype=np.int64)
+
+	def records(self):
+		records = np.zeros(len(self), dtype=RECORD_DTYPE)
+		records["offset"] = (self.offsets & 0xffff).astype(np.uint16).view(np.int16)
+		records["value"] = self.values & 0xffffffff
+		records["target"] = (self.targets & 0xffff).astype(np.uint16).view(np.int16)
+		return records
+
+	def commands(self):
+		return command_words(self.offsets, self.values, self.cmd_targets)
+
+	# Command words for many variants of this program at once. updates maps
+	# record positions to arrays of values (one per variant, all the same
+	# length); the result has one row of command words per variant.
+	def sweep(self, updates):
+		n = len(next(iter(updates.values())))
+		values = np.repeat(self.values[None, :], n, axis=0)
+		for pos, v in updates.items():
+			values[:, pos] = v
+		return command_words(self.offsets[None, :], values, self.cmd_targets[None, :])
+
+class Assembler(object):
+	def __init__(self, index):
+		self.index = index
+		self.packers = {}
+		for reg, domain in zip(index.regs, index.reg_domain):
+			packer = Packer(reg, domain)
+			self.packers["REG_" + packer.name] = packer
+
+	@staticmethod
+	def from_parser(p):
+		return Assembler(RegIndex.from_parser(p))
+
+	def packer(self, reg):
+		if not isinstance(reg, str):
+			reg = reg.full_name
+		name = reg.upper()
+		if not name.startswith("REG_"):
+			name = "REG_" + name
+		try:
+			return self.packers[name]
+		except KeyError:
+			raise Error("unknown register %s" % reg)
+
+	# program is an iterable of (register, fields) where fields is either
+	# a raw value or a dict of field values
+	def assemble(self, program):
+		offsets, values, targets, cmd_targets, names = [], [], [], [], []
+		for reg, fields in program:
+			packer = self.packer(reg)
+			offsets.append(packer.offset)
+			values.append(packer.pack(fields))
+			targets.append(packer.target)
+			cmd_targets.append(packer.cmd_target)
+			names.append("REG_" + packer.name)
+		return Program(offsets, values, targets, cmd_targets, names)
+
+	def parse_value(self, packer, expr):
+		value = 0
+		for term in expr.split("|"):
+			term = term.strip()
+			m = TERM_RE.match(term)
+			if not m:
+				raise Error("can't parse '%s'" % term)
+			name, arg = m.groups()
+			if arg is None and name[0].isdigit():
+				value |= int(name, 0)
+				continue
+			shift, mask = packer.field(name)
+			v = 1 if arg is None else int(arg, 0)
+			if v & ~mask:
+				raise Error("value %d doesn't fit in %s" % (v, name))
+			value |= v << shift
+		return value
+
+	# Accepts the output of decode.py and the dumpers: EMIT lines (with or
+	# without the dumpers' address prefix), WARNING lines carrying the
+	# real target of the next write, and raw "target offset value" lines
+	# for writes to unknown registers.
+	def parse_emit(self, text):
+		offsets, values, targets, cmd_targets, names = [], [], [], [], []
+		target = None
+		for lineno, line in enumerate(text.splitlines(), 1):
+			try:
+				m = WARNING_RE.search(line)
+				if m:
+					target = int(m.group(1), 16)
+					continue
+				m = EMIT_RE.search(line)
+				if m:
+					packer = self.packer(m.group(1))
+					offsets.append(packer.offset)
+					values.append(self.parse_value(packer, m.group(2)))
+					targets.append(packer.target if target is None else target)
+					cmd_targets.append(packer.cmd_target)
+					names.append("REG_" + packer.name)
+					target = None
+					continue
+				m = RAW_RE.match(line)
+				if m:
+					t, o, v = (int(g, 16) for g in m.groups())
+					offsets.append(o)
+					values.append(v)
+					targets.append(t)
+					cmd_targets.append(t | CMD_OP_01 if t else 0)
+					names.append(None)
+			except (Error, ValueError) as e:
+				raise Error("line %d: %s" % (lineno, getattr(e, "message", e)))
+		return Program(offsets, values, targets, cmd_targets, names)
+
+def main():
+	parser = argparse.ArgumentParser(description="Assemble EMIT(...) text into command buffers")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--regdump', type=str, help='write regdump records here')
+	parser.add_argument('--commands', type=str, help='write 64-bit command words here')
+	parser.add_argument('input', nargs='?', default='-', help='EMIT text, - for stdin')
+	args = parser.parse_args()
+
+	try:
+		asm = Assembler.from_parser(load_parser("", args.xml))
+		text = sys.stdin.read() if args.input == '-' else open(args.input).read()
+		program = asm.parse_emit(text)
+	except Error as e:
+		print(e.message if hasattr(e, "message") else e, file=sys.stderr)
+		exit(1)
+
+	if args.regdump:
+		program.records().tofile(args.regdump)
+	if args.commands:
+		program.commands().astype("<u8").tofile(args.commands)
+	if not args.regdump and not args.commands:
+		for word in program.commands().tolist():
+			print("0x%016x" % word)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Bulk conversion of 64-bit NPU command words, as found in a raw GEM dump,
+# into regdump records.
+
+import sys
+import argparse
+import numpy as np
+from decode import RECORD_DTYPE
+from sparse import read_dump, dump_size
+
+# Command words are (target << 48) | (value << 16) | offset. The engine is
+# picked from bits 56..63 by the first bit set in this order, as the
+# dumpers always did (bit 58 is never looked at).
+CMD_TARGETS = (
+	(56, 0x0100, "PC"),
+	(57, 0x0200, "CNA"),
+	(59, 0x0800, "CORE"),
+	(60, 0x1000, "DPU"),
+	(61, 0x2000, "DPU_RDMA"),
+	(62, 0x4000, "PPU"),
+	(63, 0x8000, "PPU_RDMA"),
+)
+
+# Slot 0 is for words that don't name any engine
+TARGET_NAMES = ("noone",) + tuple(name for _, _, name in CMD_TARGETS)
+TARGET_VALUES = np.array([0] + [t for _, t, _ in CMD_TARGETS], dtype=np.uint16).view(np.int16)
+
+def priority_table():
+	table = np.zeros(256, dtype=np.uint8)
+	for b in range(256):
+		for slot, (bit, _, _) in enumerate(CMD_TARGETS, 1):
+			if b & (1 << (bit - 56)):
+				table[b] = slot
+				break
+	return table
+
+TARGET_SLOT = priority_table()
+
+def load_words(buf, size=None):
+	if size is None:
+		size = len(buf)
+	return np.frombuffer(buf, dtype="<u8", count=size // 8)
+
+class Commands(object):
+	# The non-zero words of a command buffer. positions are word indexes
+	# into the buffer and slots index TARGET_NAMES/TARGET_VALUES. With
+	# keep_zeros every word is kept, as for words that came one per record
+	# from a regdump.
+	def __init__(self, words, keep_zeros=False):
+		self.positions = np.arange(len(words)) if keep_zeros else np.flatnonzero(words)
+		self.words = words[self.positions]
+		self.offsets = (self.words & np.uint64(0xffff)).astype(np.uint16)
+		self.values = ((self.words >> np.uint64(16)) & np.uint64(0xffffffff)).astype(np.uint32)
+		self.slots = TARGET_SLOT[(self.words >> np.uint64(56)).astype(np.uint8)]
+
+	def __len__(self):
+		return len(self.positions)
+
+	@staticmethod
+	def from_buffer(buf, size=None):
+		return Commands(load_words(buf, size))
+
+	@staticmethod
+	def from_file(filename):
+		return Commands.from_buffer(read_dump(filename))
+
+	def targets(self):
+		return TARGET_VALUES[self.slots]
+
+	# dump2.py has always written 0 as the target of every record
+	def records(self, with_target=True):
+		records = np.zeros(len(self), dtype=RECORD_DTYPE)
+		records["offset"] = self.offsets.view(np.int16)
+		records["value"] = self.values
+		if with_target:
+			records["target"] = self.targets()
+		return records
+
+	def write_regdump(self, filename, with_target=True):
+		self.records(with_target).tofile(filename)
+
+# Heuristic classes of what a GEM object holds
+BUFFER_ZEROS = "zeros"
+BUFFER_COMMANDS = "commands"
+BUFFER_WEIGHTS = "weights"
+BUFFER_FEATURES = "features"
+
+# A buffer is a command stream when most of its non-zero words carry bit 48
+# and name an engine. Otherwise weights are told from feature data by their
+# bytes being spread out (few zeros, high entropy) where activations have
+# runs of zeros and repeated values.
+COMMAND_FRACTION = 0.5
+WEIGHT_ENTROPY = 6.0
+WEIGHT_ZERO_FRACTION = 0.1
+
+def byte_stats(data):
+	counts = np.bincount(data, minlength=256)
+	p = counts[counts > 0] / float(len(data))
+	return counts[0] / float(len(data)), float(-(p * np.log2(p)).sum())
+
+def classify_buffer(buf, size=None):
+	if size is None:
+		size = len(buf)
+	data = np.frombuffer(buf, dtype=np.uint8, count=size)
+	if not data.any():
+		return BUFFER_ZEROS
+
+	words = load_words(buf, size)
+	words = words[words != 0]
+	if len(words):
+		top = words >> np.uint64(48)
+		engine = (top & np.uint64(1)).astype(bool) & (TARGET_SLOT[(top >> np.uint64(8)).astype(np.uint8)] > 0)
+		if np.count_nonzero(engine) >= COMMAND_FRACTION * len(words):
+			return BUFFER_COMMANDS
+
+	zeros, entropy = byte_stats(data)
+	if entropy >= WEIGHT_ENTROPY and zeros < WEIGHT_ZERO_FRACTION:
+		return BUFFER_WEIGHTS
+	return BUFFER_FEATURES
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert a raw command buffer dump into regdump records")
+	parser.add_argument('--no-target', action='store_true', help='write 0 as the target of every record')
+	parser.add_argument('raw', type=str, help='raw dump, eg. dump/gem1-dump')
+	parser.add_argument('regdump', type=str, nargs='?', help='output, default <raw>_regdump.bin')
+	args = parser.parse_args()
+
+	out = args.regdump
+	if out is None:
+		out = (args.raw[:-len("-dump")] if args.raw.endswith("-dump") else args.raw) + "_regdump.bin"
+
+	commands = Commands.from_file(args.raw)
+	commands.write_regdump(out, not args.no_target)
+	print("%d of %d command words written to %s" % (len(commands), dump_size(args.raw) // 8, out),
+	      file=sys.stderr)
+
+if __name__ == '__main__':
+	main()
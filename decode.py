@@ -8,68 +8,454 @@ import sys
 import os
 import argparse
 import struct
-from gen_parser import Parser, Reg, Enum, mask, Error
+import mmap
+import glob
+import io
+import multiprocessing
+from gen_parser import load_parser, mask, Error
+from emit import Renderer, RegIndex, UINT_TYPES
+from sparse import SparseDump, is_sparse, dump_size, read_dump
 
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Layout of one record in a regdump.bin file, as written by dump.py
+RECORD_DTYPE = [("offset", "<i2"), ("value", "<u4"), ("target", "<i2")]
+RECORD_SIZE = 8
+
+# Streaming decode works on chunks of this many bytes (a whole number of
+# records) and writes through an output buffer of STREAM_OUT_BUFFER bytes
+STREAM_CHUNK_SIZE = 1 << 20
+STREAM_OUT_BUFFER = 1 << 20
+
+# A task's register program ends with the write that starts the engines
+TASK_END_OFFSETS = (0x0008, 0xf008)
+
+FIELD_SKIP = 0
+FIELD_BOOLEAN = 1
+FIELD_UINT = 2
+
+def load_records(filename, use_mmap=False):
+	if is_sparse(filename):
+		data = read_dump(filename)
+		return np.frombuffer(data, dtype=RECORD_DTYPE, count=len(data) // RECORD_SIZE)
+	count = os.path.getsize(filename) // RECORD_SIZE
+	if count == 0:
+		return np.zeros(0, dtype=RECORD_DTYPE)
+	if use_mmap:
+		return np.memmap(filename, dtype=RECORD_DTYPE, mode="r", shape=(count,))
+	return np.fromfile(filename, dtype=RECORD_DTYPE, count=count)
+
+# Start of every task plus a final end sentinel, so that task i spans
+# records[bounds[i]:bounds[i+1]]
+def task_bounds(records):
+	offsets = records["offset"].view(np.uint16)
+	ends = np.flatnonzero(np.isin(offsets, TASK_END_OFFSETS)) + 1
+	return np.unique(np.concatenate(([0], ends, [len(records)])))
+
+# Yields memoryviews over a single reusable buffer, each holding whole
+# records only. Short reads, as returned by pipes, are carried over to the
+# next chunk. A chunk is only valid until the next one is requested.
+def read_chunks(f, chunk_size=STREAM_CHUNK_SIZE):
+	buf = bytearray(chunk_size - chunk_size % RECORD_SIZE)
+	view = memoryview(buf)
+	pending = 0
+	while True:
+		n = f.readinto(view[pending:])
+		if not n:
+			break
+		pending += n
+		whole = pending - pending % RECORD_SIZE
+		if whole:
+			yield view[:whole]
+			view[:pending - whole] = view[whole:pending]
+			pending -= whole
+	if pending:
+		print("WARNING: ignoring %d trailing bytes" % pending, file=sys.stderr)
+
+def mmap_chunks(filename, chunk_size=STREAM_CHUNK_SIZE):
+	chunk_size -= chunk_size % RECORD_SIZE
+	with open(filename, "rb") as f:
+		size = os.fstat(f.fileno()).st_size
+		size -= size % RECORD_SIZE
+		if size == 0:
+			return
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+			# Chunks are copied out: the mapping can't be closed while
+			# the consumer still holds views into it
+			for start in range(0, size, chunk_size):
+				yield m[start:min(start + chunk_size, size)]
+
+def file_chunks(filename, chunk_size=STREAM_CHUNK_SIZE):
+	with open(filename, "rb", buffering=0) as f:
+		yield from read_chunks(f, chunk_size)
+
+# Sparse dumps are inflated one chunk at a time
+def sparse_chunks(filename, chunk_size=STREAM_CHUNK_SIZE):
+	chunk_size -= chunk_size % RECORD_SIZE
+	with SparseDump(filename) as d:
+		size = d.size - d.size % RECORD_SIZE
+		for start in range(0, size, chunk_size):
+			yield memoryview(d.read(start, min(chunk_size, size - start)))
+
+def stream_records(chunks):
+	for chunk in chunks:
+		yield from struct.iter_unpack("<hIh", chunk)
+
+class FieldTables(object):
+	# Flattened shift/mask tables for every field of every register, so
+	# that whole dumps can be decoded with a handful of array operations.
+	def __init__(self, index):
+		self.index = index
+		self.regs = index.regs
+
+		# Zero-copy views of the dense (domain, offset) tables
+		self.table = np.frombuffer(index.table, dtype=np.int32).reshape(index.nrows, 0x10000)
+		self.target_row = np.frombuffer(index.target_row, dtype=np.int32)
+
+		self.reg_domain = np.array(index.reg_domain, dtype=np.int64)
+		self.reg_nfields = np.array([len(reg.bitset.fields) for reg in self.regs], dtype=np.int64)
+		self.reg_first = np.zeros(len(self.regs), dtype=np.int64)
+		if len(self.regs):
+			self.reg_first[1:] = np.cumsum(self.reg_nfields)[:-1]
+
+		shift, fmask, kind, names, labels = [], [], [], [], []
+		for reg in self.regs:
+			for field in reg.bitset.fields:
+				if field.type == "boolean":
+					# Booleans are tested on their high bit, like the text decoder does
+					shift.append(field.high)
+					fmask.append(1)
+					kind.append(FIELD_BOOLEAN)
+				elif field.type in UINT_TYPES:
+					shift.append(field.low)
+					fmask.append(mask(0, field.high - field.low))
+					kind.append(FIELD_UINT)
+				else:
+					shift.append(0)
+					fmask.append(0)
+					kind.append(FIELD_SKIP)
+				if field.name:
+					names.append("%s_%s" % (reg.full_name.upper(), field.name.upper()))
+					labels.append(field.name.upper())
+				else:
+					names.append(reg.full_name.upper())
+					labels.append(reg.name.upper())
+
+		self.field_shift = np.array(shift, dtype=np.uint32)
+		self.field_mask = np.array(fmask, dtype=np.uint32)
+		self.field_kind = np.array(kind, dtype=np.uint8)
+		self.field_names = names
+		self.field_labels = labels
+		self.reg_names = ["REG_%s" % reg.full_name.upper() for reg in self.regs]
+
+	@staticmethod
+	def from_parser(p):
+		return FieldTables(RegIndex.from_parser(p))
+
+class Decoded(object):
+	# Result of decode_records(). Field values are stored CSR-style:
+	# record i owns field_values[field_ptr[i]:field_ptr[i+1]], in the order
+	# of its register's bitset, with field_ids indexing into FieldTables.
+	def __init__(self, records, reg, mismatch, field_ptr, field_ids, field_values):
+		self.records = records
+		self.reg = reg
+		self.mismatch = mismatch
+		self.field_ptr = field_ptr
+		self.field_ids = field_ids
+		self.field_values = field_values
+
+	def __len__(self):
+		return len(self.records)
+
+# Register index of every record, -1 for unknown offsets
+def lookup_regs(records, tables):
+	offsets = records["offset"].view(np.uint16)
+	targets = records["target"].astype(np.int64)
+	reg = tables.table[tables.target_row[targets & 0xfffe], offsets]
+	fallback = reg < 0
+	reg[fallback] = tables.table[0, offsets[fallback]]
+	return reg
+
+def decode_records(records, tables):
+	values = records["value"].astype(np.uint32)
+	targets = records["target"].astype(np.int64)
+
+	reg = lookup_regs(records, tables)
+	known = reg >= 0
+	known_reg = reg[known]
+
+	mismatch = np.zeros(len(records), dtype=bool)
+	mismatch[known] = (targets[known] & 0xfffffffe) != tables.reg_domain[known_reg]
+
+	nfields = np.zeros(len(records), dtype=np.int64)
+	nfields[known] = tables.reg_nfields[known_reg]
+	field_ptr = np.zeros(len(records) + 1, dtype=np.int64)
+	np.cumsum(nfields, out=field_ptr[1:])
+
+	# Expand each record into one slot per field of its register
+	total = int(field_ptr[-1])
+	rec_of_slot = np.repeat(np.arange(len(records)), nfields)
+	first = np.zeros(len(records), dtype=np.int64)
+	first[known] = tables.reg_first[known_reg]
+	field_ids = first[rec_of_slot] + (np.arange(total) - field_ptr[:-1][rec_of_slot])
+	field_values = (values[rec_of_slot] >> tables.field_shift[field_ids]) & tables.field_mask[field_ids]
+
+	return Decoded(records, reg, mismatch, field_ptr, field_ids, field_values)
+
+def render_decoded(decoded, tables, renderer, out):
+	records = decoded.records
+	offsets = records["offset"].tolist()
+	values = records["value"].tolist()
+	targets = records["target"].tolist()
+	regs = decoded.reg.tolist()
+	mismatch = decoded.mismatch.tolist()
+	render_reg = renderer.render_reg
+
+	lines = []
+	for i in range(len(records)):
+		r = regs[i]
+		if r < 0:
+			lines.append("%x %x %x" % (targets[i], offsets[i], values[i]))
+			continue
+
+		if mismatch[i]:
+			lines.append("WARNING: target 0x%x doesn't match register's domain 0x%x" % (targets[i], tables.reg_domain[r]))
+
+		lines.append(render_reg(r, values[i]))
+
+	if lines:
+		out.write("\n".join(lines))
+		out.write("\n")
+
+def render_stream(records, renderer, write):
+	lookup = renderer.index.lookup
+	render_reg = renderer.render_reg
+	reg_domain = renderer.index.reg_domain
+	for offset, value, target in records:
+		i = lookup(offset, target)
+		if i >= 0:
+			line = render_reg(i, value)
+			domain = reg_domain[i]
+			if (target & 0xfffffffe) != domain:
+				write("WARNING: target 0x%x doesn't match register's domain 0x%x\n" % (target, domain))
+			write(line)
+			write("\n")
+		else:
+			write("%x %x %x\n" % (target, offset, value))
+
+def batch_main(args, p, data=None):
+	if np is None:
+		print("numpy not found, batch decoding is not available", file=sys.stderr)
+		exit(1)
+
+	tables = FieldTables.from_parser(p)
+	if data is None:
+		records = load_records(args.dump, args.mmap)
+	else:
+		records = np.frombuffer(data, dtype=RECORD_DTYPE)
+	decoded = decode_records(records, tables)
+
+	if args.no_text:
+		print("%d records, %d known, %d target mismatches, %d fields" %
+		      (len(decoded), int((decoded.reg >= 0).sum()), int(decoded.mismatch.sum()),
+		       len(decoded.field_values)))
+	else:
+		renderer = Renderer(tables.index)
+		render_decoded(decoded, tables, renderer, sys.stdout)
+		if args.stats:
+			print(renderer.stats(), file=sys.stderr)
+
+def open_chunks(args):
+	if args.dump == "-":
+		return read_chunks(sys.stdin.buffer)
+	if is_sparse(args.dump):
+		return sparse_chunks(args.dump)
+	if args.mmap:
+		return mmap_chunks(args.dump)
+	return file_chunks(args.dump)
+
+def stream_main(args, p):
+	if args.batch and np is None:
+		print("numpy not found, batch decoding is not available", file=sys.stderr)
+		exit(1)
+
+	index = RegIndex.from_parser(p)
+	renderer = Renderer(index)
+	chunks = open_chunks(args)
+	out = open(sys.stdout.fileno(), "w", buffering=STREAM_OUT_BUFFER, closefd=False)
+
+	try:
+		if args.batch:
+			tables = FieldTables(index)
+			for chunk in chunks:
+				records = np.frombuffer(chunk, dtype=RECORD_DTYPE)
+				render_decoded(decode_records(records, tables), tables, renderer, out)
+		else:
+			render_stream(stream_records(chunks), renderer, out.write)
+		out.flush()
+	except BrokenPipeError:
+		# Reader went away (ie. piped into head), nothing left to do
+		os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+		exit(1)
+
+	if args.stats:
+		print(renderer.stats(), file=sys.stderr)
+
+# Everything a worker needs to decode a shard. Built in the parent before
+# the pool forks so the workers share it instead of re-parsing the XML.
+class DecodeContext(object):
+	def __init__(self, p):
+		self.index = RegIndex.from_parser(p)
+		self.renderer = Renderer(self.index)
+		self.tables = FieldTables(self.index) if np is not None else None
+
+_context = None
+
+def init_worker(xml, use_cache):
+	global _context
+	if _context is None:
+		_context = DecodeContext(load_parser("", xml, use_cache))
+
+def decode_shard(shard):
+	filename, start, count = shard
+	ctx = _context
+	out = io.StringIO()
+	data = read_dump(filename, start * RECORD_SIZE, count * RECORD_SIZE)
+	if ctx.tables is not None:
+		records = np.frombuffer(data, dtype=RECORD_DTYPE)
+		render_decoded(decode_records(records, ctx.tables), ctx.tables, ctx.renderer, out)
+	else:
+		render_stream(struct.iter_unpack("<hIh", data), ctx.renderer, out.write)
+	return out.getvalue()
+
+def is_glob(pattern):
+	return any(c in pattern for c in "*?[")
+
+def expand_dumps(pattern):
+	if os.path.isdir(pattern):
+		return sorted(glob.glob(os.path.join(pattern, "*_regdump.bin")))
+	if is_glob(pattern):
+		return sorted(glob.glob(pattern))
+	return [pattern]
+
+# Split every file into record-aligned byte ranges, enough of them to keep
+# all workers busy even when a single huge file dominates.
+def make_shards(filenames, jobs, min_records=1 << 16):
+	total = sum(dump_size(f) // RECORD_SIZE for f in filenames)
+	shard_records = max(min_records, -(-total // (jobs * 4)))
+	shards = []
+	for filename in filenames:
+		count = dump_size(filename) // RECORD_SIZE
+		for start in range(0, count, shard_records):
+			shards.append((filename, start, min(shard_records, count - start)))
+		if count == 0:
+			shards.append((filename, 0, 0))
+	return shards
+
+def parallel_main(args, p):
+	global _context
+	filenames = expand_dumps(args.dump)
+	jobs = args.jobs or os.cpu_count() or 1
+	shards = make_shards(filenames, jobs)
+
+	_context = DecodeContext(p)
+	methods = multiprocessing.get_all_start_methods()
+	mp = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+	out = open(sys.stdout.fileno(), "w", buffering=STREAM_OUT_BUFFER, closefd=False)
+	current = None
+	with mp.Pool(jobs, init_worker, (args.xml, not args.no_cache)) as pool:
+		# imap keeps results in shard order, so output is deterministic
+		for shard, text in zip(shards, pool.imap(decode_shard, shards)):
+			if len(filenames) > 1 and shard[0] != current:
+				current = shard[0]
+				out.write("==> %s <==\n" % current)
+			out.write(text)
+	out.flush()
 
 def main():
+	if sys.argv[1:2] == ["diff"]:
+		import regdiff
+		regdiff.main(sys.argv[2:])
+		return
+
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--xml', type=str, required=True)
-	parser.add_argument('--dump', type=str, required=True)
+	parser.add_argument('--dump', type=str, required=True,
+			    help='regdump file, directory or glob to decode, or - to stream from stdin')
+	parser.add_argument('--jobs', '-j', type=int, default=0,
+			    help='decode on a pool of this many processes (default: one per core)')
+	parser.add_argument('--batch', action='store_true',
+			    help='decode the whole dump at once with numpy')
+	parser.add_argument('--stream', action='store_true',
+			    help='decode in fixed-size chunks with bounded memory')
+	parser.add_argument('--mmap', action='store_true',
+			    help='map the dump instead of reading it')
+	parser.add_argument('--no-text', action='store_true',
+			    help='with --batch, skip EMIT rendering and print a summary')
+	parser.add_argument('--stats', action='store_true',
+			    help='report EMIT cache statistics on stderr')
+	parser.add_argument('--no-cache', action='store_true',
+			    help='always re-parse the XML and rebuild task indexes instead of using cached copies')
+	parser.add_argument('--tasks', action='store_true',
+			    help='list the tasks of the dump, from the index kept next to it')
+	parser.add_argument('--task', type=str,
+			    help='only decode task N, or tasks N:M')
 
 	args = parser.parse_args()
 
-	p = Parser()
-
 	try:
-		p.parse("", args.xml)
+		p = load_parser("", args.xml, not args.no_cache)
 	except Error as e:
 		print(e, file=sys.stderr)
 		exit(1)
 
-	regs = {}
-	for e in p.file:
-		if isinstance(e, Reg):
-			regs[e.offset] = e
-
-	domains = {}
-	for e in p.file:
-		if isinstance(e, Enum):
-			if e.name == "target":
-				for name, val in e.values:
-					domains[name] = val
-
-	f = open(args.dump, mode='rb')
-	for i in range(0, os.path.getsize(args.dump) // 8):
-		cmd = f.read(8)
-		(offset, value, target) = struct.unpack("<hIh", cmd)
-		if offset in regs.keys():
-			reg = regs[offset]
-
-			if (target & 0xfffffffe) != domains[reg.domain]:
-				print("WARNING: target 0x%x doesn't match register's domain 0x%x" % (target, domains[reg.domain]))
-
-			print("EMIT(REG_%s, " % regs[offset].full_name.upper(), end="")
-			first = True
-			if value == 0 or len(reg.bitset.fields) == 1:
-				print("0x%x" % value, end="")
-			else:
-				for field in reg.bitset.fields:
-					if field.type == "boolean":
-						if 1 << field.high & value:
-							if not first:
-								print(" | ", end="")
-							print("%s_%s" % (reg.full_name.upper(), field.name.upper()), end="")
-							first = False
-					elif field.type == "uint":
-						field_value = (value & mask(field.low, field.high)) >> field.low
-						if field_value != 0:
-							if not first:
-								print(" | ", end="")
-							print("%s_%s(%d)" % (reg.full_name.upper(), field.name.upper(), field_value), end="")
-							first = False
-			print(");")
+	data = None
+	if args.tasks or args.task is not None:
+		if np is None:
+			print("numpy not found, task indexes are not available", file=sys.stderr)
+			exit(1)
+		import tasks
+		try:
+			data = tasks.tasks_main(args, FieldTables.from_parser(p))
+		except Error as e:
+			print(e.message, file=sys.stderr)
+			exit(1)
+		if data is None:
+			return
+	elif args.dump != "-" and (args.jobs or os.path.isdir(args.dump) or is_glob(args.dump)):
+		parallel_main(args, p)
+		return
+	elif args.stream or args.dump == "-":
+		stream_main(args, p)
+		return
+
+	if args.batch:
+		batch_main(args, p, data)
+		return
+
+	index = RegIndex.from_parser(p)
+	renderer = Renderer(index)
+
+	if data is None:
+		data = read_dump(args.dump)
+	for (offset, value, target) in struct.iter_unpack("<hIh", data[:len(data) - len(data) % 8]):
+		i = index.lookup(offset, target)
+		if i >= 0:
+			domain = index.reg_domain[i]
+
+			if (target & 0xfffffffe) != domain:
+				print("WARNING: target 0x%x doesn't match register's domain 0x%x" % (target, domain))
+
+			print(renderer.render_reg(i, value))
 		else:
 			print("%x %x %x" % (target, offset, value))
 
+	if args.stats:
+		print(renderer.stats(), file=sys.stderr)
+
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,126 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# Shared EMIT(...) rendering for decode.py, dump.py and dump2.py.
+
+import functools
+from array import array
+
+# Addresses are plain numbers as far as decoding goes
+UINT_TYPES = ("uint", "address", "waddress")
+
+def target_domains(p):
+	if "target" not in p.enums:
+		return {}
+	return dict(p.enum_values("target"))
+
+class RegIndex(object):
+	# Dense (domain, offset) -> register lookup. Each domain of the target
+	# enum gets a row of 64K entries holding indexes into self.regs, or -1.
+	# Row 0 is keyed by offset alone and catches records whose target
+	# doesn't name a domain (dump2.py writes 0) or names the wrong one.
+	def __init__(self, regs, domains):
+		self.regs = list(regs)
+		self.domains = domains
+		self.reg_domain = [domains[reg.domain] for reg in self.regs]
+
+		rows = {}
+		self.target_row = array("i", [0]) * 0x10000
+		for name, value in domains.items():
+			rows[name] = len(rows) + 1
+			# Regdump records only have 16 bits for the target
+			if value <= 0xffff:
+				self.target_row[value & 0xfffe] = rows[name]
+		self.nrows = len(rows) + 1
+
+		self.table = array("i", [-1]) * (self.nrows << 16)
+		for i, reg in enumerate(self.regs):
+			offset = reg.offset & 0xffff
+			self.table[offset] = i
+			if reg.domain in rows:
+				self.table[(rows[reg.domain] << 16) | offset] = i
+
+	@staticmethod
+	def from_parser(p):
+		return RegIndex(p.regs, target_domains(p))
+
+	def lookup(self, offset, target=0):
+		offset &= 0xffff
+		row = self.target_row[target & 0xfffe]
+		if row:
+			i = self.table[(row << 16) | offset]
+			if i >= 0:
+				return i
+		return self.table[offset]
+
+def compile_formatter(reg, hex_format="0x%x"):
+	prefix = "EMIT(REG_%s, " % reg.full_name.upper()
+	fields = reg.bitset.fields
+
+	if len(fields) == 1:
+		def format_raw(value):
+			return prefix + hex_format % value + ");"
+		return format_raw
+
+	# (bit, shift, mask, name): booleans are tested on their high bit,
+	# uints are extracted and printed, anything else is not rendered.
+	compiled = []
+	for field in fields:
+		if field.type == "boolean":
+			name = "%s_%s" % (reg.full_name.upper(), field.name.upper())
+			compiled.append((1 << field.high, 0, 0, name))
+		elif field.type in UINT_TYPES:
+			name = "%s_%s" % (reg.full_name.upper(), field.name.upper())
+			compiled.append((0, field.low, (1 << (field.high - field.low + 1)) - 1, name))
+	compiled = tuple(compiled)
+
+	def format_fields(value):
+		if value == 0:
+			return prefix + hex_format % value + ");"
+		parts = []
+		for bit, shift, m, name in compiled:
+			if bit:
+				if value & bit:
+					parts.append(name)
+			else:
+				v = (value >> shift) & m
+				if v:
+					parts.append("%s(%d)" % (name, v))
+		return prefix + " | ".join(parts) + ");"
+	return format_fields
+
+class Renderer(object):
+	# Renders register writes to EMIT lines. Formatters are compiled lazily
+	# once per register and rendered lines are kept in a bounded LRU keyed
+	# by (register, value), since command buffers repeat the same writes
+	# over and over.
+	def __init__(self, index, hex_format="0x%x", cache_size=1 << 16):
+		self.index = index
+		self.hex_format = hex_format
+		self.formatters = [None] * len(index.regs)
+		self.render_reg = functools.lru_cache(maxsize=cache_size)(self._render_reg)
+
+	@staticmethod
+	def from_parser(p, hex_format="0x%x", cache_size=1 << 16):
+		return Renderer(RegIndex.from_parser(p), hex_format, cache_size)
+
+	def _render_reg(self, i, value):
+		fmt = self.formatters[i]
+		if fmt is None:
+			fmt = compile_formatter(self.index.regs[i], self.hex_format)
+			self.formatters[i] = fmt
+		return fmt(value)
+
+	# Returns None for writes that aren't in the register database
+	def render(self, offset, value, target=0):
+		i = self.index.lookup(offset, target)
+		if i < 0:
+			return None
+		return self.render_reg(i, value)
+
+	def stats(self):
+		info = self.render_reg.cache_info()
+		total = info.hits + info.misses
+		rate = 100.0 * info.hits / total if total else 0.0
+		return "emit cache: %d hits, %d misses, %.1f%% hit rate, %d/%d entries" % \
+			(info.hits, info.misses, rate, info.currsize, info.maxsize)
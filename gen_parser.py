@@ -1,22 +1,36 @@
 import xml.parsers.expat
 import sys
 import os
+import argparse
 import collections
+import keyword
+import hashlib
+import pickle
+import tempfile
+
+# Bump whenever the pickled layout of Parser and friends changes, so stale
+# caches are ignored instead of unpickled into the wrong shape.
+CACHE_VERSION = 2
 
 class Error(Exception):
 	def __init__(self, message):
 		self.message = message
 
 class Enum(object):
+	__slots__ = ("name", "values", "names")
+
 	def __init__(self, name):
 		self.name = name
 		self.values = []
+		# name -> value, kept in sync with self.values by add_value()
+		self.names = {}
+
+	def add_value(self, name, value):
+		self.values.append((name, value))
+		self.names[name] = value
 
 	def has_name(self, name):
-		for (n, value) in self.values:
-			if n == name:
-				return True
-		return False
+		return name in self.names
 
 	def dump(self):
 		use_hex = False
@@ -36,6 +50,8 @@ class Enum(object):
 		pass
 
 class Field(object):
+	__slots__ = ("name", "low", "high", "shr", "type", "radix")
+
 	def __init__(self, name, low, high, shr, type, parser):
 		self.name = name
 		self.low = low
@@ -120,6 +136,8 @@ def field_name(reg, f):
 	return name
 
 class Bitset(object):
+	__slots__ = ("name", "inline", "fields")
+
 	def __init__(self, name, template):
 		self.name = name
 		self.inline = False
@@ -250,6 +268,68 @@ class Bitset(object):
 				print("\treturn ((%s) << %s__SHIFT) & %s__MASK;\n}" % (val, name, name))
 		print()
 
+	# (name, field) of every field as the Python packers name them: the
+	# generated classes and assemble.py's Packer
+	def py_fields(self, reg):
+		fields = []
+		for f in self.fields:
+			name = field_name(reg, f)
+			if keyword.iskeyword(name):
+				name = "_" + name
+			fields.append((name, f))
+		return fields
+
+	def dump_py_pack(self, reg, target):
+		fields = self.py_fields(reg)
+
+		print("class %s(object):" % reg.full_name)
+		print("\t__slots__ = (%s)" % "".join("\"%s\", " % name for name, f in fields))
+		print("\tOFFSET = 0x%08x" % reg.offset)
+		print("\tDOMAIN = \"%s\"" % reg.domain)
+		print("\tTARGET = 0x%x" % target)
+		for name, f in fields:
+			print("\t%s__SHIFT = %d" % (name.upper(), f.low))
+			print("\t%s__MASK = 0x%08x" % (name.upper(), mask(0, f.high - f.low)))
+		print()
+
+		args = "".join(", %s=0" % name for name, f in fields)
+		print("\tdef __init__(self%s):" % args)
+		for name, f in fields:
+			print("\t\tself.%s = %s" % (name, name))
+		if not fields:
+			print("\t\tpass")
+		print()
+
+		print("\tdef pack(self):")
+		for name, f in fields:
+			print("\t\tif self.%s & ~0x%x:" % (name, mask(0, f.high - f.low)))
+			print("\t\t\traise ValueError(\"%s.%s out of range\")" % (reg.full_name, name))
+		print("\t\treturn (%s)" % (" |\n\t\t\t".join("(self.%s << %d)" % (name, f.low) for name, f in fields) or "0"))
+		print()
+
+		print("\t@staticmethod")
+		print("\tdef unpack(value):")
+		print("\t\treturn %s(%s)" % (reg.full_name, ", ".join("(value >> %d) & 0x%x" % (f.low, mask(0, f.high - f.low)) for name, f in fields)))
+		print()
+
+		# Vectorized variants, one element per value
+		print("\t@staticmethod")
+		print("\tdef pack_array(%s):" % ", ".join("%s=0" % name for name, f in fields))
+		print("\t\tvalue = np.zeros(np.broadcast(%s).shape, dtype=np.uint32)" % (", ".join(name for name, f in fields) or "0"))
+		for name, f in fields:
+			print("\t\tvalue |= (np.asarray(%s, dtype=np.uint32) & np.uint32(0x%x)) << np.uint32(%d)" % (name, mask(0, f.high - f.low), f.low))
+		print("\t\treturn value")
+		print()
+
+		print("\t@staticmethod")
+		print("\tdef unpack_array(values):")
+		print("\t\tvalues = np.asarray(values, dtype=np.uint32)")
+		print("\t\treturn {")
+		for name, f in fields:
+			print("\t\t\t\"%s\": (values >> np.uint32(%d)) & np.uint32(0x%x)," % (name, f.low, mask(0, f.high - f.low)))
+		print("\t\t}")
+		print()
+
 class Array(object):
 	def __init__(self, attrs, domain, variant):
 		if "name" in attrs:
@@ -276,6 +356,8 @@ class Array(object):
 		pass
 
 class Reg(object):
+	__slots__ = ("name", "domain", "array", "offset", "type", "bit_size", "full_name", "bitset")
+
 	def __init__(self, attrs, domain, array, bit_size):
 		self.name = attrs["name"]
 		self.domain = domain
@@ -308,6 +390,9 @@ class Reg(object):
 	def dump_py(self):
 		print("\tREG_%s = 0x%08x" % (self.full_name, self.offset))
 
+	def dump_py_pack(self, target):
+		self.bitset.dump_py_pack(self, target)
+
 
 class Parser(object):
 	def __init__(self):
@@ -335,6 +420,12 @@ class Parser(object):
 		self.copyright_year = None
 		self.authors = []
 		self.license = None
+		# Lookup indexes, filled in by build_indexes() once parsing is done
+		self.regs = []
+		self.regs_by_offset = {}
+		self.regs_by_domain_offset = {}
+		self.regs_by_name = {}
+		self.fields_by_name = collections.defaultdict(list)
 
 	def error(self, message):
 		parser, filename = self.stack[-1]
@@ -483,6 +574,24 @@ class Parser(object):
 		self.path = rnn_path
 		self.stack = []
 		self.do_parse(filename)
+		self.build_indexes()
+
+	def build_indexes(self):
+		self.regs = [e for e in self.file if isinstance(e, Reg)]
+		self.regs_by_offset = {}
+		self.regs_by_domain_offset = {}
+		self.regs_by_name = {}
+		self.fields_by_name = collections.defaultdict(list)
+		for reg in self.regs:
+			self.regs_by_offset[reg.offset] = reg
+			self.regs_by_domain_offset[(reg.domain, reg.offset)] = reg
+			self.regs_by_name[reg.full_name] = reg
+			for field in reg.bitset.fields:
+				if field.name:
+					self.fields_by_name[field.name].append((reg, field))
+
+	def enum_values(self, name):
+		return self.enums[name].names
 
 	def parse_reg(self, attrs, bit_size):
 		self.current_bitsize = bit_size
@@ -548,7 +657,7 @@ class Parser(object):
 				value = int(attrs["value"], 0)
 			else:
 				value = self.current_enum_value
-			self.current_enum.values.append((attrs["name"], value))
+			self.current_enum.add_value(attrs["name"], value)
 		elif name == "reg32":
 			self.parse_reg(attrs, 32)
 		elif name == "reg64":
@@ -656,13 +765,30 @@ class Parser(object):
 
 
 	def dump_regs_py(self):
-		regs = []
-		for e in self.file:
-			if isinstance(e, Reg):
-				regs.append(e)
+		for e in self.regs:
+			e.dump_py()
+
+	def dump_py_pack(self):
+		regs = self.regs
+
+		targets = {}
+		if "target" in self.enums:
+			targets = self.enum_values("target")
+
+		print("try:")
+		print("\timport numpy as np")
+		print("except ImportError:")
+		print("\tnp = None")
+		print()
 
 		for e in regs:
-			e.dump_py()
+			e.dump_py_pack(targets.get(e.domain, 0))
+
+		# Offsets are only unique within a domain, as in the decoders' tables
+		print("REGS = {")
+		for e in regs:
+			print("\t(\"%s\", 0x%04x): %s," % (e.domain, e.offset, e.full_name))
+		print("}")
 
 
 	def dump_reg_variants(self, regname, variants):
@@ -739,3 +865,122 @@ class Parser(object):
 
 		for regname in self.variant_regs:
 			self.dump_reg_variants(regname, self.variant_regs[regname])
+
+def file_digest(filename):
+	with open(filename, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def cache_path(filename):
+	return os.path.join(os.path.dirname(os.path.abspath(filename)),
+			    os.path.basename(filename) + ".cache")
+
+def read_cache(rnn_path, filename):
+	try:
+		with open(cache_path(filename), "rb") as f:
+			version, key, digests, p = pickle.load(f)
+	except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+		return None
+
+	if version != CACHE_VERSION or key != (rnn_path, file_digest(filename)):
+		return None
+
+	# Imported files are part of the database too
+	for xml_file, digest in digests.items():
+		try:
+			if file_digest(xml_file) != digest:
+				return None
+		except OSError:
+			return None
+
+	return p
+
+def write_cache(rnn_path, filename, p):
+	key = (rnn_path, file_digest(filename))
+	digests = {}
+	for xml_file in p.xml_files:
+		digests[xml_file] = file_digest(xml_file)
+
+	path = cache_path(filename)
+	try:
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+	except OSError:
+		# Read-only checkout, just go without a cache
+		return
+	try:
+		with os.fdopen(fd, "wb") as f:
+			pickle.dump((CACHE_VERSION, key, digests, p), f, pickle.HIGHEST_PROTOCOL)
+		os.chmod(tmp, 0o644)
+		os.replace(tmp, path)
+	except OSError:
+		os.unlink(tmp)
+
+# Parse filename, going through a pickled copy of the database stored next
+# to it when one exists for the current contents of the XML.
+def load_parser(rnn_path, filename, use_cache=True):
+	if use_cache:
+		p = read_cache(rnn_path, filename)
+		if p is not None:
+			return p
+
+	p = Parser()
+	p.parse(rnn_path, filename)
+	p.stack = []
+
+	if use_cache:
+		write_cache(rnn_path, filename, p)
+
+	return p
+
+def dump_c_defines(args, p):
+	p.dump()
+
+def dump_c_pack_structs(args, p):
+	p.dump_structs()
+
+def dump_py_defines(args, p):
+	file_name = os.path.splitext(os.path.basename(args.xml))[0]
+
+	print("# Generated by gen_parser.py from %s, do not edit." % os.path.basename(args.xml))
+	print()
+	print("from enum import IntEnum")
+	print("class %sRegs(IntEnum):" % file_name.upper())
+
+	p.dump_regs_py()
+
+def dump_py_pack(args, p):
+	print("# Generated by gen_parser.py from %s, do not edit." % os.path.basename(args.xml))
+	print()
+
+	p.dump_py_pack()
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--rnn', type=str, default="")
+	parser.add_argument('--xml', type=str, required=True)
+
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_c_defines = subparsers.add_parser('c-defines')
+	parser_c_defines.set_defaults(func=dump_c_defines)
+
+	parser_c_pack_structs = subparsers.add_parser('c-pack-structs')
+	parser_c_pack_structs.set_defaults(func=dump_c_pack_structs)
+
+	parser_py_defines = subparsers.add_parser('py-defines')
+	parser_py_defines.set_defaults(func=dump_py_defines)
+
+	parser_py_pack = subparsers.add_parser('py-pack')
+	parser_py_pack.set_defaults(func=dump_py_pack)
+
+	args = parser.parse_args()
+
+	try:
+		p = load_parser(args.rnn, args.xml)
+	except Error as e:
+		print(e, file=sys.stderr)
+		exit(1)
+
+	args.func(args, p)
+
+if __name__ == '__main__':
+	main()
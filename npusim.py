@@ -0,0 +1,591 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Functional simulator of the NPU on the CPU. It replays a register program
+# task by task and runs the engines each task starts over whole feature
+# cubes with numpy: the CNA convolution (input conversion, padding, stride
+# and dilation, as an im2col matrix product) and the CORE truncation, then
+# the DPU pipeline, fed either by CORE or by its MRDMA: the BS and BN stages
+# (ALU, MUL, RELU/RELUX), the EW stage with its ERDMA operand, OUT_CVT and
+# the WDMA write back to memory. Only what the registers say is modelled,
+# not timing, and the semantics of the fields are a best guess from the
+# captures, old/matmul and NVDLA, which the CNA and DPU derive from.
+
+import sys
+import bisect
+import argparse
+import numpy as np
+from gen_parser import load_parser, Error
+from decode import FieldTables, load_records, lookup_regs
+from assemble import Assembler
+from cmdbuf import Commands
+
+# Engines a PC_OPERATION_ENABLE write starts, as in the job's enable_mask
+ENGINE_CNA = 0x01
+ENGINE_CORE = 0x04
+ENGINE_DPU = 0x08
+ENGINE_DPU_RDMA = 0x10
+ENGINE_PPU = 0x20
+ENGINE_PPU_RDMA = 0x40
+
+# Feature cubes are stored as surfaces of ATOM_SIZE bytes per pixel, each
+# holding the next ATOM_SIZE / itemsize channels (NC1HWC2)
+ATOM_SIZE = 16
+
+# *_PRECISION fields
+PRECISIONS = {
+	0: np.dtype(np.int8),
+	1: np.dtype(np.int16),
+	2: np.dtype(np.float16),
+	4: np.dtype(np.int32),
+	5: np.dtype(np.float32),
+}
+
+# ERDMA_DATA_SIZE, in bytes
+EW_DATA_SIZES = {0: 1, 1: 2, 2: 4}
+
+# *_ALU_ALGO, as numbered by old/matmul/alu_int8.c
+ALU_MAX = 0
+ALU_MIN = 1
+ALU_ADD = 2
+ALU_DIV = 3
+ALU_SUB = 4
+ALU_ABS = 5
+ALU_NEG = 6
+ALU_FLOOR = 7
+ALU_CEIL = 8
+
+# CONV_MODE
+CONV_DIRECT = 0
+
+# Weights are stored in groups of WEIGHT_KERNELS / itemsize kernels, each
+# split in groups of WEIGHT_CHANNELS input channels (old/matmul weight_int8)
+WEIGHT_KERNELS = 32
+WEIGHT_CHANNELS = 32
+
+# What the registers ask for but isn't modelled. The task is skipped and
+# reported, the rest of the program still runs.
+class Unsupported(Error):
+	pass
+
+def precision(value):
+	try:
+		return PRECISIONS[value]
+	except KeyError:
+		raise Unsupported("precision %d isn't simulated" % value)
+
+def sign_extend(value, bits):
+	value &= (1 << bits) - 1
+	return value - (1 << bits) if value >> (bits - 1) else value
+
+# A register operand: an integer, or the bits of a float when the DPU
+# processes floats
+def operand(value, bits, is_float):
+	if is_float:
+		return float(np.array(value, dtype=np.uint32 if bits == 32 else np.uint16).view(
+			np.float32 if bits == 32 else np.float16))
+	return sign_extend(value, bits)
+
+# Shift right, rounding half up
+def shift_right(x, shift):
+	if shift == 0:
+		return x
+	return (x + (1 << (shift - 1))) >> shift
+
+def alu(algo, x, y):
+	if algo == ALU_MAX:
+		return np.maximum(x, y)
+	if algo == ALU_MIN:
+		return np.minimum(x, y)
+	if algo == ALU_ADD:
+		return x + y
+	if algo == ALU_SUB:
+		return x - y
+	if algo == ALU_DIV:
+		y = np.broadcast_to(y, x.shape)
+		if x.dtype.kind == "f":
+			with np.errstate(divide="ignore", invalid="ignore"):
+				return x / y
+		# Like C, rounding towards zero, and 0 for a zero divisor
+		q = np.abs(x) // np.maximum(np.abs(y), 1)
+		return np.where(y == 0, 0, np.where((x < 0) != (y < 0), -q, q))
+	if algo == ALU_ABS:
+		return np.abs(x)
+	if algo == ALU_NEG:
+		return -x
+	if algo == ALU_FLOOR:
+		return np.floor(x) if x.dtype.kind == "f" else x
+	if algo == ALU_CEIL:
+		return np.ceil(x) if x.dtype.kind == "f" else x
+	raise Unsupported("ALU algorithm %d isn't simulated" % algo)
+
+def saturate(x, dtype):
+	if dtype.kind == "f":
+		return x.astype(dtype)
+	info = np.iinfo(dtype)
+	return np.clip(x, info.min, info.max).astype(dtype)
+
+def surface_channels(dtype):
+	return ATOM_SIZE // dtype.itemsize
+
+def surface_size(height, width):
+	return height * width * ATOM_SIZE
+
+# Bytes a cube of shape (channels, height, width) spans in memory
+def cube_size(shape, dtype, surf_stride=None):
+	channels, height, width = shape
+	surfaces = -(-channels // surface_channels(dtype))
+	surf_stride = surf_stride or surface_size(height, width)
+	return (surfaces - 1) * surf_stride + surface_size(height, width)
+
+# Cube surfaces as a (surfaces, height, width, surface channels) view of
+# the bytes in data
+def surface_view(data, shape, dtype, surf_stride):
+	channels, height, width = shape
+	c2 = surface_channels(dtype)
+	surfaces = -(-channels // c2)
+	surf_stride = surf_stride or surface_size(height, width)
+	view = np.lib.stride_tricks.as_strided(data, (surfaces, surface_size(height, width)), (surf_stride, 1),
+					       writeable=data.flags.writeable)
+	return view, (surfaces, height, width, c2)
+
+def unpack_cube(data, shape, dtype, surf_stride=None):
+	view, surfaces = surface_view(data, shape, dtype, surf_stride)
+	cube = np.ascontiguousarray(view).view(dtype).reshape(surfaces)
+	return cube.transpose(0, 3, 1, 2).reshape(-1, shape[1], shape[2])[:shape[0]]
+
+# Channels past the end of the cube are written as zeros
+def pack_cube(cube, out, surf_stride=None):
+	view, surfaces = surface_view(out, cube.shape, cube.dtype, surf_stride)
+	padded = np.zeros((surfaces[0] * surfaces[3],) + cube.shape[1:], dtype=cube.dtype)
+	padded[:cube.shape[0]] = cube
+	view[...] = padded.reshape(surfaces[0], surfaces[3], surfaces[1], surfaces[2]).transpose(0, 2, 3, 1) \
+		.reshape(surfaces[0], -1).view(np.uint8)
+
+# A cube as the bytes it takes in memory
+def cube_bytes(cube, surf_stride=None):
+	out = np.zeros(cube_size(cube.shape, cube.dtype, surf_stride), dtype=np.uint8)
+	pack_cube(cube, out, surf_stride)
+	return out
+
+# Element offset of every weight of a (kernels, height, width, channels)
+# set. Within a group of kernels, each group of channels holds the kernel
+# rows one after the other. The last groups may be short.
+def weight_offsets(shape, dtype):
+	kernels, height, width, channels = shape
+	group = WEIGHT_KERNELS // dtype.itemsize
+	k, y, x, c = np.ix_(*(np.arange(n) for n in shape))
+	k1, k2 = np.divmod(k, group)
+	c1, c2 = np.divmod(c, WEIGHT_CHANNELS)
+	gk = np.minimum(group, kernels - k1 * group)
+	gc = np.minimum(WEIGHT_CHANNELS, channels - c1 * WEIGHT_CHANNELS)
+	return (k1 * group * height * width * channels + c1 * WEIGHT_CHANNELS * height * width * gk +
+		(y * width + x) * gk * gc + k2 * gc + c2)
+
+def weight_bytes(weights):
+	out = np.zeros(weights.size, dtype=weights.dtype)
+	out[weight_offsets(weights.shape, weights.dtype)] = weights
+	return out.view(np.uint8)
+
+# The (channels, out height, out width, kernel height, kernel width) windows
+# a kernel sees, as a view of x
+def conv_windows(x, kernel, out, stride, dilation):
+	s = x.strides
+	return np.lib.stride_tricks.as_strided(
+		x, (x.shape[0],) + out + kernel,
+		(s[0], s[1] * stride[0], s[2] * stride[1], s[1] * dilation[0], s[2] * dilation[1]), writeable=False)
+
+class Memory(object):
+	# Buffers mapped into the NPU address space, sorted by address
+	def __init__(self):
+		self.bases = []
+		self.buffers = []
+
+	# data is a size, bytes or a contiguous array, which is then shared
+	# with the simulator rather than copied
+	def map(self, address, data):
+		if isinstance(data, int):
+			buf = np.zeros(data, dtype=np.uint8)
+		elif isinstance(data, np.ndarray):
+			buf = data.reshape(-1).view(np.uint8)
+		else:
+			buf = np.frombuffer(bytearray(data), dtype=np.uint8)
+
+		i = bisect.bisect(self.bases, address)
+		if (i > 0 and self.bases[i - 1] + len(self.buffers[i - 1]) > address) or \
+		   (i < len(self.bases) and address + len(buf) > self.bases[i]):
+			raise Error("0x%08x+0x%x overlaps a mapped buffer" % (address, len(buf)))
+		self.bases.insert(i, address)
+		self.buffers.insert(i, buf)
+		return buf
+
+	def view(self, address, size):
+		i = bisect.bisect(self.bases, address) - 1
+		if i < 0 or address + size > self.bases[i] + len(self.buffers[i]):
+			raise Error("0x%08x+0x%x isn't mapped" % (address, size))
+		start = address - self.bases[i]
+		return self.buffers[i][start:start + size]
+
+	def read_cube(self, address, shape, dtype, surf_stride=None):
+		return unpack_cube(self.view(address, cube_size(shape, dtype, surf_stride)), shape, dtype, surf_stride)
+
+	def write_cube(self, address, cube, surf_stride=None):
+		pack_cube(cube, self.view(address, cube_size(cube.shape, cube.dtype, surf_stride)), surf_stride)
+
+class Simulator(object):
+	def __init__(self, tables, memory=None):
+		self.tables = tables
+		self.asm = Assembler(tables.index)
+		self.memory = memory if memory is not None else Memory()
+		self.names = [reg.full_name.upper() for reg in tables.regs]
+		# Registers keep their values from one task to the next
+		self.values = {}
+		self.tasks = 0
+		# (task, reason) of the tasks that weren't run
+		self.skipped = []
+
+	def field(self, reg, name):
+		shift, m = self.asm.packer(reg).field(name)
+		return (self.values.get(reg, 0) >> shift) & m
+
+	def fields(self, reg):
+		return self.asm.packer(reg).unpack(self.values.get(reg, 0))
+
+	def run(self, records):
+		reg = lookup_regs(records, self.tables)
+		for r, value in zip(reg.tolist(), records["value"].tolist()):
+			if r < 0:
+				continue
+			name = self.names[r]
+			self.values[name] = value
+			if name == "PC_OPERATION_ENABLE":
+				self.execute(value)
+				self.tasks += 1
+
+	def execute(self, engines):
+		try:
+			if engines & (ENGINE_PPU | ENGINE_PPU_RDMA):
+				raise Unsupported("the PPU isn't simulated")
+			core = None
+			if engines & (ENGINE_CNA | ENGINE_CORE):
+				if not engines & ENGINE_CORE:
+					raise Unsupported("CNA without CORE isn't simulated")
+				if not engines & ENGINE_CNA:
+					raise Unsupported("CORE without CNA isn't simulated")
+				core = self.run_conv()
+			if engines & ENGINE_DPU:
+				self.run_dpu(core)
+		except Unsupported as e:
+			self.skipped.append((self.tasks, e.message))
+		except Error as e:
+			raise Error("task %d: %s" % (self.tasks, e.message))
+
+	def dpu_shape(self):
+		return (self.field("DPU_DATA_CUBE_CHANNEL", "CHANNEL") + 1,
+			self.field("DPU_DATA_CUBE_HEIGHT", "HEIGHT") + 1,
+			self.field("DPU_DATA_CUBE_WIDTH", "WIDTH") + 1)
+
+	def dpu_input(self, shape, core):
+		if not self.field("DPU_FEATURE_MODE_CFG", "FLYING_MODE"):
+			if core is None:
+				raise Error("the DPU input comes from CORE, but the task doesn't start it")
+			if core.shape != shape:
+				raise Error("the CORE cube %s doesn't match the DPU cube %s" % (core.shape, shape))
+			return core
+		mode = self.fields("DPU_RDMA_RDMA_FEATURE_MODE_CFG")
+		if mode["MRDMA_DISABLE"]:
+			raise Error("the DPU reads its input from memory, but MRDMA is disabled")
+		rdma_shape = (self.field("DPU_RDMA_RDMA_DATA_CUBE_CHANNEL", "CHANNEL") + 1,
+			      self.field("DPU_RDMA_RDMA_DATA_CUBE_HEIGHT", "HEIGHT") + 1,
+			      self.field("DPU_RDMA_RDMA_DATA_CUBE_WIDTH", "WIDTH") + 1)
+		if rdma_shape != shape:
+			raise Error("the RDMA cube %s doesn't match the DPU cube %s" % (rdma_shape, shape))
+		return self.memory.read_cube(self.values.get("DPU_RDMA_RDMA_SRC_BASE_ADDR", 0), shape,
+					     precision(mode["IN_PRECISION"]))
+
+	# The CVT_CON converters apply to every fourth channel, first to last
+	def input_cvt(self, x, dtype):
+		cvt = self.fields("CNA_CVT_CON0")
+		if cvt["CVT_BYPASS"]:
+			return x.astype(dtype)
+		if x.dtype == np.int8 and not cvt["DATA_SIGN"]:
+			x = x.view(np.uint8)
+		x = x.astype(np.float32 if dtype.kind == "f" else np.int64)
+		out = np.empty_like(x)
+		for i in range(4):
+			con = self.fields("CNA_CVT_CON%d" % (i + 1))
+			y = (x[i::4] + sign_extend(con["CVT_OFFSET%d" % i], 16)) * sign_extend(con["CVT_SCALE%d" % i], 16)
+			shift = cvt["CVT_TRUNCATE_%d" % i]
+			out[i::4] = y / (1 << shift) if dtype.kind == "f" else shift_right(y, shift)
+		return saturate(out, dtype)
+
+	# The CNA convolution and the CORE truncation, as the cube CORE hands
+	# to the DPU
+	def run_conv(self):
+		con1 = self.fields("CNA_CONV_CON1")
+		if con1["CONV_MODE"] != CONV_DIRECT or con1["DECONV"]:
+			raise Unsupported("convolution mode %d isn't simulated" % con1["CONV_MODE"])
+		dtype = precision(con1["PROC_PRECISION"])
+		is_float = dtype.kind == "f"
+
+		shape = (self.field("CNA_DATA_SIZE1", "DATAIN_CHANNEL"),
+			 self.field("CNA_DATA_SIZE0", "DATAIN_HEIGHT"),
+			 self.field("CNA_DATA_SIZE0", "DATAIN_WIDTH"))
+		x = self.memory.read_cube(self.values.get("CNA_FEATURE_DATA_ADDR", 0), shape,
+					  precision(con1["IN_PRECISION"]))
+		x = self.input_cvt(x, dtype)
+
+		size = self.fields("CNA_WEIGHT_SIZE2")
+		kernel = (size["WEIGHT_HEIGHT"], size["WEIGHT_WIDTH"])
+		wshape = (size["WEIGHT_KERNELS"],) + kernel + (shape[0],)
+		weights = self.memory.view(self.values.get("CNA_DCOMP_ADDR0", 0), int(np.prod(wshape)) * dtype.itemsize)
+		weights = weights.view(dtype)[weight_offsets(wshape, dtype)]
+
+		con3 = self.fields("CNA_CONV_CON3")
+		stride = (con3["CONV_Y_STRIDE"], con3["CONV_X_STRIDE"])
+		dilation = (con3["ATROUS_Y_DILATION"] + 1, con3["ATROUS_X_DILATION"] + 1)
+		out = (self.field("CORE_DATAOUT_SIZE_0", "DATAOUT_HEIGHT") + 1,
+		       self.field("CORE_DATAOUT_SIZE_0", "DATAOUT_WIDTH") + 1)
+		kernels = self.field("CORE_DATAOUT_SIZE_1", "DATAOUT_CHANNEL") + 1
+		if 0 in kernel + stride + shape:
+			raise Error("empty input, kernel or stride")
+		if kernels != wshape[0]:
+			raise Error("CORE makes %d channels out of %d kernels" % (kernels, wshape[0]))
+
+		# Pad up to what the last window reaches, which may also crop
+		pad = self.fields("CNA_PAD_CON0")
+		top, left = pad["PAD_TOP"], pad["PAD_LEFT"]
+		padded = tuple((o - 1) * s + (k - 1) * d + 1 for o, s, k, d in zip(out, stride, kernel, dilation))
+		pad_value = operand(self.field("CNA_PAD_CON1", "PAD_VALUE"), dtype.itemsize * 8 if is_float else 32,
+				    is_float)
+		xp = np.full((shape[0],) + padded, pad_value, dtype=dtype)
+		h, w = min(shape[1], padded[0] - top), min(shape[2], padded[1] - left)
+		xp[:, top:top + h, left:left + w] = x[:, :h, :w]
+
+		# im2col as one matrix product. fp16 accumulates in fp32, and
+		# integer products summed in float64 stay exact below 2^53.
+		acc_type = np.float32 if is_float else np.float64
+		cols = conv_windows(xp, kernel, out, stride, dilation).astype(acc_type)
+		acc = np.tensordot(weights.astype(acc_type), cols, axes=([3, 1, 2], [0, 3, 4]))
+		if is_float:
+			return acc
+
+		# CORE drops CLIP_TRUNCATE bits, rounding or not, and saturates
+		clip = self.fields("CORE_CLIP_TRUNCATE")
+		acc = acc.astype(np.int64)
+		if clip["ROUND_TYPE"]:
+			acc = shift_right(acc, clip["CLIP_TRUNCATE"])
+		else:
+			acc >>= clip["CLIP_TRUNCATE"]
+		return np.clip(acc, -1 << 31, (1 << 31) - 1)
+
+	def run_dpu(self, core=None):
+		fmt = self.fields("DPU_DATA_FORMAT")
+		is_float = precision(fmt["PROC_PRECISION"]).kind == "f"
+		shape = self.dpu_shape()
+		x = self.dpu_input(shape, core)
+		x = x.astype(np.float32 if is_float else np.int64)
+
+		x = self.bs_bn("BS", "BS_BASE_ADDR", x, is_float)
+		x = self.bs_bn("BN", "BN_BASE_ADDR", x, is_float)
+		x = self.ew(x, is_float)
+		x = self.out_cvt(x, is_float, precision(fmt["OUT_PRECISION"]))
+
+		wdma_shape = (self.field("DPU_WDMA_SIZE_0", "CHANNEL_WDMA") + 1,
+			      self.field("DPU_WDMA_SIZE_1", "HEIGHT_WDMA") + 1,
+			      self.field("DPU_WDMA_SIZE_1", "WIDTH_WDMA") + 1)
+		# The WDMA may write more than the cube, such as the rest of the
+		# channels of its last atom, which come out as zeros
+		out = np.zeros(wdma_shape, dtype=x.dtype)
+		c, h, w = (min(a, b) for a, b in zip(wdma_shape, shape))
+		out[:c, :h, :w] = x[:c, :h, :w]
+		self.memory.write_cube(self.values.get("DPU_DST_BASE_ADDR", 0), out,
+				       self.field("DPU_DST_SURF_STRIDE", "DST_SURF_STRIDE") * ATOM_SIZE)
+		return out
+
+	# One operand per channel, from the BS or BN RDMA
+	def channel_operands(self, base, channels, dtype):
+		address = self.values.get("DPU_RDMA_RDMA_" + base, 0)
+		return self.memory.view(address, channels * dtype.itemsize).view(dtype)[:, None, None]
+
+	def relu(self, x, bypass, relux, cmp, is_float):
+		if bypass:
+			return x
+		x = np.maximum(x, 0)
+		if relux:
+			x = np.minimum(x, operand(cmp, 32, is_float))
+		return x
+
+	# The BS and BN stages are the same, with their own registers
+	def bs_bn(self, stage, base, x, is_float):
+		cfg = self.fields("DPU_%s_CFG" % stage)
+		if cfg[stage + "_BYPASS"]:
+			return x
+		channels = x.shape[0]
+
+		if not cfg[stage + "_ALU_BYPASS"]:
+			if cfg[stage + "_ALU_SRC"]:
+				y = self.channel_operands(base, channels, np.dtype(np.float32 if is_float else np.int32))
+			else:
+				y = operand(self.field("DPU_%s_ALU_CFG" % stage, stage + "_ALU_OPERAND"), 32, is_float)
+			x = alu(cfg[stage + "_ALU_ALGO"], x, y)
+
+		if not cfg[stage + "_MUL_BYPASS"]:
+			mul = self.fields("DPU_%s_MUL_CFG" % stage)
+			if mul[stage + "_MUL_SRC"]:
+				if cfg[stage + "_ALU_SRC"] and not cfg[stage + "_ALU_BYPASS"]:
+					raise Unsupported("%s ALU and MUL operands both from memory aren't simulated" % stage)
+				y = self.channel_operands(base, channels, np.dtype(np.float16 if is_float else np.int16))
+			else:
+				y = operand(mul[stage + "_MUL_OPERAND"], 16, is_float)
+			product = x * y
+			if not is_float:
+				product = shift_right(product, mul[stage + "_MUL_SHIFT_VALUE"])
+			# PReLU only scales the negative values
+			x = np.where(x < 0, product, x) if cfg[stage + "_MUL_PRELU"] else product
+
+		return self.relu(x, cfg[stage + "_RELU_BYPASS"], cfg[stage + "_RELUX_EN"],
+				 self.field("DPU_%s_RELUX_CMP_VALUE" % stage, stage + "_RELUX_CMP_DAT"), is_float)
+
+	# The EW operand cube, or one value per channel, from the ERDMA
+	def ew_operand(self, shape, is_float):
+		cfg = self.fields("DPU_RDMA_RDMA_ERDMA_CFG")
+		if cfg["ERDMA_DISABLE"]:
+			raise Error("the EW operand comes from memory, but ERDMA is disabled")
+		size = EW_DATA_SIZES.get(cfg["ERDMA_DATA_SIZE"])
+		if size is None or (is_float and size == 1):
+			raise Unsupported("ERDMA data size %d isn't simulated" % cfg["ERDMA_DATA_SIZE"])
+		dtype = np.dtype("f%d" % size if is_float else "i%d" % size)
+
+		address = self.values.get("DPU_RDMA_RDMA_EW_BASE_ADDR", 0)
+		if cfg["ERDMA_DATA_MODE"] == 0:
+			return self.memory.view(address, shape[0] * size).view(dtype)[:, None, None]
+		if cfg["ERDMA_DATA_MODE"] == 1:
+			stride = self.field("DPU_RDMA_RDMA_EW_SURF_STRIDE", "EW_SURF_STRIDE") * ATOM_SIZE
+			return self.memory.read_cube(address, shape, dtype, stride)
+		raise Unsupported("ERDMA data mode %d isn't simulated" % cfg["ERDMA_DATA_MODE"])
+
+	def ew(self, x, is_float):
+		cfg = self.fields("DPU_EW_CFG")
+		if cfg["EW_BYPASS"]:
+			return x
+
+		if not cfg["EW_OP_BYPASS"]:
+			if cfg["EW_OP_SRC"]:
+				y = self.ew_operand(x.shape, is_float).astype(x.dtype)
+			else:
+				y = operand(self.field("DPU_EW_OP_VALUE_0", "EW_OPERAND_0"), 32, is_float)
+
+			if not cfg["EW_OP_CVT_BYPASS"]:
+				scale = self.fields("DPU_EW_CVT_SCALE_VALUE")
+				y = y + operand(self.field("DPU_EW_CVT_OFFSET_VALUE", "EW_OP_CVT_OFFSET"), 32, is_float)
+				y = y * sign_extend(scale["EW_OP_CVT_SCALE"], 16)
+				y = y / (1 << scale["EW_OP_CVT_SHIFT"]) if is_float else shift_right(y, scale["EW_OP_CVT_SHIFT"])
+
+			if cfg["EW_EQUAL_EN"]:
+				x = (x == y).astype(x.dtype)
+			elif cfg["EW_OP_TYPE"]:
+				product = x * y
+				if not is_float:
+					product = shift_right(product, self.field("DPU_EW_CVT_SCALE_VALUE", "EW_TRUNCATE"))
+				x = np.where(x < 0, product, x) if cfg["EW_MUL_PRELU"] else product
+			else:
+				x = alu(cfg["EW_ALU_ALGO"], x, y)
+
+		if not cfg["EW_LUT_BYPASS"]:
+			raise Unsupported("the LUT isn't simulated")
+		return self.relu(x, cfg["EW_RELU_BYPASS"], cfg["EW_RELUX_EN"],
+				 self.field("DPU_EW_RELUX_CMP_VALUE", "EW_RELUX_CMP_DAT"), is_float)
+
+	# Scale, shift, then add the offset (the output zero point) and
+	# saturate to the output precision
+	def out_cvt(self, x, is_float, dtype):
+		scale = sign_extend(self.field("DPU_OUT_CVT_SCALE", "OUT_CVT_SCALE"), 16)
+		shift = self.field("DPU_OUT_CVT_SHIFT", "OUT_CVT_SHIFT")
+		offset = operand(self.field("DPU_OUT_CVT_OFFSET", "OUT_CVT_OFFSET"), 32, is_float)
+		if is_float:
+			x = x * np.float32(scale) / np.float32(1 << shift) + np.float32(offset)
+		else:
+			x = shift_right(x * scale, shift) + offset
+		return saturate(x, dtype)
+
+def load_program(filename, xml_parser, raw=False, emit=False):
+	if emit:
+		return Assembler.from_parser(xml_parser).parse_emit(open(filename).read()).records()
+	if raw:
+		return Commands.from_file(filename).records()
+	return load_records(filename)
+
+# "ADDRESS=FILE" or "ADDRESS:SIZE=FILE"
+def parse_region(spec):
+	try:
+		region, filename = spec.split("=", 1)
+		address, _, size = region.partition(":")
+		return int(address, 0), int(size, 0) if size else None, filename
+	except ValueError:
+		raise Error("bad region '%s', expected ADDRESS[:SIZE]=FILE" % spec)
+
+# "ADDRESS:SIZE"
+def parse_zero(spec):
+	try:
+		address, size = spec.split(":")
+		return int(address, 0), int(size, 0)
+	except ValueError:
+		raise Error("bad region '%s', expected ADDRESS:SIZE" % spec)
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a register program on the CPU")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--raw', action='store_true',
+			    help='the input is a raw command buffer (gemN-dump) rather than a regdump')
+	parser.add_argument('--emit', action='store_true', help='the input is EMIT(...) text')
+	parser.add_argument('--load', action='append', default=[], metavar='ADDRESS=FILE',
+			    help='map the contents of a file')
+	parser.add_argument('--zero', action='append', default=[], metavar='ADDRESS:SIZE',
+			    help='map zeroed memory')
+	parser.add_argument('--save', action='append', default=[], metavar='ADDRESS:SIZE=FILE',
+			    help='write memory to a file after the run')
+	parser.add_argument('--check', action='append', default=[], metavar='ADDRESS=FILE',
+			    help='compare memory with a reference file after the run')
+	parser.add_argument('input', type=str)
+	args = parser.parse_args()
+
+	try:
+		p = load_parser("", args.xml)
+		records = load_program(args.input, p, args.raw, args.emit)
+		sim = Simulator(FieldTables.from_parser(p))
+		for spec in args.load:
+			address, _, filename = parse_region(spec)
+			sim.memory.map(address, open(filename, "rb").read())
+		for spec in args.zero:
+			sim.memory.map(*parse_zero(spec))
+
+		sim.run(records)
+		for task, message in sim.skipped:
+			print("task %d skipped: %s" % (task, message), file=sys.stderr)
+		print("%d tasks, %d skipped" % (sim.tasks, len(sim.skipped)))
+
+		for spec in args.save:
+			address, size, filename = parse_region(spec)
+			if size is None:
+				raise Error("--save %s needs a size" % spec)
+			sim.memory.view(address, size).tofile(filename)
+
+		failed = 0
+		for spec in args.check:
+			address, size, filename = parse_region(spec)
+			expected = np.fromfile(filename, dtype=np.uint8)[:size]
+			diff = np.flatnonzero(sim.memory.view(address, len(expected)) != expected)
+			if len(diff):
+				print("%s: %d bytes differ, first at 0x%08x" % (filename, len(diff), address + diff[0]))
+				failed += 1
+			else:
+				print("%s: ok" % filename)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+	exit(1 if failed else 0)
+
+if __name__ == '__main__':
+	main()
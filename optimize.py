@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Drops register writes that can't change state: a write of the value the
+# register already holds from its previous write, and DCOMP_AMOUNTn writes
+# no task reads because weight decompression is off. By default the state
+# is only tracked within each task; --across-tasks keeps it from one task
+# to the next, which assumes registers retain their values between tasks.
+
+import sys
+import argparse
+import collections
+import numpy as np
+from gen_parser import load_parser, Error
+from decode import RECORD_SIZE, TASK_END_OFFSETS, FieldTables, load_records, lookup_regs, task_bounds
+from cmdbuf import Commands
+from assemble import Assembler, record_commands
+from reloc import address_fields
+from sparse import read_dump
+from npusim import ENGINE_CNA, ENGINE_CORE, ENGINE_DPU, ENGINE_DPU_RDMA, ENGINE_PPU, ENGINE_PPU_RDMA
+
+# Writes to these have side effects, so they are always kept, as are the
+# PC registers that chain the tasks and any unknown register
+VOLATILE_NAMES = ("OPERATION_ENABLE", "S_POINTER", "INTERRUPT_CLEAR")
+
+# The PC fetches register programs in units of two command words
+FETCH_SIZE = 16
+
+# Tasks start on 64-byte boundaries in the captured command buffers
+TASK_ALIGN = 8
+
+# The engines with a ping-pong pair of register groups, picked by the
+# S_POINTER of their domain, and their OPERATION_ENABLE bit
+PP_ENGINES = (("CNA", ENGINE_CNA), ("CORE", ENGINE_CORE), ("DPU", ENGINE_DPU),
+	      ("DPU_RDMA", ENGINE_DPU_RDMA), ("PPU", ENGINE_PPU), ("PPU_RDMA", ENGINE_PPU_RDMA))
+
+def volatile_regs(tables):
+	return np.array([reg.domain == "PC" or any(n in reg.name.upper() for n in VOLATILE_NAMES)
+			 for reg in tables.regs], dtype=bool)
+
+# Returns the register group, 0 or 1, each record writes. It's the POINTER
+# an S_POINTER write selects, and with POINTER_PP_EN the group flips after
+# every OPERATION_ENABLE that runs the engine. Writes outside those domains
+# are in group 0.
+def pointer_groups(records, reg, tables):
+	asm = Assembler(tables.index)
+	engine = np.full(len(tables.regs) + 1, len(PP_ENGINES), dtype=np.int64)
+	pointers = {}
+	for i, r in enumerate(tables.regs):
+		for e, (domain, _) in enumerate(PP_ENGINES):
+			if r.domain == domain:
+				engine[i] = e
+				if "S_POINTER" in r.name.upper():
+					pointers[i] = e
+	packer = asm.packer("DPU_S_POINTER")
+	pointer, pp_en, pp_clear = (packer.pack({name: 1}) for name in ("POINTER", "POINTER_PP_EN", "POINTER_PP_CLEAR"))
+
+	offsets = records["offset"].view(np.uint16)
+	events = np.flatnonzero(np.isin(reg, list(pointers)) | np.isin(offsets, TASK_END_OFFSETS))
+	values = records["value"].view(np.uint32)
+	engines = engine[reg]
+	state = np.zeros(len(PP_ENGINES) + 1, dtype=np.int64)
+	pp = [False] * len(PP_ENGINES)
+	groups = np.zeros(len(records), dtype=np.int64)
+	start = 0
+	for i in events.tolist():
+		groups[start:i + 1] = state[engines[start:i + 1]]
+		start = i + 1
+		r, v = int(reg[i]), int(values[i])
+		if r in pointers:
+			e = pointers[r]
+			if v & pp_clear:
+				state[e] = 0
+			elif not (pp[e] and v & pp_en):
+				state[e] = v & pointer
+			pp[e] = bool(v & pp_en)
+		else:
+			for e, (_, bit) in enumerate(PP_ENGINES):
+				if pp[e] and v & bit:
+					state[e] ^= 1
+	groups[start:] = state[engines[start:]]
+	return groups
+
+# Returns a mask of the keys that repeat the value of the previous entry
+# with the same key
+def repeats(key, values):
+	# A stable sort groups the entries of each key in program order
+	order = np.argsort(key, kind="stable")
+	k = key[order]
+	v = values[order]
+	dup = np.zeros(len(key), dtype=bool)
+	dup[order[1:]] = (k[1:] == k[:-1]) & (v[1:] == v[:-1])
+	return dup
+
+# Returns a mask of the DCOMP_AMOUNTn writes that no CNA operation reads
+# with decompression on (DECOMP_CONTROL set, WT_DEC_BYPASS clear) before
+# the register is written again, its task ends (unless across_tasks) or the
+# program ends. Decompression counts as on until DCOMP_CTRL is written, and
+# across tasks nothing is dropped if the CNA ping-pongs, as DCOMP_CTRL may
+# then be in the other register group.
+def dead_amounts(records, reg, task, across_tasks, tables):
+	ids = dict((r.full_name.upper(), i) for i, r in enumerate(tables.regs))
+	amounts = [i for name, i in ids.items() if name.startswith("CNA_DCOMP_AMOUNT")]
+	ctrl, cna_pointer = ids["CNA_DCOMP_CTRL"], ids["CNA_S_POINTER"]
+	asm = Assembler(tables.index)
+	packer = asm.packer("CNA_DCOMP_CTRL")
+	pp_en = asm.packer("CNA_S_POINTER").pack({"POINTER_PP_EN": 1})
+	values = records["value"].view(np.uint32)
+	dead = np.zeros(len(records), dtype=bool)
+	if across_tasks and np.any((reg == cna_pointer) & (values & pp_en != 0)):
+		return dead
+
+	offsets = records["offset"].view(np.uint16)
+	enable = np.isin(offsets, TASK_END_OFFSETS)
+	events = np.flatnonzero(np.isin(reg, amounts + [ctrl]) | enable)
+	pending = {}
+	decompress = True
+	current = 0
+	for i in events.tolist():
+		if not across_tasks and task[i] != current:
+			dead[list(pending.values())] = True
+			pending = {}
+			decompress = True
+			current = task[i]
+		r, v = int(reg[i]), int(values[i])
+		if enable[i]:
+			if v & ENGINE_CNA and decompress:
+				pending = {}
+		elif r == ctrl:
+			fields = packer.unpack(v)
+			decompress = fields["DECOMP_CONTROL"] != 0 and not fields["WT_DEC_BYPASS"]
+		else:
+			if r in pending:
+				dead[pending[r]] = True
+			pending[r] = i
+	dead[list(pending.values())] = True
+	return dead
+
+# Returns a mask of the records that are redundant
+def redundant_writes(records, tables, across_tasks=False):
+	reg = lookup_regs(records, tables)
+	values = records["value"]
+	bounds = task_bounds(records)
+	task = np.repeat(np.arange(len(bounds) - 1), np.diff(bounds))
+
+	volatile = volatile_regs(tables)
+	eligible = np.flatnonzero(reg >= 0)
+	eligible = eligible[~volatile[reg[eligible]]]
+
+	key = reg[eligible].astype(np.int64)
+	if not across_tasks:
+		key += task[eligible] * len(tables.regs)
+
+	# With ping-pong on, a write has to repeat the previous write to its
+	# register group. It has to repeat the previous write to the register
+	# in either group too, in case rewriting S_POINTER resets the pointer
+	# rather than leaving it to the hardware.
+	groups = pointer_groups(records, reg, tables)[eligible]
+	v = values[eligible]
+	dup = repeats(key * 2 + groups, v) & repeats(key, v)
+
+	redundant = np.zeros(len(records), dtype=bool)
+	redundant[eligible[dup]] = True
+	redundant |= dead_amounts(records, reg, task, across_tasks, tables)
+	return redundant
+
+def fetches(words):
+	return -(-words // (FETCH_SIZE // RECORD_SIZE))
+
+def report(records, redundant, tables, out):
+	bounds = task_bounds(records)
+	before = np.diff(bounds)
+	dropped = np.add.reduceat(redundant.astype(np.int64), bounds[:-1]) if len(records) else before
+	after = before - dropped
+
+	n = int(redundant.sum())
+	out.write("%d of %d writes are redundant, %d bytes saved (%.1f%%)\n" %
+		  (n, len(records), n * RECORD_SIZE, 100.0 * n / len(records) if len(records) else 0.0))
+	out.write("%d of %d %d-byte fetches saved over %d tasks\n" %
+		  (int(fetches(before).sum() - fetches(after).sum()), int(fetches(before).sum()), FETCH_SIZE,
+		   len(before)))
+
+	reg = lookup_regs(records[redundant], tables)
+	counts = collections.Counter(reg.tolist())
+	for i, count in counts.most_common(10):
+		out.write("  %6d  REG_%s\n" % (count, tables.regs[i].full_name.upper()))
+
+def fetch_amount(words):
+	return fetches(words) - 1
+
+# The tasks of a command buffer and the PC chain between them. Every task
+# starts at the first word after the previous one. addresses[k] and
+# amounts[k] are the values of the last PC_BASE_ADDRESS and
+# PC_REGISTER_AMOUNTS writes of task k, and links[k] their positions in
+# the buffer, or None if task k doesn't write both.
+class Chain(object):
+	def __init__(self, words, tables):
+		commands = Commands(words)
+		last = np.flatnonzero(np.isin(commands.offsets, TASK_END_OFFSETS))
+		self.commands = commands
+		self.ends = commands.positions[last] + 1
+		self.starts = np.zeros(len(self.ends), dtype=np.int64)
+		self.starts[1:] = commands.positions[np.searchsorted(commands.positions, self.ends[:-1])]
+
+		reg = lookup_regs(commands.records(), tables)
+		ids = dict((r.full_name.upper(), i) for i, r in enumerate(tables.regs))
+		masks, _ = address_fields(tables)
+		base_reg, amounts_reg = ids["PC_BASE_ADDRESS"], ids["PC_REGISTER_AMOUNTS"]
+		self.address_mask = int(masks[base_reg])
+
+		task = np.searchsorted(self.ends, commands.positions, side="right")
+		self.links, self.addresses, self.amounts = [], [], []
+		for k in range(len(self.ends) - 1):
+			mine = task == k
+			link = np.flatnonzero(mine & (reg == base_reg))
+			amounts = np.flatnonzero(mine & (reg == amounts_reg))
+			if not len(link) or not len(amounts):
+				self.links.append(None)
+				self.addresses.append(None)
+				self.amounts.append(None)
+				continue
+			link, amounts = link[-1], amounts[-1]
+			self.links.append((commands.positions[link], commands.positions[amounts]))
+			self.addresses.append(int(commands.values[link]) & self.address_mask)
+			self.amounts.append(int(commands.values[amounts]) & 0xffff)
+
+	# The address of word 0 if task k links to task k + 1
+	def base(self, k):
+		return self.addresses[k] - 8 * int(self.starts[k + 1])
+
+	# Whether task k links to task k + 1 where it is in the buffer
+	def linked(self, k, base):
+		return self.links[k] is not None and self.addresses[k] == base + 8 * int(self.starts[k + 1]) and \
+		       self.amounts[k] == fetch_amount(int(self.ends[k + 1] - self.starts[k + 1]))
+
+# Returns the range of words holding the chain of tasks that ends the
+# program: the last task and every task before it that links to the next
+# one where it is in the buffer. The first of them starts after the last
+# word before its end with no target, like the data the captures hold
+# before it.
+def chained_region(words, tables):
+	chain = Chain(words, tables)
+	if not len(chain.ends):
+		raise Error("no OPERATION_ENABLE, the buffer holds no task")
+	first = len(chain.ends) - 1
+	if first > 0 and chain.links[first - 1] is not None:
+		base = chain.base(first - 1)
+		while first > 0 and chain.linked(first - 1, base):
+			first -= 1
+	commands = chain.commands
+	mine = (commands.positions >= chain.starts[first]) & (commands.positions < chain.ends[first])
+	start = np.flatnonzero(mine)[0]
+	unnamed = np.flatnonzero(mine & (commands.words >> np.uint64(48) == 0))
+	if len(unnamed):
+		start = unnamed[-1] + 1
+	return int(commands.positions[start]), int(chain.ends[-1])
+
+# Removes the words at positions drop from a command buffer and relinks
+# its PC chain: the PC_BASE_ADDRESS write of every task but the last points
+# at the next task, and its PC_REGISTER_AMOUNTS write holds the fetches of
+# the next task less one. The chain is checked against the layout of the
+# buffer first, and buffers it doesn't describe are refused. Tasks are
+# packed one after the other, at TASK_ALIGN-aligned addresses. Returns the
+# new words and the new position of every task.
+def relink(words, drop, tables):
+	chain = Chain(words, tables)
+	starts, ends = chain.starts, chain.ends
+	if len(ends) == 0 or chain.commands.positions[-1] >= ends[-1]:
+		if len(ends) > 1:
+			raise Error("words follow the last task (such as a task table), the PC chain can't be relinked")
+		return np.delete(words, drop), np.zeros(1, dtype=np.int64)
+
+	base = None
+	for k in range(len(ends) - 1):
+		if chain.links[k] is None:
+			raise Error("task %d doesn't link to the next one, the PC chain can't be relinked" % k)
+		if base is None:
+			base = chain.base(k)
+		if not chain.linked(k, base):
+			raise Error("the PC chain of task %d doesn't match the layout of the buffer" % k)
+	links = chain.links
+	address_mask = chain.address_mask
+
+	removed = np.zeros(len(words), dtype=bool)
+	removed[drop] = True
+	segments = [np.flatnonzero(~removed[start:end]) + start for start, end in zip(starts, ends)]
+	# Tasks are aligned by their address, word 0 needn't be
+	origin = base // 8 if base is not None else 0
+	new_starts = np.zeros(len(ends), dtype=np.int64)
+	for k in range(1, len(ends)):
+		after = origin + new_starts[k - 1] + len(segments[k - 1])
+		new_starts[k] = -(-after // TASK_ALIGN) * TASK_ALIGN - origin
+
+	out = np.zeros(new_starts[-1] + len(segments[-1]), dtype=np.uint64)
+	patch = words.copy()
+	for k, (link, amounts) in enumerate(links):
+		value = (int(patch[link]) >> 16) & 0xffffffff
+		value = (value & ~address_mask) | (base + 8 * int(new_starts[k + 1]))
+		patch[link] = (patch[link] & ~np.uint64(0xffffffff << 16)) | np.uint64(value << 16)
+		value = (int(patch[amounts]) >> 16) & 0xffff0000 | fetch_amount(len(segments[k + 1]))
+		patch[amounts] = (patch[amounts] & ~np.uint64(0xffffffff << 16)) | np.uint64(value << 16)
+	for start, segment in zip(new_starts, segments):
+		out[start:start + len(segment)] = patch[segment]
+	return out, new_starts
+
+def main():
+	parser = argparse.ArgumentParser(description="Drop redundant register writes from a command stream")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--raw', action='store_true',
+			    help='the input is a raw command buffer (gemN-dump) rather than a regdump')
+	parser.add_argument('--across-tasks', action='store_true',
+			    help='track register state across task boundaries too')
+	parser.add_argument('--regdump', type=str, help='write the optimized regdump here')
+	parser.add_argument('--commands', type=str, help='write the optimized command words here')
+	parser.add_argument('--chain-only', action='store_true',
+			    help='with --raw, only optimize the chained tasks that end the program, leaving the words '
+			    'before and after them (such as a task table) where they are')
+	parser.add_argument('input', type=str)
+	args = parser.parse_args()
+
+	try:
+		p = load_parser("", args.xml)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+	if args.chain_only and not args.raw:
+		print("--chain-only needs a raw command buffer (--raw)", file=sys.stderr)
+		exit(1)
+
+	tables = FieldTables.from_parser(p)
+	if args.raw:
+		words = np.frombuffer(read_dump(args.input), dtype="<u8").astype(np.uint64)
+		first, end = 0, len(words)
+		if args.chain_only:
+			try:
+				first, end = chained_region(words, tables)
+			except Error as e:
+				print(e.message, file=sys.stderr)
+				exit(1)
+			print("chained tasks at words %d to %d" % (first, end))
+		commands = Commands(words[first:end])
+		records = commands.records()
+	else:
+		records = load_records(args.input)
+
+	redundant = redundant_writes(records, tables, args.across_tasks)
+	report(records, redundant, tables, sys.stdout)
+
+	keep = ~redundant
+	if args.regdump:
+		records[keep].tofile(args.regdump)
+	if args.commands:
+		if args.raw:
+			region = words[first:end]
+			drop = commands.positions[redundant]
+		else:
+			region = record_commands(records, tables)
+			drop = np.flatnonzero(redundant)
+		try:
+			out, starts = relink(region, drop, tables)
+		except Error as e:
+			print(e.message, file=sys.stderr)
+			exit(1)
+		if args.raw and args.chain_only:
+			# The tasks only shrink, the rest of the buffer stays in place
+			out = np.concatenate((words[:first], out, np.zeros(end - first - len(out), dtype=np.uint64),
+					      words[end:]))
+			starts += first
+		out.astype("<u8").tofile(args.commands)
+		print("%d command words (was %d), tasks at words %s" %
+		      (len(out), len(words) if args.raw else len(region), " ".join(str(s) for s in starts.tolist())))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Analytical cost model of a command stream. Every task is reduced to what
+# its registers say it moves and computes: the DMA bytes of each engine,
+# rounded up to whole bursts, and the cycles of its busiest engine. The
+# latency of a program is then a fixed submit cost, plus a fixed cost per
+# task, plus a cost per byte and per cycle. The coefficients start from
+# nominal RK3588 figures and can be fitted to measured latencies such as
+# old/benchmark_results.csv.
+
+import sys
+import csv
+import json
+import argparse
+import numpy as np
+from gen_parser import load_parser, Error
+from decode import FieldTables, lookup_regs, TASK_END_OFFSETS
+from assemble import Assembler
+from npusim import load_program, ENGINE_CNA, ENGINE_DPU, ENGINE_DPU_RDMA, ENGINE_PPU, ENGINE_PPU_RDMA
+
+PERF_MODEL_VERSION = 1
+
+# old/matmul/npu_hw.h
+CBUF_BANKS = 12
+CBUF_BANK_SIZE = 32768
+
+# A DMA burst is BURST_LEN + 1 beats of BEAT_SIZE bytes
+BEAT_SIZE = 16
+
+# Feature cubes are stored in 16-byte atoms (see npusim.py)
+ATOM_SIZE = 16
+
+# Bytes per element of every *_PRECISION value, unknown ones as int8
+PRECISION_SIZES = np.array([1, 2, 2, 2, 4, 4, 1, 1], dtype=np.int64)
+
+# CNA MACs per cycle by element size, DPU and PPU atoms per cycle
+MACS_PER_CYCLE = {1: 1024, 2: 512, 4: 256}
+ATOMS_PER_CYCLE = 1
+
+# Registers the model reads
+STATE_REGS = (
+	"PC_OPERATION_ENABLE",
+	"CNA_CONV_CON1", "CNA_DATA_SIZE0", "CNA_DATA_SIZE1", "CNA_WEIGHT_SIZE0", "CNA_WEIGHT_SIZE2",
+	"CNA_CBUF_CON0", "CNA_DMA_CON0",
+	"CORE_DATAOUT_SIZE_0", "CORE_DATAOUT_SIZE_1",
+	"DPU_FEATURE_MODE_CFG", "DPU_DATA_FORMAT",
+	"DPU_DATA_CUBE_WIDTH", "DPU_DATA_CUBE_HEIGHT", "DPU_DATA_CUBE_CHANNEL",
+	"DPU_WDMA_SIZE_0", "DPU_WDMA_SIZE_1", "DPU_BS_CFG", "DPU_BN_CFG", "DPU_EW_CFG",
+	"DPU_RDMA_RDMA_DATA_CUBE_WIDTH", "DPU_RDMA_RDMA_DATA_CUBE_HEIGHT", "DPU_RDMA_RDMA_DATA_CUBE_CHANNEL",
+	"DPU_RDMA_RDMA_FEATURE_MODE_CFG", "DPU_RDMA_RDMA_ERDMA_CFG",
+	"PPU_DATA_CUBE_OUT_WIDTH", "PPU_DATA_CUBE_OUT_HEIGHT", "PPU_DATA_CUBE_OUT_CHANNEL",
+	"PPU_DATA_FORMAT", "PPU_MISC_CTRL",
+	"PPU_RDMA_RDMA_CUBE_IN_WIDTH", "PPU_RDMA_RDMA_CUBE_IN_HEIGHT", "PPU_RDMA_RDMA_CUBE_IN_CHANNEL",
+	"PPU_RDMA_RDMA_DATA_FORMAT",
+)
+
+# DMA streams as (name, engine register holding its BURST_LEN, field)
+STREAMS = (
+	("cna_feature", "CNA_DMA_CON0", "DATA_BURST_LEN"),
+	("cna_weight", "CNA_DMA_CON0", "WEIGHT_BURST_LEN"),
+	("dpu_read", "DPU_RDMA_RDMA_FEATURE_MODE_CFG", "BURST_LEN"),
+	("dpu_write", "DPU_FEATURE_MODE_CFG", "BURST_LEN"),
+	("ppu_read", "PPU_MISC_CTRL", "BURST_LEN"),
+	("ppu_write", "PPU_MISC_CTRL", "BURST_LEN"),
+)
+READ_STREAMS = ("cna_feature", "cna_weight", "dpu_read", "ppu_read")
+WRITE_STREAMS = ("dpu_write", "ppu_write")
+
+# Model coefficients, in ms, and their nominal values: a 1 GHz clock and
+# about 8 GB/s of DRAM bandwidth
+COEFFICIENTS = ("submit", "task", "byte", "cycle")
+NOMINAL = {"submit": 0.05, "task": 0.005, "byte": 1.25e-7, "cycle": 1e-6}
+
+class TaskState(object):
+	# values[i, k]: value of register names[k] when task i starts its
+	# engines. Registers keep their values from one task to the next, and
+	# read as 0 before their first write.
+	def __init__(self, asm, names, values):
+		self.asm = asm
+		self.names = names
+		self.values = values
+
+	def __len__(self):
+		return len(self.values)
+
+	@staticmethod
+	def build(records, tables, asm, names=STATE_REGS):
+		# Tasks end with their OPERATION_ENABLE write. Writes after the last
+		# one don't start anything, so they aren't a task of their own.
+		ends = np.flatnonzero(np.isin(records["offset"].view(np.uint16), TASK_END_OFFSETS)) + 1
+		reg = lookup_regs(records, tables)
+		ids = dict((r.full_name.upper(), i) for i, r in enumerate(tables.regs))
+		values = np.zeros((len(ends), len(names)), dtype=np.int64)
+		for k, name in enumerate(names):
+			pos = np.flatnonzero(reg == ids[name]) if name in ids else np.zeros(0, dtype=np.int64)
+			# The last write before the end of each task
+			last = np.searchsorted(pos, ends) - 1
+			written = last >= 0
+			values[written, k] = records["value"][pos[last[written]]]
+		return TaskState(asm, names, values)
+
+	def value(self, reg):
+		return self.values[:, self.names.index(reg)]
+
+	def field(self, reg, name):
+		shift, m = self.asm.packer(reg).field(name)
+		return (self.value(reg) >> shift) & m
+
+def cube_bytes(channels, height, width, itemsize):
+	return -(-channels // (ATOM_SIZE // itemsize)) * height * width * ATOM_SIZE
+
+def cube_atoms(channels, height, width, itemsize):
+	return cube_bytes(channels, height, width, itemsize) // ATOM_SIZE
+
+# Bytes and cycles of every task, as a dict of arrays
+def task_costs(state):
+	f = state.field
+	n = len(state)
+	# The value of PC_OPERATION_ENABLE is the mask of engines to start
+	engines = state.value("PC_OPERATION_ENABLE")
+	cna = (engines & ENGINE_CNA) != 0
+	dpu = (engines & ENGINE_DPU) != 0
+	dpu_rdma = (engines & ENGINE_DPU_RDMA) != 0
+	ppu = (engines & ENGINE_PPU) != 0
+	ppu_rdma = (engines & ENGINE_PPU_RDMA) != 0
+	costs = {"engines": engines}
+
+	# CNA: the input cube, read again for every pass over weights that
+	# don't fit in their CBUF banks, and the weights
+	in_size = PRECISION_SIZES[f("CNA_CONV_CON1", "IN_PRECISION")]
+	proc_size = PRECISION_SIZES[f("CNA_CONV_CON1", "PROC_PRECISION")]
+	channels = f("CNA_DATA_SIZE1", "DATAIN_CHANNEL")
+	weight_bytes = f("CNA_WEIGHT_SIZE0", "WEIGHT_BYTES")
+	weight_room = np.maximum(f("CNA_CBUF_CON0", "WEIGHT_BANK"), 1) * CBUF_BANK_SIZE
+	passes = np.maximum(-(-weight_bytes // weight_room), 1)
+	feature = cube_bytes(channels, f("CNA_DATA_SIZE0", "DATAIN_HEIGHT"), f("CNA_DATA_SIZE0", "DATAIN_WIDTH"), in_size)
+	costs["cna_feature"] = np.where(cna, feature * passes, 0)
+	costs["cna_weight"] = np.where(cna, weight_bytes, 0)
+	costs["cbuf_passes"] = np.where(cna, passes, 0)
+	costs["cbuf_banks"] = f("CNA_CBUF_CON0", "DATA_BANK") + f("CNA_CBUF_CON0", "WEIGHT_BANK")
+
+	size2 = (f("CNA_WEIGHT_SIZE2", "WEIGHT_KERNELS"), f("CNA_WEIGHT_SIZE2", "WEIGHT_HEIGHT"),
+		 f("CNA_WEIGHT_SIZE2", "WEIGHT_WIDTH"))
+	outputs = (f("CORE_DATAOUT_SIZE_0", "DATAOUT_HEIGHT") + 1) * (f("CORE_DATAOUT_SIZE_0", "DATAOUT_WIDTH") + 1)
+	macs = np.where(cna, size2[0] * size2[1] * size2[2] * channels * outputs, 0)
+	costs["macs"] = macs
+	macs_per_cycle = np.array([MACS_PER_CYCLE.get(s, MACS_PER_CYCLE[1]) for s in range(5)])[proc_size]
+	cna_cycles = -(-macs // macs_per_cycle)
+
+	# DPU: MRDMA input when not fed by CORE, ERDMA and BS/BN operands
+	rdma_size = PRECISION_SIZES[f("DPU_RDMA_RDMA_FEATURE_MODE_CFG", "IN_PRECISION")]
+	rdma_shape = (f("DPU_RDMA_RDMA_DATA_CUBE_CHANNEL", "CHANNEL") + 1,
+		      f("DPU_RDMA_RDMA_DATA_CUBE_HEIGHT", "HEIGHT") + 1,
+		      f("DPU_RDMA_RDMA_DATA_CUBE_WIDTH", "WIDTH") + 1)
+	mrdma = dpu & dpu_rdma & (f("DPU_FEATURE_MODE_CFG", "FLYING_MODE") == 1) & \
+		(f("DPU_RDMA_RDMA_FEATURE_MODE_CFG", "MRDMA_DISABLE") == 0)
+	read = np.where(mrdma, cube_bytes(*rdma_shape, rdma_size), 0)
+
+	ew_size = np.array([1, 2, 4, 4])[f("DPU_RDMA_RDMA_ERDMA_CFG", "ERDMA_DATA_SIZE")]
+	erdma = dpu & dpu_rdma & (f("DPU_EW_CFG", "EW_BYPASS") == 0) & (f("DPU_EW_CFG", "EW_OP_BYPASS") == 0) & \
+		(f("DPU_EW_CFG", "EW_OP_SRC") == 1) & (f("DPU_RDMA_RDMA_ERDMA_CFG", "ERDMA_DISABLE") == 0)
+	per_element = f("DPU_RDMA_RDMA_ERDMA_CFG", "ERDMA_DATA_MODE") == 1
+	read += np.where(erdma, np.where(per_element, cube_bytes(*rdma_shape, ew_size), rdma_shape[0] * ew_size), 0)
+
+	dpu_shape = (f("DPU_DATA_CUBE_CHANNEL", "CHANNEL") + 1, f("DPU_DATA_CUBE_HEIGHT", "HEIGHT") + 1,
+		     f("DPU_DATA_CUBE_WIDTH", "WIDTH") + 1)
+	for stage in ("BS", "BN"):
+		cfg = "DPU_%s_CFG" % stage
+		on = dpu & (f(cfg, stage + "_BYPASS") == 0)
+		alu = on & (f(cfg, stage + "_ALU_BYPASS") == 0) & (f(cfg, stage + "_ALU_SRC") == 1)
+		read += np.where(alu, dpu_shape[0] * 4, 0)
+	costs["dpu_read"] = read
+
+	out_size = PRECISION_SIZES[f("DPU_DATA_FORMAT", "OUT_PRECISION")]
+	costs["dpu_write"] = np.where(dpu, cube_bytes(f("DPU_WDMA_SIZE_0", "CHANNEL_WDMA") + 1,
+						      f("DPU_WDMA_SIZE_1", "HEIGHT_WDMA") + 1,
+						      f("DPU_WDMA_SIZE_1", "WIDTH_WDMA") + 1, out_size), 0)
+	dpu_cycles = np.where(dpu, cube_atoms(*dpu_shape, PRECISION_SIZES[f("DPU_DATA_FORMAT", "PROC_PRECISION")]), 0)
+
+	# PPU
+	ppu_size = PRECISION_SIZES[f("PPU_DATA_FORMAT", "PROC_PRECISION")]
+	ppu_in = (f("PPU_RDMA_RDMA_CUBE_IN_CHANNEL", "CUBE_IN_CHANNEL") + 1,
+		  f("PPU_RDMA_RDMA_CUBE_IN_HEIGHT", "CUBE_IN_HEIGHT") + 1,
+		  f("PPU_RDMA_RDMA_CUBE_IN_WIDTH", "CUBE_IN_WIDTH") + 1)
+	ppu_out = (f("PPU_DATA_CUBE_OUT_CHANNEL", "CUBE_OUT_CHANNEL") + 1,
+		   f("PPU_DATA_CUBE_OUT_HEIGHT", "CUBE_OUT_HEIGHT") + 1,
+		   f("PPU_DATA_CUBE_OUT_WIDTH", "CUBE_OUT_WIDTH") + 1)
+	costs["ppu_read"] = np.where(ppu & ppu_rdma, cube_bytes(*ppu_in, PRECISION_SIZES[
+		f("PPU_RDMA_RDMA_DATA_FORMAT", "IN_PRECISION")]), 0)
+	costs["ppu_write"] = np.where(ppu, cube_bytes(*ppu_out, ppu_size), 0)
+	ppu_cycles = np.where(ppu, cube_atoms(*ppu_in, ppu_size), 0)
+
+	# Operations: a multiply and an add per MAC, one per DPU and PPU element
+	costs["ops"] = 2 * macs + np.where(dpu, dpu_shape[0] * dpu_shape[1] * dpu_shape[2], 0) + \
+		np.where(ppu, ppu_in[0] * ppu_in[1] * ppu_in[2], 0)
+
+	# Bursts are moved whole
+	bursts = np.zeros(n, dtype=np.int64)
+	dma = np.zeros(n, dtype=np.int64)
+	for name, reg, field in STREAMS:
+		burst = (state.field(reg, field) + 1) * BEAT_SIZE
+		count = -(-costs[name] // burst)
+		bursts += count
+		dma += count * burst
+	costs["read_bytes"] = sum(costs[name] for name in READ_STREAMS)
+	costs["write_bytes"] = sum(costs[name] for name in WRITE_STREAMS)
+	costs["bursts"] = bursts
+	costs["dma_bytes"] = dma
+
+	# Engines of a task run as a pipeline, so the busiest one sets the pace
+	costs["cycles"] = np.maximum(np.maximum(cna_cycles, dpu_cycles), ppu_cycles) // ATOMS_PER_CYCLE
+	return costs
+
+# Features of a program, in the order of COEFFICIENTS
+def program_features(costs):
+	return np.array([1.0, len(costs["engines"]), costs["dma_bytes"].sum(), costs["cycles"].sum()])
+
+class Model(object):
+	def __init__(self, coefficients=None):
+		self.coefficients = dict(NOMINAL)
+		self.coefficients.update(coefficients or {})
+
+	def vector(self):
+		return np.array([self.coefficients[name] for name in COEFFICIENTS])
+
+	# Latency of every task in ms, without the submit cost
+	def task_latency(self, costs):
+		c = self.coefficients
+		return c["task"] + c["byte"] * costs["dma_bytes"] + c["cycle"] * costs["cycles"]
+
+	def predict(self, costs):
+		return self.coefficients["submit"] + float(self.task_latency(costs).sum())
+
+	# Least squares on the relative error, pulled towards the nominal
+	# coefficients by weight, which keeps a handful of measurements from
+	# making up the coefficients they can't tell apart. Coefficients stay
+	# non-negative.
+	@staticmethod
+	def fit(features, measured, weight=0.1):
+		features = np.asarray(features, dtype=np.float64)
+		measured = np.asarray(measured, dtype=np.float64)
+		nominal = np.array([NOMINAL[name] for name in COEFFICIENTS])
+		# Solve for the ratio to the nominal coefficients
+		a = features * nominal / measured[:, None]
+		b = np.ones(len(measured))
+		active = np.ones(len(COEFFICIENTS), dtype=bool)
+		while True:
+			k = np.flatnonzero(active)
+			lhs = np.vstack([a[:, k], np.sqrt(weight) * np.eye(len(k))])
+			rhs = np.concatenate([b, np.sqrt(weight) * np.ones(len(k))])
+			ratio = np.zeros(len(COEFFICIENTS))
+			ratio[k] = np.linalg.lstsq(lhs, rhs, rcond=None)[0]
+			if (ratio[k] >= 0).all():
+				break
+			active[k[ratio[k] < 0]] = False
+		return Model(dict(zip(COEFFICIENTS, (ratio * nominal).tolist())))
+
+	def save(self, filename):
+		with open(filename, "w") as f:
+			json.dump({"version": PERF_MODEL_VERSION, "coefficients": self.coefficients}, f, indent=1)
+
+	@staticmethod
+	def load(filename):
+		try:
+			with open(filename) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			raise Error("%s is not a performance model" % filename)
+		if data.get("version") != PERF_MODEL_VERSION:
+			raise Error("%s: unsupported model version %s" % (filename, data.get("version")))
+		return Model(data["coefficients"])
+
+	def report(self, out):
+		for name in COEFFICIENTS:
+			out.write("  %-8s %.4g ms (nominal %.4g)\n" % (name, self.coefficients[name], NOMINAL[name]))
+
+# Measured ms per inference from benchmark_results.csv: 1 / NPU FPS, which
+# has more digits than the latency column
+def load_benchmarks(filename):
+	results = {}
+	with open(filename, newline="") as f:
+		for row in csv.DictReader(f):
+			try:
+				results[row["Operation"]] = 1000.0 / float(row["NPU FPS"])
+			except (KeyError, ValueError, ZeroDivisionError):
+				continue
+	return results
+
+class Costing(object):
+	def __init__(self, xml):
+		self.parser = load_parser("", xml)
+		self.tables = FieldTables.from_parser(self.parser)
+		self.asm = Assembler(self.tables.index)
+
+	def costs(self, filename, raw=False, emit=False):
+		records = load_program(filename, self.parser, raw, emit)
+		return task_costs(TaskState.build(records, self.tables, self.asm))
+
+# "OP=FILE"
+def parse_capture(spec):
+	op, sep, filename = spec.partition("=")
+	if not sep:
+		raise Error("bad capture '%s', expected OPERATION=FILE" % spec)
+	return op, filename
+
+def fit_main(args):
+	costing = Costing(args.xml)
+	benchmarks = load_benchmarks(args.results)
+	names, features, measured = [], [], []
+	for op, filename in (parse_capture(spec) for spec in args.capture):
+		if op not in benchmarks:
+			raise Error("%s has no NPU measurement in %s" % (op, args.results))
+		names.append(op)
+		features.append(program_features(costing.costs(filename, args.raw, args.emit)))
+		measured.append(benchmarks[op])
+	if not names:
+		raise Error("nothing to fit, pass --capture OPERATION=FILE")
+
+	model = Model.fit(features, measured, args.weight)
+	print("coefficients:")
+	model.report(sys.stdout)
+	predicted = np.array(features).dot(model.vector())
+	error = (predicted - np.array(measured)) / np.array(measured)
+	print("%-20s %6s %10s %10s %7s" % ("operation", "tasks", "measured", "predicted", "error"))
+	for i, op in enumerate(names):
+		print("%-20s %6d %8.3fms %8.3fms %+6.1f%%" % (op, features[i][1], measured[i], predicted[i], 100 * error[i]))
+	print("mean absolute error %.1f%%" % (100 * np.abs(error).mean()))
+	if args.save:
+		model.save(args.save)
+
+def predict_main(args):
+	costing = Costing(args.xml)
+	model = Model.load(args.model) if args.model else Model()
+	results = []
+	for filename in args.input:
+		costs = costing.costs(filename, args.raw, args.emit)
+		results.append((model.predict(costs), filename, costs))
+
+	# Fastest first, to rank alternatives
+	results.sort(key=lambda r: r[0])
+	for latency, filename, costs in results:
+		print("%s: %.3f ms, %d tasks, %d bytes read, %d written, %d cycles" %
+		      (filename, latency, len(costs["engines"]), costs["read_bytes"].sum(),
+		       costs["write_bytes"].sum(), costs["cycles"].sum()))
+		if args.tasks:
+			latency = model.task_latency(costs)
+			for i in range(len(latency)):
+				print("  %5d  engines 0x%02x  %10d read %10d written %10d cycles %8.4f ms" %
+				      (i, costs["engines"][i], costs["read_bytes"][i], costs["write_bytes"][i],
+				       costs["cycles"][i], latency[i]))
+
+def main():
+	parser = argparse.ArgumentParser(description="Latency and bandwidth model of command streams")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--raw', action='store_true',
+			    help='inputs are raw command buffers (gemN-dump) rather than regdumps')
+	parser.add_argument('--emit', action='store_true', help='inputs are EMIT(...) text')
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_fit = subparsers.add_parser('fit', help='fit the model to measured latencies')
+	parser_fit.add_argument('--results', type=str, required=True, help='benchmark_results.csv')
+	parser_fit.add_argument('--capture', action='append', default=[], metavar='OPERATION=FILE',
+				help='the command stream of a benchmarked operation')
+	parser_fit.add_argument('--weight', type=float, default=0.1,
+				help='how strongly to keep the coefficients near their nominal values')
+	parser_fit.add_argument('--save', type=str, help='write the fitted model here')
+	parser_fit.set_defaults(func=fit_main)
+
+	parser_predict = subparsers.add_parser('predict', help='estimate and rank the latency of command streams')
+	parser_predict.add_argument('--model', type=str, help='a fitted model, nominal coefficients by default')
+	parser_predict.add_argument('--tasks', action='store_true', help='show every task')
+	parser_predict.add_argument('input', nargs='+')
+	parser_predict.set_defaults(func=predict_main)
+
+	args = parser.parse_args()
+	try:
+		args.func(args)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Structural diff of regdump captures. Tasks are aligned first, then the
+# register writes inside each pair of tasks, and only the fields whose
+# values changed are reported. Any number of captures can be compared
+# against the first one.
+
+import sys
+import os
+import argparse
+import bisect
+import numpy as np
+from gen_parser import load_parser, Error
+from decode import load_records, decode_records, task_bounds, FieldTables
+
+class Capture(object):
+	def __init__(self, filename, tables):
+		self.filename = filename
+		self.records = load_records(filename)
+		self.values = self.records["value"].astype(np.int64)
+		self.reg = decode_records(self.records, tables).reg
+
+		# Writes are matched on (offset, register), so unknown offsets still
+		# line up with each other
+		offsets = self.records["offset"].view(np.uint16).astype(np.int64)
+		self.keys = (offsets << 16) | (self.reg + 1)
+
+		self.bounds = task_bounds(self.records)
+		self.task = np.repeat(np.arange(len(self.bounds) - 1), np.diff(self.bounds))
+		self.signatures = [self.keys[s:e].tobytes() for s, e in zip(self.bounds[:-1], self.bounds[1:])]
+
+	def task_range(self, t0, t1):
+		return np.arange(self.bounds[t0], self.bounds[t1])
+
+# Index pairs of the longest increasing run of js in ps, a list of (i, j)
+# sorted by i
+def increasing_run(ps):
+	tails, tail_pos, prev = [], [], [-1] * len(ps)
+	for n, (i, j) in enumerate(ps):
+		k = bisect.bisect_left(tails, j)
+		if k == len(tails):
+			tails.append(j)
+			tail_pos.append(n)
+		else:
+			tails[k] = j
+			tail_pos[k] = n
+		prev[n] = tail_pos[k - 1] if k else -1
+	run = []
+	n = tail_pos[-1] if tail_pos else -1
+	while n >= 0:
+		run.append(ps[n])
+		n = prev[n]
+	return run[::-1]
+
+# Equal runs (i, j, n) of a[a0:a1] and b[b0:b1], by Myers' O(ND) shortest
+# edit script
+def myers_runs(a, b, a0, a1, b0, b1):
+	n, m = a1 - a0, b1 - b0
+	off = n + m + 1
+	v = [0] * (2 * off + 1)
+	trace = []
+	for d in range(n + m + 1):
+		trace.append(v[off - d:off + d + 1])
+		for k in range(-d, d + 1, 2):
+			if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+				x = v[off + k + 1]
+			else:
+				x = v[off + k - 1] + 1
+			y = x - k
+			while x < n and y < m and a[a0 + x] == b[b0 + y]:
+				x += 1
+				y += 1
+			v[off + k] = x
+			if x >= n and y >= m:
+				return backtrack(trace, x, y, a0, b0)
+	return []
+
+def backtrack(trace, x, y, a0, b0):
+	runs = []
+	for d in range(len(trace) - 1, -1, -1):
+		v = trace[d]
+		k = x - y
+		if d == 0:
+			px = py = 0
+		else:
+			# v holds the furthest x of diagonals -d..d at the start of step d
+			if k == -d or (k != d and v[k - 1 + d] < v[k + 1 + d]):
+				px = v[k + 1 + d]
+				py = px - k - 1
+				sx, sy = px, py + 1
+			else:
+				px = v[k - 1 + d]
+				py = px - k + 1
+				sx, sy = px + 1, py
+			if x > sx:
+				runs.append((a0 + sx, b0 + sy, x - sx))
+			x, y = px, py
+			continue
+		if x > 0:
+			runs.append((a0, b0, x))
+	return runs[::-1]
+
+# Equal runs (i, j, n) of the sequences a and b, in order. Items that occur
+# once in both anchor the alignment (patience diff), so a stream repeating
+# the same tasks can't be aligned a whole period off; what lies between
+# anchors gets a minimal Myers alignment.
+def matching_runs(a, b):
+	runs = []
+	ranges = [(0, len(a), 0, len(b))]
+	while ranges:
+		a0, a1, b0, b1 = ranges.pop()
+		start = 0
+		while a0 + start < a1 and b0 + start < b1 and a[a0 + start] == b[b0 + start]:
+			start += 1
+		end = 0
+		while a1 - end > a0 + start and b1 - end > b0 + start and a[a1 - end - 1] == b[b1 - end - 1]:
+			end += 1
+		if start:
+			runs.append((a0, b0, start))
+		if end:
+			runs.append((a1 - end, b1 - end, end))
+		a0, a1, b0, b1 = a0 + start, a1 - end, b0 + start, b1 - end
+		if a0 == a1 or b0 == b1:
+			continue
+
+		count_a, count_b = {}, {}
+		for i in range(a0, a1):
+			count_a[a[i]] = i if a[i] not in count_a else -1
+		for j in range(b0, b1):
+			count_b[b[j]] = j if b[j] not in count_b else -1
+		anchors = increasing_run(sorted((i, count_b[x]) for x, i in count_a.items()
+						if i >= 0 and count_b.get(x, -1) >= 0))
+		if not anchors:
+			runs.extend(myers_runs(a, b, a0, a1, b0, b1))
+			continue
+		for i, j in anchors:
+			ranges.append((a0, i, b0, j))
+			runs.append((i, j, 1))
+			a0, b0 = i + 1, j + 1
+		ranges.append((a0, a1, b0, b1))
+	return sorted(runs)
+
+# Aligns the writes a.keys[a0:a1] with b.keys[b0:b1]
+def align_writes(a, b, a0, a1, b0, b1, matched, only_a, only_b):
+	i, j = a0, b0
+	for ri, rj, n in matching_runs(a.keys[a0:a1].tolist(), b.keys[b0:b1].tolist()) + [(a1 - a0, b1 - b0, 0)]:
+		only_a.append(np.arange(i, a0 + ri))
+		only_b.append(np.arange(j, b0 + rj))
+		matched.append((np.arange(a0 + ri, a0 + ri + n), np.arange(b0 + rj, b0 + rj + n)))
+		i, j = a0 + ri + n, b0 + rj + n
+
+# Returns (ia, ib, only_a, only_b): index arrays of the writes matched
+# between both captures, and of those present in only one of them.
+def align(a, b):
+	matched, only_a, only_b = [], [], []
+
+	# Identical register sequences are matched a block of tasks at once,
+	# the writes of the tasks in between are aligned one by one
+	ids = {}
+	sig_a = [ids.setdefault(s, len(ids)) for s in a.signatures]
+	sig_b = [ids.setdefault(s, len(ids)) for s in b.signatures]
+	t, u = 0, 0
+	for ta, tb, n in matching_runs(sig_a, sig_b) + [(len(sig_a), len(sig_b), 0)]:
+		if ta > t or tb > u:
+			align_writes(a, b, a.bounds[t], a.bounds[ta], b.bounds[u], b.bounds[tb], matched, only_a, only_b)
+		matched.append((a.task_range(ta, ta + n), b.task_range(tb, tb + n)))
+		t, u = ta + n, tb + n
+
+	def cat(parts):
+		return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+	ia = cat([m[0] for m in matched])
+	ib = cat([m[1] for m in matched])
+	return ia, ib, np.sort(cat(only_a)), np.sort(cat(only_b))
+
+class Diff(object):
+	# rows: indexes into the base capture of the writes that differ in at
+	# least one other capture. values[r, c] is the value written in capture
+	# c, or -1 when that capture has no matching write.
+	def __init__(self, captures, rows, values, extra):
+		self.captures = captures
+		self.rows = rows
+		self.values = values
+		self.extra = extra
+
+def diff_captures(captures):
+	base = captures[0]
+	values = np.full((len(base.records), len(captures)), -1, dtype=np.int64)
+	values[:, 0] = base.values
+	extra = [np.zeros(0, dtype=np.int64)]
+
+	for c, other in enumerate(captures[1:], 1):
+		ia, ib, only_a, only_b = align(base, other)
+		values[ia, c] = other.values[ib]
+		extra.append(only_b)
+
+	rows = np.flatnonzero((values != values[:, :1]).any(axis=1))
+	return Diff(captures, rows, values[rows], extra)
+
+def format_value(v):
+	return "-" if v < 0 else "0x%x" % v
+
+def field_changes(diff, tables):
+	# Decode every capture's value of each differing write against the
+	# base register, and keep the fields that don't agree everywhere.
+	base = diff.captures[0]
+	records = base.records[diff.rows]
+	per_capture = []
+	for c in range(len(diff.captures)):
+		r = records.copy()
+		r["value"] = np.maximum(diff.values[:, c], 0).astype(np.uint32)
+		per_capture.append(decode_records(r, tables))
+
+	d0 = per_capture[0]
+	fields = np.stack([d.field_values for d in per_capture], axis=1).astype(np.int64)
+	missing = np.repeat(diff.values < 0, np.diff(d0.field_ptr), axis=0)
+	fields[missing] = -1
+	changed = (fields != fields[:, :1]).any(axis=1)
+	return d0, fields, changed
+
+def render_diff(diff, tables, out):
+	base = diff.captures[0]
+	pair = len(diff.captures) == 2
+	d0, fields, changed = field_changes(diff, tables)
+
+	if not pair:
+		out.write("# %s\n" % "  ".join(os.path.basename(c.filename) for c in diff.captures))
+
+	ptr = d0.field_ptr.tolist()
+	regs = d0.reg.tolist()
+	for n, row in enumerate(diff.rows.tolist()):
+		task = int(base.task[row])
+		reg = regs[n]
+		if reg >= 0:
+			name = tables.reg_names[reg]
+		else:
+			name = "0x%x" % (int(base.records["offset"][row]) & 0xffff)
+
+		if not pair and (diff.values[n] < 0).any():
+			out.write("task %d %s: %s\n" % (task, name, "  ".join(format_value(v) for v in diff.values[n])))
+			continue
+		if pair and diff.values[n, 1] < 0:
+			out.write("- task %d %s = 0x%x\n" % (task, name, diff.values[n, 0]))
+			continue
+
+		reported = False
+		for j in range(ptr[n], ptr[n + 1]):
+			if not changed[j]:
+				continue
+			label = tables.field_labels[d0.field_ids[j]]
+			if pair:
+				out.write("task %d %s.%s: %d -> %d\n" % (task, name, label, fields[j, 0], fields[j, 1]))
+			else:
+				out.write("task %d %s.%s: %s\n" % (task, name, label, "  ".join(str(v) for v in fields[j])))
+			reported = True
+
+		# Registers we can't split into fields
+		if not reported:
+			if pair:
+				out.write("task %d %s: 0x%x -> 0x%x\n" % (task, name, diff.values[n, 0], diff.values[n, 1]))
+			else:
+				out.write("task %d %s: %s\n" % (task, name, "  ".join(format_value(v) for v in diff.values[n])))
+
+	for c, capture in enumerate(diff.captures[1:], 1):
+		for i in diff.extra[c].tolist():
+			reg = int(capture.reg[i])
+			name = tables.reg_names[reg] if reg >= 0 else "0x%x" % (int(capture.records["offset"][i]) & 0xffff)
+			if pair:
+				out.write("+ task %d %s = 0x%x\n" % (int(capture.task[i]), name, capture.values[i]))
+			else:
+				out.write("+ %s task %d %s = 0x%x\n" % (os.path.basename(capture.filename),
+								 int(capture.task[i]), name, capture.values[i]))
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="decode.py diff",
+					 description="Compare regdump captures field by field")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--no-cache', action='store_true')
+	parser.add_argument('dumps', nargs='+',
+			    help='captures to compare, all against the first one')
+	args = parser.parse_args(argv)
+
+	if len(args.dumps) < 2:
+		parser.error("need at least two captures to compare")
+
+	try:
+		p = load_parser("", args.xml, not args.no_cache)
+	except Error as e:
+		print(e, file=sys.stderr)
+		exit(1)
+
+	tables = FieldTables.from_parser(p)
+	captures = [Capture(f, tables) for f in args.dumps]
+	render_diff(diff_captures(captures), tables, sys.stdout)
+
+if __name__ == '__main__':
+	main()
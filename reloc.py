@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Relocatable command buffers. The fields that registers.xml types as
+# address or waddress are found in a command stream, and the stream becomes
+# an immutable image of command words plus a relocation table saying which
+# buffer, and at which offset into it, each of those fields points to.
+# Binding buffers to new addresses patches a copy of the image, or many
+# copies at once, instead of generating the stream again.
+
+import sys
+import os
+import argparse
+import numpy as np
+from gen_parser import mask, Error
+from decode import lookup_regs
+from cmdbuf import Commands
+from template import stream_words, load_tables, format_table
+
+RELOC_VERSION = 1
+
+# Value bits of a command word
+VALUE_SHIFT = np.uint64(16)
+
+# Mask of the address field of every register, 0 for the others, and
+# whether the NPU writes to what it points to. The extra last entry is for
+# unknown registers.
+def address_fields(tables):
+	masks = np.zeros(len(tables.regs) + 1, dtype=np.uint32)
+	writes = np.zeros(len(tables.regs) + 1, dtype=bool)
+	for i, reg in enumerate(tables.regs):
+		field = reg.bitset.get_address_field()
+		if field is not None:
+			masks[i] = mask(field.low, field.high)
+			writes[i] = field.type == "waddress"
+	return masks, writes
+
+# "NAME=ADDRESS" or "NAME=ADDRESS:SIZE"
+def parse_buffer(spec):
+	try:
+		name, value = spec.split("=", 1)
+		base, _, size = value.partition(":")
+		return name, int(base, 0), int(size, 0) if size else None
+	except ValueError:
+		raise Error("bad buffer '%s', expected NAME=ADDRESS[:SIZE]" % spec)
+
+class Image(object):
+	# words: the command words, never written to
+	# relocation i patches the address field masks[i] of words[positions[i]]
+	# to the address of buffer buffers[i] plus deltas[i]
+	# names, bases, writes: name, original address and whether the NPU
+	# writes to it, for every buffer
+	def __init__(self, words, positions, buffers, deltas, masks, names, bases, writes):
+		self.words = words
+		self.words.flags.writeable = False
+		self.positions = positions
+		self.buffers = buffers
+		self.deltas = deltas
+		self.masks = masks
+		self.names = names
+		self.bases = bases
+		self.writes = writes
+
+	def __len__(self):
+		return len(self.positions)
+
+	# ranges: [(name, address, size)] of known buffers. Addresses outside
+	# all of them get a buffer per register, based at the lowest address
+	# the register holds.
+	@staticmethod
+	def build(words, tables, ranges=()):
+		commands = Commands(words)
+		reg = lookup_regs(commands.records(), tables)
+		field_masks, field_writes = address_fields(tables)
+		# Null addresses, such as the end of the PC chain, stay null
+		addresses = commands.values & field_masks[reg]
+		sel = np.flatnonzero(addresses != 0)
+		reg = reg[sel]
+		masks = field_masks[reg]
+		addresses = addresses[sel]
+
+		names, bases, writes = [], [], []
+		buffers = np.full(len(sel), -1, dtype=np.int64)
+		for name, base, size in ranges:
+			end = base + size if size is not None else 1 << 32
+			inside = (buffers < 0) & (addresses >= base) & (addresses < end)
+			buffers[inside] = len(names)
+			names.append(name)
+			bases.append(base)
+			writes.append(bool(field_writes[reg[inside]].any()))
+
+		for r in np.unique(reg[buffers < 0]).tolist():
+			inside = (buffers < 0) & (reg == r)
+			buffers[inside] = len(names)
+			names.append(tables.regs[r].full_name.upper())
+			bases.append(int(addresses[inside].min()))
+			writes.append(bool(field_writes[r]))
+
+		bases = np.array(bases, dtype=np.int64)
+		deltas = addresses.astype(np.int64) - bases[buffers]
+		return Image(np.array(words, dtype=np.uint64), commands.positions[sel], buffers, deltas,
+			     masks, names, bases, np.array(writes, dtype=bool))
+
+	def buffer(self, name):
+		try:
+			return self.names.index(name)
+		except ValueError:
+			raise Error("no buffer %s, the image has %s" % (name, ", ".join(self.names) or "none"))
+
+	# Addresses of every buffer from a {name: address} dict, the original
+	# ones for the buffers that aren't in it
+	def addresses(self, bind):
+		bases = self.bases.copy()
+		for name, address in bind.items():
+			bases[self.buffer(name)] = address
+		return bases
+
+	def patch(self, bases):
+		fields = bases[..., self.buffers] + self.deltas
+		bad = (fields < 0) | (fields > 0xffffffff) | ((fields & ~self.masks.astype(np.int64)) != 0)
+		if bad.any():
+			i = np.flatnonzero(bad.reshape(-1, len(self)).any(axis=0))[0]
+			raise Error("buffer %s can't be placed there, word %d needs an aligned 32-bit address" %
+				    (self.names[self.buffers[i]], self.positions[i]))
+		keep = ~(self.masks.astype(np.uint64) << VALUE_SHIFT)
+		return (self.words[self.positions] & keep) | (fields.astype(np.uint64) << VALUE_SHIFT)
+
+	# A patched copy of the image, or the image patched into out (such as
+	# the mapped command buffer) without any allocation
+	def bind(self, bind, out=None):
+		if out is None:
+			out = self.words.copy()
+		else:
+			out[:len(self.words)] = self.words
+		out[self.positions] = self.patch(self.addresses(bind))
+		return out
+
+	# bases has one row of buffer addresses per copy, in the order of names
+	def bind_many(self, bases):
+		bases = np.asarray(bases, dtype=np.int64)
+		out = np.repeat(self.words[None, :], len(bases), axis=0)
+		out[:, self.positions] = self.patch(bases)
+		return out
+
+	def save(self, filename):
+		with open(filename, "wb") as f:
+			np.savez_compressed(f, version=RELOC_VERSION, words=self.words, positions=self.positions,
+					    buffers=self.buffers, deltas=self.deltas, masks=self.masks,
+					    names=np.array(self.names, dtype=str), bases=self.bases, writes=self.writes)
+
+	@staticmethod
+	def load(filename):
+		try:
+			with np.load(filename) as f:
+				if int(f["version"]) != RELOC_VERSION:
+					raise Error("%s: unsupported image version %d" % (filename, int(f["version"])))
+				return Image(f["words"], f["positions"], f["buffers"], f["deltas"], f["masks"],
+					     f["names"].tolist(), f["bases"], f["writes"])
+		except (OSError, KeyError, ValueError):
+			raise Error("%s is not a relocatable image" % filename)
+
+	def report(self, out):
+		out.write("%d words, %d relocations to %d buffers\n" % (len(self.words), len(self), len(self.names)))
+		counts = np.bincount(self.buffers, minlength=len(self.names))
+		for i, name in enumerate(self.names):
+			out.write("  %-32s 0x%08x %s %d\n" % (name, self.bases[i], "rw" if self.writes[i] else "r ",
+							  counts[i]))
+
+def emit_c(image, name, source, out):
+	out.write("/* Generated by reloc.py from %s */\n\n" % source)
+	out.write("#include <stdint.h>\n#include <string.h>\n\n")
+	out.write("#define %s_WORDS %d\n" % (name.upper(), len(image.words)))
+	out.write("#define %s_RELOCS %d\n" % (name.upper(), len(image)))
+	out.write("#define %s_BUFFERS %d\n\n" % (name.upper(), len(image.names)))
+	for i, buffer in enumerate(image.names):
+		out.write("#define %s_BUFFER_%s %d\n" % (name.upper(), buffer.upper(), i))
+	out.write("\nstatic const uint64_t %s_image[] = {\n%s\n};\n\n" %
+		  (name, format_table(image.words, 4, "0x%016xull") or "\t0"))
+	tables = [
+		("positions", "uint32_t", image.positions, "%d"),
+		("buffers", "uint16_t", image.buffers, "%d"),
+		("deltas", "uint32_t", image.deltas, "0x%x"),
+		("masks", "uint32_t", image.masks, "0x%08x"),
+	]
+	for table, ctype, values, fmt in tables:
+		out.write("static const %s %s_%s[] = {\n%s\n};\n\n" %
+			  (ctype, name, table, format_table(values, 8, fmt) or "\t0"))
+
+	out.write("/* bases holds the address of every buffer, %s_BUFFER_* */\n" % name.upper())
+	out.write("static inline void %s_bind(uint64_t *instrs, const uint32_t *bases)\n{\n" % name)
+	out.write("\tmemcpy(instrs, %s_image, sizeof(%s_image));\n" % (name, name))
+	out.write("\tfor (unsigned i = 0; i < %s_RELOCS; i++) {\n" % name.upper())
+	out.write("\t\tuint64_t m = (uint64_t)%s_masks[i] << 16;\n" % name)
+	out.write("\t\tuint64_t address = (uint32_t)(bases[%s_buffers[i]] + %s_deltas[i]);\n" % (name, name))
+	out.write("\t\tuint64_t *word = &instrs[%s_positions[i]];\n\n" % name)
+	out.write("\t\t*word = (*word & ~m) | ((address << 16) & m);\n")
+	out.write("\t}\n}\n")
+
+def build_main(args):
+	tables = load_tables(args.xml)
+	ranges = [parse_buffer(spec) for spec in args.buffer]
+	image = Image.build(stream_words(args.input, args.raw, tables), tables, ranges)
+	image.report(sys.stderr)
+
+	if args.save:
+		image.save(args.save)
+	if args.c:
+		name = args.name or os.path.basename(args.input).replace("-", "_").replace(".", "_")
+		with open(args.c, "w") as f:
+			emit_c(image, name, args.input, f)
+
+def bind_main(args):
+	image = Image.load(args.input)
+	bind = dict((name, base) for name, base, _ in (parse_buffer(spec) for spec in args.buffer))
+	image.bind(bind).astype("<u8").tofile(args.commands)
+
+def info_main(args):
+	Image.load(args.input).report(sys.stdout)
+
+def main():
+	parser = argparse.ArgumentParser(description="Relocatable command buffer images")
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_build = subparsers.add_parser('build', help='make an image and its relocations from a command stream')
+	parser_build.add_argument('--xml', type=str, required=True)
+	parser_build.add_argument('--raw', action='store_true',
+				  help='the input is a raw command buffer (gemN-dump) rather than a regdump')
+	parser_build.add_argument('--buffer', action='append', default=[], metavar='NAME=ADDRESS[:SIZE]',
+				  help='a buffer the stream points to, as captured')
+	parser_build.add_argument('--save', type=str, help='write the image here, for bind')
+	parser_build.add_argument('--c', type=str, help='write the image and a bind function as C here')
+	parser_build.add_argument('--name', type=str, help='prefix of the C symbols, from the input by default')
+	parser_build.add_argument('input')
+	parser_build.set_defaults(func=build_main)
+
+	parser_bind = subparsers.add_parser('bind', help='patch new buffer addresses into an image')
+	parser_bind.add_argument('--buffer', action='append', default=[], metavar='NAME=ADDRESS')
+	parser_bind.add_argument('--commands', type=str, required=True, help='write the command words here')
+	parser_bind.add_argument('input')
+	parser_bind.set_defaults(func=bind_main)
+
+	parser_info = subparsers.add_parser('info')
+	parser_info.add_argument('input')
+	parser_info.set_defaults(func=info_main)
+
+	args = parser.parse_args()
+	try:
+		args.func(args)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
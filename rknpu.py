@@ -0,0 +1,435 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# Session with the RKNPU DRM device: one fd, the version/unique queries
+# done once, and an LRU of opened and mapped GEM objects keyed by flink.
+# Buffers of its own can be allocated, synced and submitted to the NPU, as
+# old/matmul does (see rknpu-ioctl.h there). FakeDevice serves the same API
+# from raw dumps on disk.
+
+import os
+import errno
+import fcntl
+import mmap
+import ctypes
+import threading
+from collections import OrderedDict
+from sparse import dump_size, read_dump
+
+_IOC_NONE, _IOC_WRITE, _IOC_READ = 0, 1, 2
+
+def _IOC(d, t, n, s):
+	return (d << 30) | (s << 16) | (ord(t) << 8) | n
+
+def _IOW(t, n, s):
+	return _IOC(_IOC_WRITE, t, n, ctypes.sizeof(s))
+
+def _IOWR(t, n, s):
+	return _IOC(_IOC_READ | _IOC_WRITE, t, n, ctypes.sizeof(s))
+
+DRM_COMMAND_BASE = 0x40
+
+class drm_version(ctypes.Structure):
+	_fields_ = [("version_major", ctypes.c_int), ("version_minor", ctypes.c_int),
+		    ("version_patchlevel", ctypes.c_int),
+		    ("name_len", ctypes.c_size_t), ("name", ctypes.POINTER(ctypes.c_char)),
+		    ("date_len", ctypes.c_size_t), ("date", ctypes.POINTER(ctypes.c_char)),
+		    ("desc_len", ctypes.c_size_t), ("desc", ctypes.POINTER(ctypes.c_char))]
+
+class drm_unique(ctypes.Structure):
+	_fields_ = [("unique_len", ctypes.c_size_t), ("unique", ctypes.POINTER(ctypes.c_char))]
+
+class drm_gem_open(ctypes.Structure):
+	_fields_ = [("name", ctypes.c_uint32), ("handle", ctypes.c_uint32), ("size", ctypes.c_uint64)]
+
+class drm_gem_close(ctypes.Structure):
+	_fields_ = [("handle", ctypes.c_uint32), ("pad", ctypes.c_uint32)]
+
+class rknpu_mem_map(ctypes.Structure):
+	_fields_ = [("handle", ctypes.c_uint32), ("offset", ctypes.c_uint64)]
+
+class rknpu_action(ctypes.Structure):
+	_fields_ = [("flags", ctypes.c_uint32), ("value", ctypes.c_uint32)]
+
+class rknpu_mem_create(ctypes.Structure):
+	_fields_ = [("handle", ctypes.c_uint32), ("flags", ctypes.c_uint32), ("size", ctypes.c_uint64),
+		    ("obj_addr", ctypes.c_uint64), ("dma_addr", ctypes.c_uint64), ("sram_size", ctypes.c_uint64)]
+
+class rknpu_mem_destroy(ctypes.Structure):
+	_fields_ = [("handle", ctypes.c_uint32), ("reserved", ctypes.c_uint32), ("obj_addr", ctypes.c_uint64)]
+
+class rknpu_mem_sync(ctypes.Structure):
+	_fields_ = [("flags", ctypes.c_uint32), ("reserved", ctypes.c_uint32), ("obj_addr", ctypes.c_uint64),
+		    ("offset", ctypes.c_uint64), ("size", ctypes.c_uint64)]
+
+# What the NPU reads for every task of a job, from the task buffer
+class rknpu_task(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [("flags", ctypes.c_uint32), ("op_idx", ctypes.c_uint32), ("enable_mask", ctypes.c_uint32),
+		    ("int_mask", ctypes.c_uint32), ("int_clear", ctypes.c_uint32), ("int_status", ctypes.c_uint32),
+		    ("regcfg_amount", ctypes.c_uint32), ("regcfg_offset", ctypes.c_uint32),
+		    ("regcmd_addr", ctypes.c_uint64)]
+
+class rknpu_subcore_task(ctypes.Structure):
+	_fields_ = [("task_start", ctypes.c_uint32), ("task_number", ctypes.c_uint32)]
+
+class rknpu_submit(ctypes.Structure):
+	_fields_ = [("flags", ctypes.c_uint32), ("timeout", ctypes.c_uint32), ("task_start", ctypes.c_uint32),
+		    ("task_number", ctypes.c_uint32), ("task_counter", ctypes.c_uint32), ("priority", ctypes.c_int32),
+		    ("task_obj_addr", ctypes.c_uint64), ("regcfg_obj_addr", ctypes.c_uint64),
+		    ("task_base_addr", ctypes.c_uint64), ("user_data", ctypes.c_uint64),
+		    ("core_mask", ctypes.c_uint32), ("fence_fd", ctypes.c_int32),
+		    ("subcore_task", rknpu_subcore_task * 5)]
+
+DRM_IOCTL_VERSION = _IOWR('d', 0x00, drm_version)
+DRM_IOCTL_GET_UNIQUE = _IOWR('d', 0x01, drm_unique)
+DRM_IOCTL_GEM_CLOSE = _IOW('d', 0x09, drm_gem_close)
+DRM_IOCTL_GEM_OPEN = _IOWR('d', 0x0b, drm_gem_open)
+DRM_IOCTL_RKNPU_ACTION = _IOWR('d', DRM_COMMAND_BASE + 0x00, rknpu_action)
+DRM_IOCTL_RKNPU_SUBMIT = _IOWR('d', DRM_COMMAND_BASE + 0x01, rknpu_submit)
+DRM_IOCTL_RKNPU_MEM_CREATE = _IOWR('d', DRM_COMMAND_BASE + 0x02, rknpu_mem_create)
+DRM_IOCTL_RKNPU_MEM_MAP = _IOWR('d', DRM_COMMAND_BASE + 0x03, rknpu_mem_map)
+DRM_IOCTL_RKNPU_MEM_DESTROY = _IOWR('d', DRM_COMMAND_BASE + 0x04, rknpu_mem_destroy)
+DRM_IOCTL_RKNPU_MEM_SYNC = _IOWR('d', DRM_COMMAND_BASE + 0x05, rknpu_mem_sync)
+
+# rknpu_mem_create flags
+RKNPU_MEM_CACHEABLE = 1 << 1
+RKNPU_MEM_KERNEL_MAPPING = 1 << 3
+RKNPU_MEM_IOMMU = 1 << 4
+RKNPU_MEM_ZEROING = 1 << 5
+# What old/hello2.c allocates everything with
+RKNPU_MEM_DEFAULT = RKNPU_MEM_IOMMU | RKNPU_MEM_ZEROING | RKNPU_MEM_CACHEABLE
+
+# rknpu_mem_sync flags
+RKNPU_MEM_SYNC_TO_DEVICE = 1 << 0
+RKNPU_MEM_SYNC_FROM_DEVICE = 1 << 1
+
+# rknpu_submit flags
+RKNPU_JOB_PC = 1 << 0
+RKNPU_JOB_BLOCK = 0 << 1
+RKNPU_JOB_PINGPONG = 1 << 2
+
+# rknpu_action flags
+RKNPU_GET_DRV_VERSION = 1
+RKNPU_ACT_RESET = 6
+
+DRM_STRING_LEN = 256
+
+def _string(ptr, length):
+	return ctypes.string_at(ptr, length).decode('utf-8', errors='ignore').rstrip('\x00')
+
+class Gem(object):
+	# An opened GEM object and its CPU mapping. buf is only valid while the
+	# object is in the device's cache.
+	def __init__(self, flink, handle, size, offset, buf):
+		self.flink = flink
+		self.handle = handle
+		self.size = size
+		self.offset = offset
+		self.buf = buf
+
+class Mem(object):
+	# A buffer allocated on the device and its CPU mapping. address is what
+	# the NPU sees, obj_addr what the sync and submit ioctls name it by.
+	def __init__(self, handle, size, obj_addr, address, buf):
+		self.handle = handle
+		self.size = size
+		self.obj_addr = obj_addr
+		self.address = address
+		self.buf = buf
+
+class RknpuDevice(object):
+	def __init__(self, path="/dev/dri/card1", max_gems=8):
+		self.path = path
+		self.max_gems = max_gems
+		self.gems = OrderedDict()
+		self.mems = []
+		self._version = None
+		self._unique = None
+
+		# ioctl arguments are allocated once and refilled for every call
+		self._strings = [(ctypes.c_char * DRM_STRING_LEN)() for _ in range(4)]
+		self._drm_version = drm_version()
+		self._drm_unique = drm_unique()
+		self._gem_open = drm_gem_open()
+		self._gem_close = drm_gem_close()
+		self._mem_map = rknpu_mem_map()
+		self._action = rknpu_action()
+		self._mem_create = rknpu_mem_create()
+		self._mem_destroy = rknpu_mem_destroy()
+		self._mem_sync = rknpu_mem_sync()
+		self._submit = rknpu_submit()
+
+		# Guards the shared ioctl arguments and the cache, so that a session
+		# can be used from several threads
+		self.lock = threading.Lock()
+
+		self.fd = self.open()
+
+	def open(self):
+		return os.open(self.path, os.O_RDWR)
+
+	def ioctl(self, request, arg):
+		fcntl.ioctl(self.fd, request, arg)
+
+	def map(self, size, offset):
+		return mmap.mmap(self.fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE, offset=offset)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	# (name, date, desc) of the DRM driver
+	def version(self):
+		if self._version is None:
+			v = self._drm_version
+			v.version_major = v.version_minor = v.version_patchlevel = 0
+			ptrs = [ctypes.cast(s, ctypes.POINTER(ctypes.c_char)) for s in self._strings[:3]]
+			v.name_len = v.date_len = v.desc_len = DRM_STRING_LEN
+			v.name, v.date, v.desc = ptrs
+			self.ioctl(DRM_IOCTL_VERSION, v)
+			self._version = (_string(v.name, v.name_len), _string(v.date, v.date_len),
+					 _string(v.desc, v.desc_len))
+		return self._version
+
+	def unique(self):
+		if self._unique is None:
+			u = self._drm_unique
+			u.unique_len = DRM_STRING_LEN
+			u.unique = ctypes.cast(self._strings[3], ctypes.POINTER(ctypes.c_char))
+			self.ioctl(DRM_IOCTL_GET_UNIQUE, u)
+			self._unique = _string(u.unique, u.unique_len)
+		return self._unique
+
+	# Opens and maps the GEM object behind a flink name, or returns it from
+	# the cache. The least recently used object is closed when more than
+	# max_gems are open.
+	def gem(self, flink):
+		with self.lock:
+			return self._gem(flink)
+
+	def _gem(self, flink):
+		gem = self.gems.get(flink)
+		if gem is not None:
+			self.gems.move_to_end(flink)
+			return gem
+
+		g = self._gem_open
+		g.name, g.handle, g.size = flink, 0, 0
+		self.ioctl(DRM_IOCTL_GEM_OPEN, g)
+		handle, size = g.handle, g.size
+
+		try:
+			m = self._mem_map
+			m.handle, m.offset = handle, 0
+			self.ioctl(DRM_IOCTL_RKNPU_MEM_MAP, m)
+			buf = self.map(size, m.offset)
+		except:
+			self.close_handle(handle)
+			raise
+
+		gem = Gem(flink, handle, size, m.offset, buf)
+		self.gems[flink] = gem
+		while len(self.gems) > self.max_gems:
+			self._release(next(iter(self.gems)))
+		return gem
+
+	# Size of the GEM object behind a flink name, or None if there is none.
+	# Nothing is mapped or kept open.
+	def probe(self, flink):
+		with self.lock:
+			g = self._gem_open
+			g.name, g.handle, g.size = flink, 0, 0
+			try:
+				self.ioctl(DRM_IOCTL_GEM_OPEN, g)
+			except OSError:
+				return None
+			size = g.size
+			self.close_handle(g.handle)
+			return size
+
+	# Flink names are handed out in order, so live objects are found by
+	# probing upwards until max_misses names in a row don't exist. Returns
+	# [(flink, size)].
+	def discover(self, start=1, max_misses=16):
+		found = []
+		misses = 0
+		flink = start
+		while misses < max_misses:
+			size = self.probe(flink)
+			if size is None:
+				misses += 1
+			else:
+				found.append((flink, size))
+				misses = 0
+			flink += 1
+		return found
+
+	# GET and SET actions return the driver's value
+	def action(self, flags, value=0):
+		with self.lock:
+			a = self._action
+			a.flags, a.value = flags, value
+			self.ioctl(DRM_IOCTL_RKNPU_ACTION, a)
+			return a.value
+
+	def reset(self):
+		self.action(RKNPU_ACT_RESET)
+
+	# A new buffer, mapped and kept until free() or close()
+	def alloc(self, size, flags=RKNPU_MEM_DEFAULT):
+		with self.lock:
+			c = self._mem_create
+			ctypes.memset(ctypes.addressof(c), 0, ctypes.sizeof(c))
+			c.flags, c.size = flags, size
+			self.ioctl(DRM_IOCTL_RKNPU_MEM_CREATE, c)
+			handle, obj_addr, address = c.handle, c.obj_addr, c.dma_addr
+
+			try:
+				m = self._mem_map
+				m.handle, m.offset = handle, 0
+				self.ioctl(DRM_IOCTL_RKNPU_MEM_MAP, m)
+				buf = self.map(size, m.offset)
+			except:
+				self._destroy(handle, obj_addr)
+				raise
+
+			mem = Mem(handle, size, obj_addr, address, buf)
+			self.mems.append(mem)
+			return mem
+
+	def free(self, mem):
+		with self.lock:
+			self._free(mem)
+
+	def _free(self, mem):
+		self.mems.remove(mem)
+		try:
+			mem.buf.close()
+		finally:
+			self._destroy(mem.handle, mem.obj_addr)
+
+	def _destroy(self, handle, obj_addr):
+		d = self._mem_destroy
+		d.handle, d.reserved, d.obj_addr = handle, 0, obj_addr
+		self.ioctl(DRM_IOCTL_RKNPU_MEM_DESTROY, d)
+
+	# flags is RKNPU_MEM_SYNC_TO_DEVICE before the NPU reads a buffer the
+	# CPU wrote, RKNPU_MEM_SYNC_FROM_DEVICE before the CPU reads what the
+	# NPU wrote
+	def sync(self, mem, flags, offset=0, size=None):
+		with self.lock:
+			s = self._mem_sync
+			s.flags, s.reserved, s.obj_addr = flags, 0, mem.obj_addr
+			s.offset, s.size = offset, mem.size - offset if size is None else size
+			self.ioctl(DRM_IOCTL_RKNPU_MEM_SYNC, s)
+
+	# Runs task_number rknpu_task entries of the tasks buffer from
+	# task_start, on core 0, and waits up to timeout ms for the last one.
+	# task_base_addr is the NPU address of the command buffer. The defaults
+	# are those of old/hello2.c, which leaves PINGPONG off.
+	def submit(self, tasks, task_start, task_number, task_base_addr=0, flags=RKNPU_JOB_PC | RKNPU_JOB_BLOCK,
+		   timeout=1000):
+		with self.lock:
+			s = self._submit
+			ctypes.memset(ctypes.addressof(s), 0, ctypes.sizeof(s))
+			s.flags, s.timeout = flags, timeout
+			s.task_start, s.task_number = task_start, task_number
+			s.task_obj_addr = tasks.obj_addr
+			s.task_base_addr = task_base_addr
+			s.core_mask = 1
+			s.fence_fd = -1
+			s.subcore_task[0].task_start, s.subcore_task[0].task_number = task_start, task_number
+			self.ioctl(DRM_IOCTL_RKNPU_SUBMIT, s)
+
+	def close_handle(self, handle):
+		c = self._gem_close
+		c.handle, c.pad = handle, 0
+		self.ioctl(DRM_IOCTL_GEM_CLOSE, c)
+
+	def release(self, flink):
+		with self.lock:
+			self._release(flink)
+
+	def _release(self, flink):
+		gem = self.gems.pop(flink, None)
+		if gem is None:
+			return
+		try:
+			gem.buf.close()
+		finally:
+			self.close_handle(gem.handle)
+
+	def close(self):
+		if self.fd is None:
+			return
+		try:
+			with self.lock:
+				while self.gems:
+					self._release(next(iter(self.gems)))
+				while self.mems:
+					self._free(self.mems[-1])
+		finally:
+			self.close_fd()
+			self.fd = None
+
+	def close_fd(self):
+		os.close(self.fd)
+
+class FakeDevice(RknpuDevice):
+	# Serves flink N from a dump file, raw or sparse, by default
+	# <path>/gem<N>-dump as written by dump.py.
+	def __init__(self, path="dump", max_gems=8, pattern="gem%d-dump"):
+		self.pattern = pattern
+		self.handles = {}
+		self.next_handle = 1
+		RknpuDevice.__init__(self, path, max_gems)
+
+	def open(self):
+		if not os.path.isdir(self.path):
+			raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), self.path)
+		return -1
+
+	def close_fd(self):
+		self.handles.clear()
+
+	def filename(self, flink):
+		return os.path.join(self.path, self.pattern % flink)
+
+	def ioctl(self, request, arg):
+		if request == DRM_IOCTL_VERSION:
+			for field, text in (("name", b"rknpu"), ("date", b"fake"), ("desc", self.path.encode())):
+				n = min(len(text), getattr(arg, field + "_len"))
+				ctypes.memmove(getattr(arg, field), text, n)
+				setattr(arg, field + "_len", n)
+		elif request == DRM_IOCTL_GET_UNIQUE:
+			text = b"fake:" + self.path.encode()
+			n = min(len(text), arg.unique_len)
+			ctypes.memmove(arg.unique, text, n)
+			arg.unique_len = n
+		elif request == DRM_IOCTL_GEM_OPEN:
+			filename = self.filename(arg.name)
+			if not os.path.exists(filename):
+				raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+			arg.handle = self.next_handle
+			arg.size = dump_size(filename)
+			self.handles[arg.handle] = filename
+			self.next_handle += 1
+		elif request == DRM_IOCTL_RKNPU_MEM_MAP:
+			if arg.handle not in self.handles:
+				raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+			arg.offset = arg.handle << 32
+		elif request == DRM_IOCTL_GEM_CLOSE:
+			if self.handles.pop(arg.handle, None) is None:
+				raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+		else:
+			raise OSError(errno.ENOTTY, os.strerror(errno.ENOTTY))
+
+	def map(self, size, offset):
+		# Copied into anonymous memory rather than mapped, so that tools can
+		# rewrite the very dumps they are reading from
+		buf = mmap.mmap(-1, size)
+		buf[:] = read_dump(self.handles[offset >> 32], 0, size)
+		return buf
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Per-task memory traffic and roofline report of a command stream. The
+# bytes every engine reads and writes and the operations it performs come
+# from perf.py; with the byte and cycle costs of a performance model they
+# say whether each task waits on memory or on compute. Tasks are ranked by
+# the time they spend waiting on memory beyond their compute time, which is
+# what re-tiling or re-quantizing them could save.
+
+import sys
+import csv
+import json
+import argparse
+import numpy as np
+from gen_parser import Error
+from perf import Costing, Model
+from npusim import ENGINE_CNA, ENGINE_CORE, ENGINE_DPU, ENGINE_DPU_RDMA, ENGINE_PPU, ENGINE_PPU_RDMA
+
+ENGINES = (("CNA", ENGINE_CNA), ("CORE", ENGINE_CORE), ("DPU", ENGINE_DPU), ("DPU_RDMA", ENGINE_DPU_RDMA),
+	   ("PPU", ENGINE_PPU), ("PPU_RDMA", ENGINE_PPU_RDMA))
+
+# Report columns, in order, and the cost they come from
+TRAFFIC = (
+	("cna_feature_read", "cna_feature"),
+	("cna_weight_read", "cna_weight"),
+	("dpu_read", "dpu_read"),
+	("dpu_write", "dpu_write"),
+	("ppu_read", "ppu_read"),
+	("ppu_write", "ppu_write"),
+)
+COLUMNS = ("rank", "task", "engines") + tuple(name for name, _ in TRAFFIC) + \
+	("read_bytes", "write_bytes", "dma_bytes", "cbuf_passes", "ops", "intensity",
+	 "memory_ms", "compute_ms", "bound", "excess_ms")
+
+def engine_names(mask):
+	return "|".join(name for name, value in ENGINES if value & mask) or "-"
+
+# Tasks none of whose traffic registers are set (no engine enabled, or
+# none of the cubes it moves programmed) are bound by neither, and are
+# ranked after every other task
+NO_TRAFFIC = "none"
+
+# One dict per task, in the order of COLUMNS, ranked by excess memory time
+def roofline(costs, model):
+	c = model.coefficients
+	memory = costs["dma_bytes"] * c["byte"]
+	compute = costs["cycles"] * c["cycle"]
+	excess = np.maximum(memory - compute, 0)
+	bytes_moved = costs["read_bytes"] + costs["write_bytes"]
+	intensity = costs["ops"] / np.maximum(bytes_moved, 1)
+	idle = (costs["dma_bytes"] == 0) & (costs["ops"] == 0)
+
+	order = np.lexsort((np.arange(len(excess)), -memory, -excess, idle))
+	rows = []
+	for rank, i in enumerate(order.tolist()):
+		row = {"rank": rank, "task": i, "engines": engine_names(int(costs["engines"][i]))}
+		for name, cost in TRAFFIC:
+			row[name] = int(costs[cost][i])
+		row.update({
+			"read_bytes": int(costs["read_bytes"][i]),
+			"write_bytes": int(costs["write_bytes"][i]),
+			"dma_bytes": int(costs["dma_bytes"][i]),
+			"cbuf_passes": int(costs["cbuf_passes"][i]),
+			"ops": int(costs["ops"][i]),
+			"intensity": round(float(intensity[i]), 3),
+			"memory_ms": float(memory[i]),
+			"compute_ms": float(compute[i]),
+			"bound": NO_TRAFFIC if idle[i] else "memory" if memory[i] > compute[i] else "compute",
+			"excess_ms": float(excess[i]),
+		})
+		rows.append(row)
+	return rows
+
+def summary(costs, model, rows):
+	c = model.coefficients
+	bytes_moved = int(costs["read_bytes"].sum() + costs["write_bytes"].sum())
+	memory_bound = [row for row in rows if row["bound"] == "memory"]
+	return {
+		"tasks": len(rows),
+		"read_bytes": int(costs["read_bytes"].sum()),
+		"write_bytes": int(costs["write_bytes"].sum()),
+		"ops": int(costs["ops"].sum()),
+		"intensity": round(float(costs["ops"].sum()) / max(bytes_moved, 1), 3),
+		# The memory roof: bytes moved in the time of a cycle
+		"bytes_per_cycle": c["cycle"] / c["byte"] if c["byte"] else None,
+		"memory_bound_tasks": len(memory_bound),
+		"no_traffic_tasks": sum(1 for row in rows if row["bound"] == NO_TRAFFIC),
+		"latency_ms": model.predict(costs),
+		"excess_ms": sum(row["excess_ms"] for row in memory_bound),
+	}
+
+def write_csv(rows, out):
+	writer = csv.DictWriter(out, fieldnames=COLUMNS, lineterminator="\n")
+	writer.writeheader()
+	writer.writerows(rows)
+
+def report(rows, total, out, top):
+	out.write("%d tasks, %d bytes read, %d written, %.3f ops/byte, %d memory bound, %.4f of %.4f ms waiting on memory\n" %
+		  (total["tasks"], total["read_bytes"], total["write_bytes"], total["intensity"],
+		   total["memory_bound_tasks"], total["excess_ms"], total["latency_ms"]))
+	if total["no_traffic_tasks"]:
+		out.write("%d tasks set none of the traffic registers, ranked last with bound %s\n" %
+			  (total["no_traffic_tasks"], NO_TRAFFIC))
+	out.write("%5s %6s %-24s %12s %12s %6s %10s %10s %10s %8s\n" %
+		  ("rank", "task", "engines", "read", "written", "passes", "ops/byte", "memory ms", "excess ms", "bound"))
+	for row in rows[:top]:
+		out.write("%5d %6d %-24s %12d %12d %6d %10.3f %10.4f %10.4f %8s\n" %
+			  (row["rank"], row["task"], row["engines"], row["read_bytes"], row["write_bytes"],
+			   row["cbuf_passes"], row["intensity"], row["memory_ms"], row["excess_ms"], row["bound"]))
+
+def main():
+	parser = argparse.ArgumentParser(description="Memory traffic and roofline report of a command stream")
+	parser.add_argument('--xml', type=str, required=True)
+	parser.add_argument('--raw', action='store_true',
+			    help='the input is a raw command buffer (gemN-dump) rather than a regdump')
+	parser.add_argument('--emit', action='store_true', help='the input is EMIT(...) text')
+	parser.add_argument('--model', type=str, help='a model fitted by perf.py, nominal coefficients by default')
+	parser.add_argument('--csv', type=str, help='write every task here, ranked')
+	parser.add_argument('--json', type=str, help='write the summary and every task here, ranked')
+	parser.add_argument('--top', type=int, default=20, help='how many tasks to show')
+	parser.add_argument('input', type=str)
+	args = parser.parse_args()
+
+	try:
+		model = Model.load(args.model) if args.model else Model()
+		costs = Costing(args.xml).costs(args.input, args.raw, args.emit)
+		rows = roofline(costs, model)
+		total = summary(costs, model, rows)
+		report(rows, total, sys.stdout, args.top)
+
+		if args.csv:
+			with open(args.csv, "w", newline="") as f:
+				write_csv(rows, f)
+		if args.json:
+			with open(args.json, "w") as f:
+				json.dump({"input": args.input, "model": model.coefficients, "summary": total, "tasks": rows},
+					  f, indent=1)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Sparse container for GEM dumps. Pages that are all zeros aren't stored,
+# runs of non-zero pages are stored as-is or compressed with zlib/lzma, and
+# a run table at the front allows reading any range without inflating the
+# whole file. Files without the magic are plain raw dumps, and everything
+# here reads both.
+
+import sys
+import os
+import struct
+import bisect
+import zlib
+import lzma
+import argparse
+from gen_parser import Error
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+SPARSE_MAGIC = b"NPUSPARS"
+SPARSE_VERSION = 1
+SPARSE_PAGE_SIZE = 4096
+
+# Runs of non-zero pages are split at this size, so random access never
+# inflates more than this much data
+SPARSE_MAX_RUN = 1 << 20
+
+# magic, version, codec, page size, buffer size, flink, handle, runs
+HEADER = struct.Struct("<8sHHIQIII")
+# start and length in the buffer, offset and length of the stored data
+RUN = struct.Struct("<QQQQ")
+
+CODECS = {"none": 0, "zlib": 1, "lzma": 2}
+
+def compress(codec, data):
+	if codec == 1:
+		return zlib.compress(data)
+	if codec == 2:
+		return lzma.compress(data)
+	return bytes(data)
+
+def decompress(codec, data):
+	if codec == 1:
+		return zlib.decompress(data)
+	if codec == 2:
+		return lzma.decompress(data)
+	return data
+
+# [(first, end)] page ranges of buf that hold anything but zeros. Reading
+# doesn't need numpy, so without it the pages are compared one by one.
+def live_ranges(buf, size, page_size):
+	if np is None:
+		zero = bytes(page_size)
+		ranges = []
+		with memoryview(buf) as view:
+			for page, start in enumerate(range(0, size, page_size)):
+				end = min(start + page_size, size)
+				if view[start:end] == zero[:end - start]:
+					continue
+				if ranges and ranges[-1][1] == page:
+					ranges[-1][1] = page + 1
+				else:
+					ranges.append([page, page + 1])
+		return ranges
+
+	data = np.frombuffer(buf, dtype=np.uint8, count=size)
+	full = size // page_size
+	live = np.zeros(-(-size // page_size), dtype=bool)
+	live[:full] = data[:full * page_size].reshape(full, page_size).any(axis=1)
+	if full < len(live):
+		live[full] = data[full * page_size:].any()
+	del data
+
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], live, [0])).astype(np.int8)))
+	return list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+# [(start, length)] of the non-zero pages of buf
+def nonzero_runs(buf, size, page_size=SPARSE_PAGE_SIZE):
+	max_pages = max(1, SPARSE_MAX_RUN // page_size)
+	runs = []
+	for first, end in live_ranges(buf, size, page_size):
+		for page in range(first, end, max_pages):
+			start = page * page_size
+			runs.append((start, min(min(page + max_pages, end) * page_size, size) - start))
+	return runs
+
+def write_sparse(filename, buf, size=None, flink=0, handle=0, codec="zlib", page_size=SPARSE_PAGE_SIZE):
+	if size is None:
+		size = len(buf)
+	codec_id = CODECS[codec]
+	with memoryview(buf) as view:
+		runs = [(start, length, compress(codec_id, view[start:start + length]))
+			for start, length in nonzero_runs(buf, size, page_size)]
+
+	with open(filename, "wb") as f:
+		f.write(HEADER.pack(SPARSE_MAGIC, SPARSE_VERSION, codec_id, page_size, size, flink, handle, len(runs)))
+		offset = HEADER.size + RUN.size * len(runs)
+		for start, length, data in runs:
+			f.write(RUN.pack(start, length, offset, len(data)))
+			offset += len(data)
+		for _, _, data in runs:
+			f.write(data)
+
+class SparseDump(object):
+	def __init__(self, filename):
+		self.filename = filename
+		self.f = open(filename, "rb")
+		header = self.f.read(HEADER.size)
+		if len(header) < HEADER.size or not header.startswith(SPARSE_MAGIC):
+			self.f.close()
+			raise Error("%s is not a sparse dump" % filename)
+		(_, version, self.codec, self.page_size, self.size,
+		 self.flink, self.handle, nruns) = HEADER.unpack(header)
+		if version != SPARSE_VERSION:
+			self.f.close()
+			raise Error("%s: unsupported sparse dump version %d" % (filename, version))
+
+		self.runs = list(RUN.iter_unpack(self.f.read(RUN.size * nruns)))
+		self.starts = [run[0] for run in self.runs]
+		self.cached = (None, None)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def __len__(self):
+		return self.size
+
+	def close(self):
+		self.f.close()
+
+	def stored(self):
+		return sum(run[1] for run in self.runs)
+
+	def run_data(self, i):
+		if self.cached[0] != i:
+			_, _, offset, length = self.runs[i]
+			self.f.seek(offset)
+			self.cached = (i, decompress(self.codec, self.f.read(length)))
+		return self.cached[1]
+
+	# Only the runs overlapping [offset, offset + length) are inflated
+	def read(self, offset=0, length=None):
+		if length is None:
+			length = self.size - offset
+		length = max(0, min(length, self.size - offset))
+		out = bytearray(length)
+		end = offset + length
+		i = max(0, bisect.bisect_right(self.starts, offset) - 1)
+		while i < len(self.runs) and self.runs[i][0] < end:
+			start, run_length = self.runs[i][:2]
+			lo, hi = max(start, offset), min(start + run_length, end)
+			if lo < hi:
+				data = self.run_data(i)
+				out[lo - offset:hi - offset] = data[lo - start:hi - start]
+			i += 1
+		return out
+
+def is_sparse(filename):
+	with open(filename, "rb") as f:
+		return f.read(len(SPARSE_MAGIC)) == SPARSE_MAGIC
+
+# Size of the buffer in a dump, sparse or raw
+def dump_size(filename):
+	if is_sparse(filename):
+		with SparseDump(filename) as d:
+			return d.size
+	return os.path.getsize(filename)
+
+def read_dump(filename, offset=0, length=None):
+	if is_sparse(filename):
+		with SparseDump(filename) as d:
+			return d.read(offset, length)
+	with open(filename, "rb") as f:
+		f.seek(offset)
+		return f.read() if length is None else f.read(length)
+
+# codec None writes a plain raw dump
+def write_dump(filename, buf, size=None, codec=None, flink=0, handle=0):
+	if codec is not None:
+		write_sparse(filename, buf, size, flink, handle, codec)
+		return
+	if size is None:
+		size = len(buf)
+	with memoryview(buf) as view, open(filename, "wb") as f:
+		f.write(view[:size])
+
+def pack_main(args):
+	data = read_dump(args.input)
+	write_sparse(args.output or args.input + ".sparse", data, codec=args.codec,
+		     flink=args.flink, handle=args.handle)
+
+def unpack_main(args):
+	write_dump(args.output, read_dump(args.input))
+
+def info_main(args):
+	for filename in args.files:
+		if not is_sparse(filename):
+			print("%s: raw, %d bytes" % (filename, os.path.getsize(filename)))
+			continue
+		with SparseDump(filename) as d:
+			codec = [name for name, value in CODECS.items() if value == d.codec][0]
+			print("%s: flink %d handle %d, %d bytes, %d runs holding %d bytes, %s, %d bytes on disk" %
+			      (filename, d.flink, d.handle, d.size, len(d.runs), d.stored(), codec,
+			       os.path.getsize(filename)))
+
+def main():
+	parser = argparse.ArgumentParser(description="Sparse GEM dump container")
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_pack = subparsers.add_parser('pack', help='convert a dump to the sparse format')
+	parser_pack.add_argument('--codec', choices=CODECS.keys(), default='zlib')
+	parser_pack.add_argument('--flink', type=int, default=0)
+	parser_pack.add_argument('--handle', type=int, default=0)
+	parser_pack.add_argument('input')
+	parser_pack.add_argument('output', nargs='?', help='default <input>.sparse')
+	parser_pack.set_defaults(func=pack_main)
+
+	parser_unpack = subparsers.add_parser('unpack', help='expand a dump to a raw one')
+	parser_unpack.add_argument('input')
+	parser_unpack.add_argument('output')
+	parser_unpack.set_defaults(func=unpack_main)
+
+	parser_info = subparsers.add_parser('info')
+	parser_info.add_argument('files', nargs='+')
+	parser_info.set_defaults(func=info_main)
+
+	args = parser.parse_args()
+	try:
+		args.func(args)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,284 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Direct submission of register programs, without the RKNN runtime. A
+# backend allocates buffers the NPU can address and runs command words on
+# them: NpuBackend through the RKNPU ioctls of rknpu.py, SimBackend on the
+# CPU with npusim.py. run_image() binds a relocatable image (reloc.py) to
+# buffers holding the inputs and outputs and runs it on either.
+
+import sys
+import ctypes
+import argparse
+import numpy as np
+from gen_parser import Error
+from decode import TASK_END_OFFSETS
+from cmdbuf import Commands, TARGET_NAMES
+from npusim import Simulator, Memory, ENGINE_CORE, ENGINE_DPU, ENGINE_PPU
+from reloc import Image
+from template import load_tables
+from rknpu import RknpuDevice, rknpu_task, RKNPU_MEM_DEFAULT, RKNPU_MEM_KERNEL_MAPPING, \
+	RKNPU_MEM_SYNC_TO_DEVICE, RKNPU_MEM_SYNC_FROM_DEVICE
+
+PAGE_SIZE = 4096
+
+# The PC fetches this many words past the register writes of a task
+# (RKNPU_PC_DATA_EXTRA_AMOUNT)
+PC_DATA_EXTRA_AMOUNT = 4
+
+# Interrupts that signal the end of a task, for the last engine it starts
+INT_CNA = 0x0030
+INT_CORE = 0x00c0
+INT_DPU = 0x0300
+INT_PPU = 0x0c00
+INT_CLEAR = 0x1ffff
+
+PC_BASE_ADDRESS = 0x0010
+PC_SLOT = TARGET_NAMES.index("PC")
+
+# Where SimBackend starts handing out addresses
+SIM_BASE = 0x10000000
+
+def page_align(size):
+	return max(-(-size // PAGE_SIZE) * PAGE_SIZE, PAGE_SIZE)
+
+class Tasks(object):
+	# The tasks of a stream of command words. Task i is words[starts[i]:ends[i]],
+	# ending with the write of its engine mask, engines[i].
+	def __init__(self, starts, ends, engines, chained):
+		self.starts = starts
+		self.ends = ends
+		self.engines = engines
+		# The stream links its tasks itself, with PC_BASE_ADDRESS
+		self.chained = chained
+
+	def __len__(self):
+		return len(self.starts)
+
+	@staticmethod
+	def build(words):
+		commands = Commands(np.asarray(words, dtype=np.uint64))
+		last = np.flatnonzero(np.isin(commands.offsets, TASK_END_OFFSETS))
+		ends = commands.positions[last] + 1
+		starts = np.concatenate(([0], ends[:-1]))
+		chained = bool(((commands.offsets == PC_BASE_ADDRESS) & (commands.slots == PC_SLOT) &
+				(commands.values != 0)).any())
+		return Tasks(starts, ends, commands.values[last].astype(np.int64), chained)
+
+	def int_masks(self):
+		masks = np.full(len(self), INT_CNA, dtype=np.int64)
+		for engine, mask in ((ENGINE_CORE, INT_CORE), (ENGINE_DPU, INT_DPU), (ENGINE_PPU, INT_PPU)):
+			masks[(self.engines & engine) != 0] = mask
+		return masks
+
+class Buffer(object):
+	# Memory the NPU addresses at address, with data as a uint8 array the
+	# CPU can read and write
+	def __init__(self, address, data, mem=None):
+		self.address = address
+		self.data = data
+		self.mem = mem
+
+	def __len__(self):
+		return len(self.data)
+
+class NpuBackend(object):
+	def __init__(self, device):
+		self.device = device
+
+	def alloc(self, size, flags=RKNPU_MEM_DEFAULT):
+		mem = self.device.alloc(page_align(size), flags)
+		return Buffer(mem.address, np.frombuffer(mem.buf, dtype=np.uint8), mem)
+
+	def free(self, buffer):
+		mem, buffer.mem, buffer.data = buffer.mem, None, None
+		self.device.free(mem)
+
+	def to_device(self, buffer):
+		self.device.sync(buffer.mem, RKNPU_MEM_SYNC_TO_DEVICE)
+
+	def from_device(self, buffer):
+		self.device.sync(buffer.mem, RKNPU_MEM_SYNC_FROM_DEVICE)
+
+	# Runs the command words in commands, a buffer from alloc(), and waits
+	# for them. A stream that links its tasks runs as one job; the tasks of
+	# one that doesn't are started one after the other.
+	def run(self, commands, count, timeout=1000):
+		tasks = Tasks.build(commands.data[:count * 8].view(np.uint64))
+		if not len(tasks):
+			return 0
+
+		table = self.alloc(len(tasks) * ctypes.sizeof(rknpu_task), RKNPU_MEM_DEFAULT | RKNPU_MEM_KERNEL_MAPPING)
+		try:
+			entries = (rknpu_task * len(tasks)).from_buffer(table.mem.buf)
+			for i, mask in enumerate(tasks.int_masks().tolist()):
+				t = entries[i]
+				t.flags, t.op_idx = 0, i
+				t.enable_mask = int(tasks.engines[i])
+				t.int_mask, t.int_clear, t.int_status = mask, INT_CLEAR, 0
+				t.regcfg_amount = max(int(tasks.ends[i] - tasks.starts[i]) - PC_DATA_EXTRA_AMOUNT, 0)
+				t.regcfg_offset = 0
+				t.regcmd_addr = commands.address + int(tasks.starts[i]) * 8
+			# The mapping can't be closed while ctypes still points into it
+			del entries, t
+			self.to_device(table)
+			self.to_device(commands)
+
+			if tasks.chained:
+				self.device.submit(table.mem, 0, len(tasks), commands.address, timeout=timeout)
+			else:
+				for i in range(len(tasks)):
+					self.device.submit(table.mem, i, 1, commands.address, timeout=timeout)
+		finally:
+			self.free(table)
+		return len(tasks)
+
+	def close(self):
+		self.device.close()
+
+class SimBackend(object):
+	# Addresses are handed out in order from SIM_BASE, page aligned
+	def __init__(self, tables):
+		self.tables = tables
+		self.memory = Memory()
+		self.next_address = SIM_BASE
+		# (task, reason) of the tasks the simulator couldn't run
+		self.skipped = []
+
+	def alloc(self, size, flags=RKNPU_MEM_DEFAULT):
+		size = page_align(size)
+		address = self.next_address
+		self.next_address += size
+		return Buffer(address, self.memory.map(address, size))
+
+	# Freed addresses aren't reused, the buffer just stops being shared
+	def free(self, buffer):
+		buffer.data = None
+
+	def to_device(self, buffer):
+		pass
+
+	def from_device(self, buffer):
+		pass
+
+	def run(self, commands, count, timeout=None):
+		words = commands.data[:count * 8].view(np.uint64)
+		sim = Simulator(self.tables, self.memory)
+		sim.run(Commands(words).records())
+		self.skipped.extend(sim.skipped)
+		return sim.tasks
+
+	def close(self):
+		pass
+
+# The NPU if its device can be opened, the simulator otherwise
+def open_backend(tables, path="/dev/dri/card1", force_sim=False):
+	if not force_sim:
+		try:
+			return NpuBackend(RknpuDevice(path))
+		except OSError:
+			pass
+	if tables is None:
+		raise Error("no NPU at %s, and the simulator needs --xml" % path)
+	return SimBackend(tables)
+
+# Runs image with its buffers bound to new ones. inputs maps buffer names
+# to bytes-like contents, sizes maps names to sizes for the buffers to
+# allocate empty; every other buffer is zeroed and a page larger than what
+# the image reaches into it. A buffer named COMMANDS (reloc.py build
+# --buffer commands=ADDRESS:SIZE) is the command buffer itself, for streams
+# that link their tasks with PC_BASE_ADDRESS. Returns the number of tasks
+# and {name: bytes} of the buffers the NPU writes.
+COMMANDS = "commands"
+
+def run_image(backend, image, inputs={}, sizes={}, timeout=1000):
+	# Without it the links would point into a zeroed buffer of their own,
+	# and the PC would run off into zeros
+	if COMMANDS not in image.names and Tasks.build(image.words).chained:
+		raise Error("the image links its tasks with PC_BASE_ADDRESS, build it with --buffer %s=ADDRESS:SIZE" %
+			    COMMANDS)
+	buffers = {}
+	try:
+		commands = buffers[COMMANDS] = backend.alloc(len(image.words) * 8)
+		for i, name in enumerate(image.names):
+			if name == COMMANDS:
+				continue
+			data = inputs.get(name)
+			size = len(data) if data is not None else sizes.get(name)
+			if size is None:
+				reach = image.deltas[image.buffers == i]
+				size = int(reach.max()) + PAGE_SIZE if len(reach) else PAGE_SIZE
+			buffer = buffers[name] = backend.alloc(size)
+			if data is not None:
+				buffer.data[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+			backend.to_device(buffer)
+
+		image.bind(dict((name, b.address) for name, b in buffers.items() if name in image.names),
+			   commands.data[:len(image.words) * 8].view(np.uint64))
+		tasks = backend.run(commands, len(image.words), timeout)
+
+		outputs = {}
+		for i, name in enumerate(image.names):
+			if image.writes[i] and name != COMMANDS:
+				buffer = buffers[name]
+				backend.from_device(buffer)
+				size = len(inputs[name]) if name in inputs else sizes.get(name, len(buffer))
+				outputs[name] = buffer.data[:size].tobytes()
+		return tasks, outputs
+	finally:
+		for buffer in buffers.values():
+			backend.free(buffer)
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a relocatable image on the NPU, or on the CPU without one")
+	parser.add_argument('--xml', type=str, help='registers.xml, for the simulator')
+	parser.add_argument('--device', type=str, default="/dev/dri/card1")
+	parser.add_argument('--sim', action='store_true', help='use the simulator even if there is an NPU')
+	parser.add_argument('--input', action='append', default=[], metavar='NAME=FILE',
+			    help='initial contents of a buffer of the image')
+	parser.add_argument('--size', action='append', default=[], metavar='NAME=SIZE',
+			    help='size of a buffer, instead of what the image reaches into it')
+	parser.add_argument('--output', action='append', default=[], metavar='NAME=FILE',
+			    help='write a buffer the NPU wrote to a file')
+	parser.add_argument('--timeout', type=int, default=1000, help='ms to wait for every job')
+	parser.add_argument('image', type=str, help='an image from reloc.py build --save')
+	args = parser.parse_args()
+
+	try:
+		image = Image.load(args.image)
+		inputs = {}
+		for spec in args.input:
+			name, _, filename = spec.partition("=")
+			inputs[name] = open(filename, "rb").read()
+		sizes = {}
+		for spec in args.size:
+			name, _, size = spec.partition("=")
+			sizes[name] = int(size, 0)
+		for name in list(inputs) + list(sizes):
+			image.buffer(name)
+
+		backend = open_backend(load_tables(args.xml), args.device, args.sim)
+		try:
+			tasks, outputs = run_image(backend, image, inputs, sizes, args.timeout)
+		finally:
+			backend.close()
+		if isinstance(backend, SimBackend):
+			for task, message in backend.skipped:
+				print("task %d skipped: %s" % (task, message), file=sys.stderr)
+			print("%d tasks on the CPU, %d skipped" % (tasks, len(backend.skipped)))
+		else:
+			print("%d tasks on the NPU" % tasks)
+
+		for spec in args.output:
+			name, _, filename = spec.partition("=")
+			if name not in outputs:
+				raise Error("the NPU doesn't write %s, it writes %s" % (name, ", ".join(outputs) or "nothing"))
+			with open(filename, "wb") as f:
+				f.write(outputs[name])
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,169 @@
+#
+# SPDX-License-Identifier: MIT
+#
+# Task index of a regdump. A command stream is a chain of tasks, each one a
+# register program ending with an OPERATION_ENABLE write and pointing at
+# the next through the PC registers. The index keeps the record range of
+# every task, the engines it programs and the values of a few key
+# registers, and is stored next to the dump so that any task can be
+# decoded without reading what comes before it.
+
+import sys
+import os
+import tempfile
+import numpy as np
+from gen_parser import Error, file_digest
+from decode import RECORD_SIZE, load_records, lookup_regs, task_bounds
+from sparse import read_dump
+
+TASK_INDEX_VERSION = 1
+
+# Chain each task to the next one
+PC_REGS = ("PC_BASE_ADDRESS", "PC_REGISTER_AMOUNTS", "PC_TASK_CON", "PC_TASK_DMA_BASE_ADDR")
+
+# Size of the data each engine works on
+SHAPE_REGS = (
+	"CNA_CONV_CON1", "CNA_DATA_SIZE0", "CNA_DATA_SIZE1", "CNA_WEIGHT_SIZE0", "CNA_WEIGHT_SIZE2",
+	"CORE_DATAOUT_SIZE_0", "CORE_DATAOUT_SIZE_1",
+	"DPU_DATA_CUBE_WIDTH", "DPU_DATA_CUBE_HEIGHT", "DPU_DATA_CUBE_CHANNEL",
+	"PPU_DATA_CUBE_IN_WIDTH", "PPU_DATA_CUBE_IN_HEIGHT", "PPU_DATA_CUBE_IN_CHANNEL",
+	"PPU_DATA_CUBE_OUT_WIDTH", "PPU_DATA_CUBE_OUT_HEIGHT", "PPU_DATA_CUBE_OUT_CHANNEL",
+)
+
+class TaskIndex(object):
+	# bounds: task i spans records[bounds[i]:bounds[i+1]]
+	# engines: OR of the domains of the registers each task writes
+	# values[i, k]: last value task i writes to register names[k], or -1
+	def __init__(self, bounds, engines, names, values):
+		self.bounds = bounds
+		self.engines = engines
+		self.names = names
+		self.values = values
+
+	def __len__(self):
+		return len(self.bounds) - 1
+
+	@staticmethod
+	def build(records, tables):
+		bounds = task_bounds(records)
+		ntasks = len(bounds) - 1
+		reg = lookup_regs(records, tables)
+		values = records["value"].astype(np.int64)
+
+		domains = np.where(reg >= 0, tables.reg_domain[reg], 0).astype(np.uint32)
+		engines = np.zeros(ntasks, dtype=np.uint32)
+		if len(records):
+			engines = np.bitwise_or.reduceat(domains, bounds[:-1])
+
+		ids = dict((reg.full_name.upper(), i) for i, reg in enumerate(tables.regs))
+		names = [name for name in PC_REGS + SHAPE_REGS if name in ids]
+		key_values = np.full((ntasks, len(names)), -1, dtype=np.int64)
+		task = np.repeat(np.arange(ntasks), np.diff(bounds))
+		for k, name in enumerate(names):
+			pos = np.flatnonzero(reg == ids[name])
+			if len(pos) == 0:
+				continue
+			# Keep the last write of each task
+			t = task[pos]
+			last = np.append(t[1:] != t[:-1], True)
+			key_values[t[last], k] = values[pos[last]]
+
+		return TaskIndex(bounds, engines, names, key_values)
+
+	def column(self, name):
+		return self.values[:, self.names.index(name)]
+
+	def save(self, filename, key):
+		path = index_path(filename)
+		try:
+			fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+		except OSError:
+			return
+		try:
+			with os.fdopen(fd, "wb") as f:
+				np.savez_compressed(f, version=TASK_INDEX_VERSION, key=np.array(key),
+						    bounds=self.bounds, engines=self.engines,
+						    names=np.array(self.names, dtype=str), values=self.values)
+			os.chmod(tmp, 0o644)
+			os.replace(tmp, path)
+		except OSError:
+			os.unlink(tmp)
+
+	@staticmethod
+	def load(filename, key):
+		try:
+			with np.load(index_path(filename)) as f:
+				if int(f["version"]) != TASK_INDEX_VERSION or f["key"].tolist() != list(key):
+					return None
+				return TaskIndex(f["bounds"], f["engines"], f["names"].tolist(), f["values"])
+		except (OSError, KeyError, ValueError):
+			return None
+
+def index_path(filename):
+	return os.path.join(os.path.dirname(os.path.abspath(filename)),
+			    os.path.basename(filename) + ".tasks")
+
+# Dumps are big, so they are keyed on size and modification time rather
+# than on their contents. The register database goes by digest.
+def index_key(filename, xml):
+	st = os.stat(filename)
+	return [str(st.st_size), str(st.st_mtime_ns), file_digest(xml)]
+
+def load_task_index(filename, xml, tables, use_cache=True):
+	key = index_key(filename, xml)
+	if use_cache:
+		index = TaskIndex.load(filename, key)
+		if index is not None:
+			return index
+
+	index = TaskIndex.build(load_records(filename, True), tables)
+	if use_cache:
+		index.save(filename, key)
+	return index
+
+# Raw records of tasks [first, last), read straight from their offset
+def read_tasks(filename, index, first, last):
+	start, end = int(index.bounds[first]), int(index.bounds[last])
+	return read_dump(filename, start * RECORD_SIZE, (end - start) * RECORD_SIZE)
+
+def engine_names(domains, mask):
+	return "|".join(name for name, value in sorted(domains.items(), key=lambda d: d[1]) if value & mask) or "-"
+
+def format_index(index, domains, out):
+	for i in range(len(index)):
+		line = "task %d: records %d-%d %s" % (i, index.bounds[i], index.bounds[i + 1] - 1,
+						    engine_names(domains, int(index.engines[i])))
+		regs = ["%s=0x%x" % (name, v) for name, v in zip(index.names, index.values[i].tolist()) if v >= 0]
+		if regs:
+			line += " " + " ".join(regs)
+		out.write(line + "\n")
+
+# "N" for a single task, "N:M" for tasks N to M-1, "N:" up to the last
+def parse_task_range(spec, ntasks):
+	try:
+		if ":" in spec:
+			first, last = spec.split(":", 1)
+			first = int(first) if first else 0
+			last = int(last) if last else ntasks
+		else:
+			first = int(spec)
+			last = first + 1
+	except ValueError:
+		raise Error("bad task range '%s'" % spec)
+	if first < 0:
+		first += ntasks
+	if last < 0:
+		last += ntasks
+	if not 0 <= first < last <= ntasks:
+		raise Error("no tasks %s, the dump has %d" % (spec, ntasks))
+	return first, last
+
+# decode.py --tasks / --task: prints the index and returns None, or returns
+# the raw records of the selected tasks for decoding
+def tasks_main(args, tables):
+	index = load_task_index(args.dump, args.xml, tables, not args.no_cache)
+	if args.tasks:
+		format_index(index, tables.index.domains, sys.stdout)
+		return None
+	first, last = parse_task_range(args.task, len(index))
+	return read_tasks(args.dump, index, first, last)
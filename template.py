@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Factors a command stream into register templates plus per-task deltas.
+# Tasks that write the same registers in the same order share a template
+# holding the most common value of each write, and each task only keeps
+# the writes whose value differs from it. The stream can be expanded back
+# word for word, and the tables can be emitted as C or Python in place of
+# long instrs[nInstrs++] = INSTR(...) sequences.
+
+import sys
+import os
+import argparse
+import numpy as np
+from gen_parser import load_parser, Error
+from decode import TASK_END_OFFSETS, FieldTables, load_records
+from cmdbuf import Commands, load_words
+from assemble import record_commands
+from sparse import read_dump
+
+TEMPLATE_VERSION = 1
+
+# A command word without its value: target in bits 48..63, offset in 0..15
+KEY_MASK = np.uint64(0xffff00000000ffff)
+
+def word_bounds(words):
+	offsets = (words & np.uint64(0xffff)).astype(np.uint16)
+	ends = np.flatnonzero(np.isin(offsets, TASK_END_OFFSETS) & (words != 0)) + 1
+	return np.unique(np.concatenate(([0], ends, [len(words)])))
+
+# Most common value of every column of values, the smallest one on ties
+def column_modes(values):
+	rows = len(values)
+	s = np.sort(values, axis=0)
+	new = np.ones(s.shape, dtype=bool)
+	new[1:] = s[1:] != s[:-1]
+	index = np.arange(rows)[:, None]
+	start = np.maximum.accumulate(np.where(new, index, 0), axis=0)
+	best = np.argmax(index - start, axis=0)
+	return s[best, np.arange(s.shape[1])]
+
+def narrowest(values, types=("uint8", "uint16", "uint32", "uint64")):
+	top = int(values.max()) if len(values) else 0
+	for t in types:
+		if top <= np.iinfo(t).max:
+			return t
+
+class Templates(object):
+	# Template i covers keys[starts[i]:starts[i+1]] and values alike. Task t
+	# uses template task_templates[t] and overrides the values at
+	# delta_positions[delta_starts[t]:delta_starts[t+1]]. nwords counts the
+	# trailing zero words that aren't in any task. regdump is set when the
+	# words came one per record of a regdump, zero records included.
+	def __init__(self, starts, keys, values, task_templates, delta_starts, delta_positions, delta_values, nwords,
+		     regdump=False):
+		self.starts = starts
+		self.keys = keys
+		self.values = values
+		self.task_templates = task_templates
+		self.delta_starts = delta_starts
+		self.delta_positions = delta_positions
+		self.delta_values = delta_values
+		self.nwords = nwords
+		self.regdump = regdump
+
+	def __len__(self):
+		return len(self.starts) - 1
+
+	@staticmethod
+	def build(words, regdump=False):
+		nwords = len(words)
+		words = words[:np.flatnonzero(words)[-1] + 1] if words.any() else words[:0]
+		bounds = word_bounds(words)
+		ntasks = len(bounds) - 1
+		keys = words & KEY_MASK
+		values = ((words >> np.uint64(16)) & np.uint64(0xffffffff)).astype(np.uint32)
+
+		groups = {}
+		for t in range(ntasks):
+			groups.setdefault(keys[bounds[t]:bounds[t + 1]].tobytes(), []).append(t)
+
+		starts = [0]
+		tmpl_keys, tmpl_values = [], []
+		task_templates = np.zeros(ntasks, dtype=np.int64)
+		delta_tasks, delta_positions, delta_values = [], [], []
+		for i, tasks in enumerate(groups.values()):
+			tasks = np.array(tasks)
+			first = bounds[tasks[0]]
+			length = bounds[tasks[0] + 1] - first
+			task_templates[tasks] = i
+
+			v = values[bounds[tasks][:, None] + np.arange(length)]
+			base = column_modes(v)
+			rows, cols = np.nonzero(v != base)
+			delta_tasks.append(tasks[rows])
+			delta_positions.append(cols)
+			delta_values.append(v[rows, cols])
+
+			tmpl_keys.append(keys[first:first + length])
+			tmpl_values.append(base)
+			starts.append(starts[-1] + length)
+
+		delta_tasks = np.concatenate(delta_tasks or [np.zeros(0, dtype=np.int64)])
+		delta_positions = np.concatenate(delta_positions or [np.zeros(0, dtype=np.int64)])
+		delta_values = np.concatenate(delta_values or [np.zeros(0, dtype=np.uint32)])
+		order = np.lexsort((delta_positions, delta_tasks))
+		delta_starts = np.searchsorted(delta_tasks[order], np.arange(ntasks + 1))
+
+		return Templates(np.array(starts, dtype=np.int64),
+				 np.concatenate(tmpl_keys or [np.zeros(0, dtype=np.uint64)]),
+				 np.concatenate(tmpl_values or [np.zeros(0, dtype=np.uint32)]),
+				 task_templates, delta_starts, delta_positions[order], delta_values[order], nwords, regdump)
+
+	def expand(self):
+		lengths = np.diff(self.starts)[self.task_templates]
+		task_starts = np.concatenate(([0], np.cumsum(lengths)))
+		# Position of every output word in the template tables
+		src = np.arange(task_starts[-1]) - np.repeat(task_starts[:-1] - self.starts[self.task_templates], lengths)
+		values = self.values[src]
+		delta_tasks = np.repeat(np.arange(len(self.task_templates)), np.diff(self.delta_starts))
+		values[task_starts[delta_tasks] + self.delta_positions] = self.delta_values
+
+		words = np.zeros(self.nwords, dtype=np.uint64)
+		words[:len(src)] = self.keys[src] | (values.astype(np.uint64) << np.uint64(16))
+		return words
+
+	# The tables with the narrowest types that hold them, as emitted
+	def tables(self):
+		return [
+			("template_starts", self.starts.astype(narrowest(self.starts))),
+			("targets", (self.keys >> np.uint64(48)).astype(np.uint16)),
+			("offsets", (self.keys & np.uint64(0xffff)).astype(np.uint16)),
+			("values", self.values),
+			("task_templates", self.task_templates.astype(narrowest(self.task_templates))),
+			("delta_starts", self.delta_starts.astype(narrowest(self.delta_starts))),
+			("delta_positions", self.delta_positions.astype(narrowest(self.delta_positions))),
+			("delta_values", self.delta_values),
+		]
+
+	def table_size(self):
+		return sum(a.nbytes for _, a in self.tables())
+
+	def save(self, filename):
+		with open(filename, "wb") as f:
+			np.savez_compressed(f, version=TEMPLATE_VERSION, nwords=self.nwords, starts=self.starts,
+					    keys=self.keys, values=self.values, task_templates=self.task_templates,
+					    delta_starts=self.delta_starts, delta_positions=self.delta_positions,
+					    delta_values=self.delta_values, regdump=self.regdump)
+
+	@staticmethod
+	def load(filename):
+		try:
+			with np.load(filename) as f:
+				if int(f["version"]) != TEMPLATE_VERSION:
+					raise Error("%s: unsupported template version %d" % (filename, int(f["version"])))
+				return Templates(f["starts"], f["keys"], f["values"], f["task_templates"], f["delta_starts"],
+						 f["delta_positions"], f["delta_values"], int(f["nwords"]),
+						 "regdump" in f.files and bool(f["regdump"]))
+		except (OSError, KeyError, ValueError):
+			raise Error("%s is not a template file" % filename)
+
+	def report(self, out):
+		raw = self.nwords * 8
+		out.write("%d words in %d tasks, %d templates of %d words, %d deltas\n" %
+			  (self.nwords, len(self.task_templates), len(self), len(self.keys), len(self.delta_values)))
+		out.write("%d bytes of tables for %d bytes of commands (%.1fx)\n" %
+			  (self.table_size(), raw, raw / max(1, self.table_size())))
+
+def format_table(values, per_line, fmt):
+	values = values.tolist()
+	return ",\n".join("\t" + ", ".join(fmt % v for v in values[i:i + per_line])
+			  for i in range(0, len(values), per_line))
+
+def emit_c(templates, name, source, out):
+	out.write("/* Generated by template.py from %s */\n\n" % source)
+	out.write("#include <stdint.h>\n\n")
+	out.write("#ifndef INSTR\n")
+	out.write("#define INSTR(target, value, offset) \\\n")
+	out.write("\t(((uint64_t)(target) << 48) | ((uint64_t)(uint32_t)(value) << 16) | (uint16_t)(offset))\n")
+	out.write("#endif\n\n")
+	out.write("#define %s_WORDS %d\n" % (name.upper(), templates.nwords))
+	out.write("#define %s_TASKS %d\n\n" % (name.upper(), len(templates.task_templates)))
+	for table, values in templates.tables():
+		ctype = "%s_t" % values.dtype.name
+		fmt = "0x%08x" if values.dtype == np.uint32 else "0x%x" if table in ("targets", "offsets") else "%d"
+		out.write("static const %s %s_%s[] = {\n%s\n};\n\n" %
+			  (ctype, name, table, format_table(values, 8, fmt) or "\t0"))
+
+	out.write("/* instrs must hold %s_WORDS words, returns the number written */\n" % name.upper())
+	out.write("static inline unsigned %s_expand(uint64_t *instrs)\n{\n" % name)
+	out.write("\tunsigned n = 0;\n\n")
+	out.write("\tfor (unsigned t = 0; t < %s_TASKS; t++) {\n" % name.upper())
+	out.write("\t\tunsigned base = %s_template_starts[%s_task_templates[t]];\n" % (name, name))
+	out.write("\t\tunsigned end = %s_template_starts[%s_task_templates[t] + 1];\n" % (name, name))
+	out.write("\t\tunsigned first = n;\n\n")
+	out.write("\t\tfor (unsigned i = base; i < end; i++)\n")
+	out.write("\t\t\tinstrs[n++] = INSTR(%s_targets[i], %s_values[i], %s_offsets[i]);\n" % (name, name, name))
+	out.write("\t\tfor (unsigned i = %s_delta_starts[t]; i < %s_delta_starts[t + 1]; i++) {\n" % (name, name))
+	out.write("\t\t\tunsigned k = base + %s_delta_positions[i];\n" % name)
+	out.write("\t\t\tinstrs[first + %s_delta_positions[i]] = INSTR(%s_targets[k], %s_delta_values[i], %s_offsets[k]);\n" %
+		  (name, name, name, name))
+	out.write("\t\t}\n\t}\n")
+	out.write("\twhile (n < %s_WORDS)\n\t\tinstrs[n++] = 0;\n" % name.upper())
+	out.write("\treturn n;\n}\n")
+
+def emit_py(templates, name, source, out):
+	out.write("# Generated by template.py from %s\n\n" % source)
+	out.write("WORDS = %d\n\n" % templates.nwords)
+	for table, values in templates.tables():
+		fmt = "0x%08x" if values.dtype == np.uint32 else "0x%x" if table in ("targets", "offsets") else "%d"
+		out.write("%s = (\n%s\n)\n\n" % (table.upper(), format_table(values, 8, fmt) + "," if len(values) else ""))
+
+	out.write("def expand():\n")
+	out.write("\twords = []\n")
+	out.write("\tfor t, tmpl in enumerate(TASK_TEMPLATES):\n")
+	out.write("\t\tbase, end = TEMPLATE_STARTS[tmpl], TEMPLATE_STARTS[tmpl + 1]\n")
+	out.write("\t\tvalues = list(VALUES[base:end])\n")
+	out.write("\t\tfor i in range(DELTA_STARTS[t], DELTA_STARTS[t + 1]):\n")
+	out.write("\t\t\tvalues[DELTA_POSITIONS[i]] = DELTA_VALUES[i]\n")
+	out.write("\t\twords.extend((TARGETS[base + i] << 48) | (v << 16) | OFFSETS[base + i] for i, v in enumerate(values))\n")
+	out.write("\treturn words + [0] * (WORDS - len(words))\n")
+
+# Command words of a raw command buffer, or of a regdump given the tables
+def stream_words(filename, raw, tables=None):
+	if raw:
+		return load_words(read_dump(filename)).copy()
+	if tables is None:
+		raise Error("--xml is needed to turn regdump records into command words")
+	return record_commands(load_records(filename), tables)
+
+def load_tables(xml):
+	return FieldTables.from_parser(load_parser("", xml)) if xml else None
+
+def build_main(args):
+	templates = Templates.build(stream_words(args.input, args.raw, load_tables(args.xml)), not args.raw)
+	templates.report(sys.stderr)
+
+	name = args.name or os.path.basename(args.input).replace("-", "_").replace(".", "_")
+	if args.save:
+		templates.save(args.save)
+	if args.c:
+		with open(args.c, "w") as f:
+			emit_c(templates, name, args.input, f)
+	if args.py:
+		with open(args.py, "w") as f:
+			emit_py(templates, name, args.input, f)
+
+def expand_main(args):
+	templates = Templates.load(args.input)
+	words = templates.expand()
+	if args.commands:
+		words.astype("<u8").tofile(args.commands)
+	if args.regdump:
+		# A regdump gets all its records back, the words of records that
+		# only carry bits of the target the records don't keep are zero
+		Commands(words, templates.regdump).write_regdump(args.regdump)
+	if not args.commands and not args.regdump:
+		for word in words.tolist():
+			print("0x%016x" % word)
+
+def info_main(args):
+	Templates.load(args.input).report(sys.stdout)
+
+def main():
+	parser = argparse.ArgumentParser(description="Factor command streams into templates and deltas")
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_build = subparsers.add_parser('build', help='extract the templates of a command stream')
+	parser_build.add_argument('--xml', type=str, help='register database, needed for regdumps')
+	parser_build.add_argument('--raw', action='store_true',
+				  help='the input is a raw command buffer (gemN-dump) rather than a regdump')
+	parser_build.add_argument('--save', type=str, help='write the templates here, for expand')
+	parser_build.add_argument('--c', type=str, help='write C tables and an expand function here')
+	parser_build.add_argument('--py', type=str, help='write Python tables and an expand function here')
+	parser_build.add_argument('--name', type=str, help='prefix of the C symbols, from the input by default')
+	parser_build.add_argument('input')
+	parser_build.set_defaults(func=build_main)
+
+	parser_expand = subparsers.add_parser('expand', help='regenerate the command stream')
+	parser_expand.add_argument('--commands', type=str, help='write 64-bit command words here')
+	parser_expand.add_argument('--regdump', type=str, help='write regdump records here')
+	parser_expand.add_argument('input')
+	parser_expand.set_defaults(func=expand_main)
+
+	parser_info = subparsers.add_parser('info')
+	parser_info.add_argument('input')
+	parser_info.set_defaults(func=info_main)
+
+	args = parser.parse_args()
+	try:
+		args.func(args)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()
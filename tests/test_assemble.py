@@ -0,0 +1,55 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import sys
+import subprocess
+import numpy as np
+import pytest
+from gen_parser import load_parser
+from decode import FieldTables, load_records
+from cmdbuf import Commands
+from sparse import read_dump
+from assemble import Assembler, record_commands, CMD_OP_40, CMD_OP_ENABLE
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="module")
+def tables():
+	return FieldTables.from_parser(load_parser("", os.path.join(ROOT, "registers.xml")))
+
+# Raw command buffer -> regdump -> command words gives back every word,
+# the OP_40/OP_ENABLE pairs and the task table included
+@pytest.mark.parametrize("dump", ["dump/gem2-dump", "old/dump/gem2-dump"])
+def test_regdump_round_trip(tables, tmp_path, dump):
+	words = np.frombuffer(read_dump(os.path.join(ROOT, dump)), dtype="<u8").astype(np.uint64)
+	commands = Commands(words)
+	regdump = str(tmp_path / "regdump.bin")
+	commands.write_regdump(regdump)
+
+	out = np.zeros_like(words)
+	out[commands.positions] = record_commands(load_records(regdump), tables)
+	assert out.tobytes() == words.tobytes()
+
+def test_packer_pc_targets(tables):
+	asm = Assembler(tables.index)
+	assert asm.packer("PC_VERSION").cmd_target == CMD_OP_40
+	assert asm.packer("PC_OPERATION_ENABLE").cmd_target == CMD_OP_ENABLE
+	assert asm.packer("PC_BASE_ADDRESS").cmd_target == 0x0101
+	assert asm.packer("CNA_CONV_CON1").cmd_target == 0x0201
+
+# Packer and the generated packers come from the same field layout
+def test_packer_matches_generated(tables):
+	out = subprocess.run([sys.executable, "gen_parser.py", "--xml", "registers.xml", "py-pack"],
+			     cwd=ROOT, check=True, capture_output=True, text=True).stdout
+	namespace = {}
+	exec(compile(out, "npu_regs.py", "exec"), namespace)
+	asm = Assembler(tables.index)
+	for (domain, offset), cls in namespace["REGS"].items():
+		packer = asm.packer(cls.__name__)
+		assert (packer.reg.domain, packer.offset) == (domain, offset)
+		# The top and bottom bit of every field
+		fields = dict((name, (1 << (m.bit_length() - 1)) | 1) for name, _, m in packer.layout)
+		value = packer.pack(fields)
+		assert cls(**dict((name.lower(), v) for name, v in fields.items())).pack() == value
+		unpacked = cls.unpack(value)
+		assert dict((name, getattr(unpacked, name.lower())) for name in fields) == packer.unpack(value)
@@ -0,0 +1,20 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import sys
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DUMPS = ["dump/gem2_regdump.bin", "old/dump/gem4_regdump.bin"]
+
+def decode(*args):
+	return subprocess.run([sys.executable, "decode.py", "--xml", "registers.xml"] + list(args),
+			      cwd=ROOT, capture_output=True, check=True).stdout
+
+@pytest.mark.parametrize("dump", DUMPS)
+@pytest.mark.parametrize("batch", [[], ["--batch"]])
+def test_stream_mmap(dump, batch):
+	mapped = decode("--dump", dump, "--stream", "--mmap", *batch)
+	assert mapped
+	assert mapped == decode("--dump", dump, "--stream", *batch)
@@ -0,0 +1,196 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import numpy as np
+import pytest
+from gen_parser import load_parser
+from decode import FieldTables
+from assemble import Assembler
+from npusim import Simulator, load_program, ENGINE_CNA, ENGINE_CORE, ENGINE_DPU, ENGINE_DPU_RDMA
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Where the test programs keep their buffers
+SRC = 0x100000
+EW = 0x200000
+WEIGHTS = 0x300000
+DST = 0x400000
+
+@pytest.fixture(scope="module")
+def tables():
+	return FieldTables.from_parser(load_parser("", os.path.join(ROOT, "registers.xml")))
+
+def run(tables, program, buffers):
+	sim = Simulator(tables)
+	for address, data in buffers.items():
+		sim.memory.map(address, data)
+	sim.run(Assembler(tables.index).assemble(program).records())
+	assert sim.tasks == 1 and not sim.skipped
+	return sim
+
+# Loop references: feature cubes are surfaces of 16 bytes per pixel, each
+# holding the next 16 // itemsize channels
+def pack(cube, dtype):
+	channels, height, width = len(cube), len(cube[0]), len(cube[0][0])
+	per = 16 // np.dtype(dtype).itemsize
+	surfaces = -(-channels // per)
+	out = np.zeros(surfaces * height * width * per, dtype=dtype)
+	for c in range(channels):
+		for y in range(height):
+			for x in range(width):
+				out[((c // per) * height + y) * width * per + x * per + c % per] = cube[c][y][x]
+	return out
+
+def unpack(data, dtype, shape):
+	channels, height, width = shape
+	per = 16 // np.dtype(dtype).itemsize
+	data = data.view(dtype)
+	return [[[int(data[((c // per) * height + y) * width * per + x * per + c % per])
+		  for x in range(width)] for y in range(height)] for c in range(channels)]
+
+# Shift right, rounding half up
+def rshift(v, shift):
+	return (v + (1 << shift >> 1)) >> shift
+
+def clamp(v, bits):
+	return max(-(1 << bits - 1), min((1 << bits - 1) - 1, v))
+
+def random_cube(rng, shape):
+	return rng.integers(-128, 128, size=shape).tolist()
+
+def dpu_cube(shape):
+	c, h, w = shape
+	return [
+		("DPU_DATA_CUBE_CHANNEL", {"CHANNEL": c - 1}),
+		("DPU_DATA_CUBE_HEIGHT", {"HEIGHT": h - 1}),
+		("DPU_DATA_CUBE_WIDTH", {"WIDTH": w - 1}),
+		("DPU_WDMA_SIZE_0", {"CHANNEL_WDMA": c - 1}),
+		("DPU_WDMA_SIZE_1", {"HEIGHT_WDMA": h - 1, "WIDTH_WDMA": w - 1}),
+		("DPU_DST_BASE_ADDR", DST),
+	]
+
+def out_cvt(scale, shift, offset):
+	return [
+		("DPU_OUT_CVT_SCALE", {"OUT_CVT_SCALE": scale & 0xffff}),
+		("DPU_OUT_CVT_SHIFT", {"OUT_CVT_SHIFT": shift}),
+		("DPU_OUT_CVT_OFFSET", offset & 0xffffffff),
+	]
+
+# int8 cube from memory through BS (ALU add of a constant, RELU), BN
+# (multiply and shift), EW (add or multiply an int8 cube) and OUT_CVT
+@pytest.mark.parametrize("ew_mul", [False, True])
+def test_dpu_int8(tables, ew_mul):
+	rng = np.random.default_rng(1)
+	shape = (20, 3, 5)
+	a = random_cube(rng, shape)
+	b = random_cube(rng, shape)
+	bs_add, bn_mul, bn_shift, ew_shift = -7, 5, 1, 3
+	scale, shift, offset = 3, 4, -5
+
+	program = [
+		("DPU_DATA_FORMAT", {"PROC_PRECISION": 0, "OUT_PRECISION": 0}),
+		("DPU_FEATURE_MODE_CFG", {"FLYING_MODE": 1}),
+		("DPU_RDMA_RDMA_FEATURE_MODE_CFG", {"MRDMA_DISABLE": 0, "IN_PRECISION": 0}),
+		("DPU_RDMA_RDMA_DATA_CUBE_CHANNEL", {"CHANNEL": shape[0] - 1}),
+		("DPU_RDMA_RDMA_DATA_CUBE_HEIGHT", {"HEIGHT": shape[1] - 1}),
+		("DPU_RDMA_RDMA_DATA_CUBE_WIDTH", {"WIDTH": shape[2] - 1}),
+		("DPU_RDMA_RDMA_SRC_BASE_ADDR", SRC),
+		("DPU_BS_CFG", {"BS_ALU_ALGO": 2, "BS_MUL_BYPASS": 1}),
+		("DPU_BS_ALU_CFG", {"BS_ALU_OPERAND": bs_add & 0xffffffff}),
+		("DPU_BN_CFG", {"BN_ALU_BYPASS": 1, "BN_RELU_BYPASS": 1}),
+		("DPU_BN_MUL_CFG", {"BN_MUL_OPERAND": bn_mul, "BN_MUL_SHIFT_VALUE": bn_shift}),
+		("DPU_EW_CFG", {"EW_OP_SRC": 1, "EW_OP_CVT_BYPASS": 1, "EW_OP_TYPE": int(ew_mul), "EW_ALU_ALGO": 2,
+				"EW_LUT_BYPASS": 1, "EW_RELU_BYPASS": 1}),
+		("DPU_EW_CVT_SCALE_VALUE", {"EW_TRUNCATE": ew_shift}),
+		("DPU_RDMA_RDMA_ERDMA_CFG", {"ERDMA_DISABLE": 0, "ERDMA_DATA_SIZE": 0, "ERDMA_DATA_MODE": 1}),
+		("DPU_RDMA_RDMA_EW_BASE_ADDR", EW),
+	] + dpu_cube(shape) + out_cvt(scale, shift, offset) + [
+		("PC_OPERATION_ENABLE", ENGINE_DPU | ENGINE_DPU_RDMA),
+	]
+	size = len(pack(a, np.int8))
+	sim = run(tables, program, {SRC: pack(a, np.int8), EW: pack(b, np.int8), DST: size})
+
+	expected = [[[0] * shape[2] for _ in range(shape[1])] for _ in range(shape[0])]
+	for c in range(shape[0]):
+		for y in range(shape[1]):
+			for x in range(shape[2]):
+				v = max(a[c][y][x] + bs_add, 0)
+				v = rshift(v * bn_mul, bn_shift)
+				v = rshift(v * b[c][y][x], ew_shift) if ew_mul else v + b[c][y][x]
+				expected[c][y][x] = clamp(rshift(v * scale, shift) + offset, 8)
+	assert unpack(sim.memory.view(DST, size), np.int8, shape) == expected
+
+# Weights of int8 kernels, up to 32 kernels and 32 channels, are stored
+# kernel row by kernel row, then kernel, then channel
+def pack_weights(weights):
+	kernels, channels = len(weights), len(weights[0])
+	height, width = len(weights[0][0]), len(weights[0][0][0])
+	out = np.zeros(kernels * channels * height * width, dtype=np.int8)
+	for k in range(kernels):
+		for c in range(channels):
+			for y in range(height):
+				for x in range(width):
+					out[((y * width + x) * kernels + k) * channels + c] = weights[k][c][y][x]
+	return out
+
+# 3x3 int8 convolution, stride 2, one pixel of padding all around with a
+# non-zero value, CORE truncation rounding half up, int32 out
+def test_conv_int8(tables):
+	rng = np.random.default_rng(2)
+	channels, height, width, kernels = 8, 7, 6, 6
+	stride, pad, pad_value, truncate = 2, 1, -3, 3
+	x = random_cube(rng, (channels, height, width))
+	weights = rng.integers(-128, 128, size=(kernels, channels, 3, 3)).tolist()
+	out_h = (height + 2 * pad - 3) // stride + 1
+	out_w = (width + 2 * pad - 3) // stride + 1
+	shape = (kernels, out_h, out_w)
+
+	program = [
+		("CNA_CONV_CON1", {"CONV_MODE": 0, "PROC_PRECISION": 0, "IN_PRECISION": 0}),
+		("CNA_DATA_SIZE0", {"DATAIN_HEIGHT": height, "DATAIN_WIDTH": width}),
+		("CNA_DATA_SIZE1", {"DATAIN_CHANNEL": channels}),
+		("CNA_FEATURE_DATA_ADDR", SRC),
+		("CNA_CVT_CON0", {"CVT_BYPASS": 1}),
+		("CNA_WEIGHT_SIZE2", {"WEIGHT_KERNELS": kernels, "WEIGHT_HEIGHT": 3, "WEIGHT_WIDTH": 3}),
+		("CNA_DCOMP_ADDR0", WEIGHTS),
+		("CNA_CONV_CON3", {"CONV_Y_STRIDE": stride, "CONV_X_STRIDE": stride}),
+		("CNA_PAD_CON0", {"PAD_TOP": pad, "PAD_LEFT": pad}),
+		("CNA_PAD_CON1", {"PAD_VALUE": pad_value & 0xffffffff}),
+		("CORE_DATAOUT_SIZE_0", {"DATAOUT_HEIGHT": out_h - 1, "DATAOUT_WIDTH": out_w - 1}),
+		("CORE_DATAOUT_SIZE_1", {"DATAOUT_CHANNEL": kernels - 1}),
+		("CORE_CLIP_TRUNCATE", {"CLIP_TRUNCATE": truncate, "ROUND_TYPE": 1}),
+		("DPU_DATA_FORMAT", {"PROC_PRECISION": 0, "OUT_PRECISION": 4}),
+		("DPU_FEATURE_MODE_CFG", {"FLYING_MODE": 0}),
+		("DPU_BS_CFG", {"BS_BYPASS": 1}),
+		("DPU_BN_CFG", {"BN_BYPASS": 1}),
+		("DPU_EW_CFG", {"EW_BYPASS": 1}),
+	] + dpu_cube(shape) + out_cvt(1, 0, 0) + [
+		("PC_OPERATION_ENABLE", ENGINE_CNA | ENGINE_CORE | ENGINE_DPU),
+	]
+	size = len(pack([[[0] * out_w] * out_h] * kernels, np.int32)) * 4
+	sim = run(tables, program, {SRC: pack(x, np.int8), WEIGHTS: pack_weights(weights), DST: size})
+
+	expected = [[[0] * out_w for _ in range(out_h)] for _ in range(kernels)]
+	for k in range(kernels):
+		for oy in range(out_h):
+			for ox in range(out_w):
+				acc = 0
+				for c in range(channels):
+					for ky in range(3):
+						for kx in range(3):
+							iy, ix = oy * stride + ky - pad, ox * stride + kx - pad
+							v = x[c][iy][ix] if 0 <= iy < height and 0 <= ix < width else pad_value
+							acc += v * weights[k][c][ky][kx]
+				expected[k][oy][ox] = clamp(rshift(acc, truncate), 32)
+	assert unpack(sim.memory.view(DST, size), np.int32, shape) == expected
+
+# CORE started without CNA and other unmodelled tasks are skipped, the
+# rest of the program still runs
+@pytest.mark.parametrize("program", ["old/dump/sub_int8.h", "old/dump/xyy_123_int8.h"])
+def test_unsupported_tasks_skipped(tables, program):
+	p = load_parser("", os.path.join(ROOT, "registers.xml"))
+	sim = Simulator(tables)
+	sim.memory.map(0, 1 << 32)
+	sim.run(load_program(os.path.join(ROOT, program), p, False, True))
+	assert sim.tasks > len(sim.skipped) > 0
+	assert any("without CNA" in message for _, message in sim.skipped)
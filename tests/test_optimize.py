@@ -0,0 +1,105 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import numpy as np
+import pytest
+from gen_parser import load_parser, Error
+from decode import FieldTables, task_bounds
+from cmdbuf import Commands
+from sparse import read_dump
+from assemble import Assembler
+from npusim import ENGINE_CNA, ENGINE_CORE, ENGINE_DPU
+from optimize import redundant_writes, relink, chained_region
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="module")
+def tables():
+	return FieldTables.from_parser(load_parser("", os.path.join(ROOT, "registers.xml")))
+
+# The three chained tasks of dump/gem2-dump, without the task table after them
+def gem2_tasks():
+	words = np.frombuffer(read_dump(os.path.join(ROOT, "dump/gem2-dump")), dtype="<u8").astype(np.uint64)
+	return words[:257]
+
+def test_relink_unchanged(tables):
+	words = gem2_tasks()
+	out, starts = relink(words, [], tables)
+	assert np.array_equal(out, words)
+	assert starts.tolist() == [0, 104, 184]
+
+def test_relink_across_tasks(tables):
+	words = gem2_tasks()
+	commands = Commands(words)
+	redundant = redundant_writes(commands.records(), tables, across_tasks=True)
+	out, starts = relink(words, commands.positions[redundant], tables)
+	assert len(out) < len(words)
+	# The relinked chain describes the new layout
+	again, _ = relink(out, [], tables)
+	assert np.array_equal(again, out)
+
+def test_relink_refuses_task_table(tables):
+	words = np.frombuffer(read_dump(os.path.join(ROOT, "dump/gem2-dump")), dtype="<u8").astype(np.uint64)
+	with pytest.raises(Error):
+		relink(words, [], tables)
+
+def program(tables, tasks):
+	writes = []
+	for task in tasks:
+		writes += task + [("PC_OPERATION_ENABLE", ENGINE_CNA | ENGINE_CORE | ENGINE_DPU)]
+	return Assembler(tables.index).assemble(writes).records()
+
+def dropped(records, redundant):
+	return [(int(r["offset"]) & 0xffff, int(r["value"])) for r in records[redundant]]
+
+# With the DPU ping-ponging, tasks alternate between its register groups:
+# a write is only dropped if it repeats both its group and the register
+@pytest.mark.parametrize("formats, expected", [([1, 2, 1], []), ([1, 1, 1], [(0x4010, 1)]), ([1, 1, 2], [])])
+def test_pointer_groups(tables, formats, expected):
+	tasks = [[("DPU_S_POINTER", {"POINTER_PP_MODE": 1, "EXECUTER_PP_EN": 1, "POINTER_PP_EN": 1}),
+		  ("DPU_DATA_FORMAT", f)] for f in formats]
+	records = program(tables, tasks)
+	assert dropped(records, redundant_writes(records, tables, across_tasks=True)) == expected
+	# Without it every write that repeats the previous one is dropped
+	records = program(tables, [task[1:] for task in tasks])
+	repeats = [(0x4010, f) for prev, f in zip(formats, formats[1:]) if f == prev]
+	assert dropped(records, redundant_writes(records, tables, across_tasks=True)) == repeats
+
+def test_pointer_groups_gem2(tables):
+	words = gem2_tasks()
+	commands = Commands(words)
+	records = commands.records()
+	redundant = redundant_writes(records, tables, across_tasks=True)
+	bounds = task_bounds(records)
+	assert np.add.reduceat(redundant, bounds[:-1]).tolist() == [0, 0, 64]
+
+AMOUNTS = [("CNA_DCOMP_AMOUNT%d" % i, 0) for i in range(16)]
+
+# DCOMP_AMOUNTn is only read by a CNA operation with decompression on
+def test_dead_amounts(tables):
+	records = program(tables, [[("CNA_DCOMP_CTRL", 0)] + AMOUNTS])
+	assert redundant_writes(records, tables).sum() == 16
+	records = program(tables, [[("CNA_DCOMP_CTRL", {"DECOMP_CONTROL": 1})] + AMOUNTS])
+	assert redundant_writes(records, tables).sum() == 0
+	# Nothing says decompression is off
+	records = program(tables, [AMOUNTS])
+	assert redundant_writes(records, tables).sum() == 0
+	# The second task reads the amounts of the first across tasks
+	records = program(tables, [[("CNA_DCOMP_CTRL", 0)] + AMOUNTS, [("CNA_DCOMP_CTRL", {"DECOMP_CONTROL": 1})]])
+	assert redundant_writes(records, tables).sum() == 16
+	assert redundant_writes(records, tables, across_tasks=True).sum() == 0
+
+# The chained tasks of the captures come after data and before a task
+# table, which stay where they are
+@pytest.mark.parametrize("dump, region", [("dump/gem2-dump", (24, 257)), ("dump/gem4-dump", (1104, 1337))])
+def test_chained_region(tables, dump, region):
+	words = np.frombuffer(read_dump(os.path.join(ROOT, dump)), dtype="<u8").astype(np.uint64)
+	assert chained_region(words, tables) == region
+	first, end = region
+	commands = Commands(words[first:end])
+	redundant = redundant_writes(commands.records(), tables, across_tasks=True)
+	assert redundant.sum() > 0
+	out, starts = relink(words[first:end], commands.positions[redundant], tables)
+	assert len(out) < end - first
+	again, _ = relink(out, [], tables)
+	assert np.array_equal(again, out)
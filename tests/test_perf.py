@@ -0,0 +1,42 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import pytest
+from npusim import Simulator, Memory, load_program, cube_size
+from perf import Costing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CountingMemory(Memory):
+	def __init__(self):
+		Memory.__init__(self)
+		self.read = 0
+		self.written = 0
+
+	def read_cube(self, address, shape, dtype, surf_stride=None):
+		self.read += cube_size(shape, dtype, surf_stride)
+		return Memory.read_cube(self, address, shape, dtype, surf_stride)
+
+	def write_cube(self, address, cube, surf_stride=None):
+		self.written += cube_size(cube.shape, cube.dtype, surf_stride)
+		Memory.write_cube(self, address, cube, surf_stride)
+
+# The model costs the tasks the simulator runs, and the bytes they move,
+# not the writes after the last OPERATION_ENABLE
+@pytest.mark.parametrize("program, raw, emit", [
+	("dump/gem2-dump", True, False),
+	("old/dump/mul_int8.h", False, True),
+])
+def test_tasks_match_npusim(program, raw, emit):
+	costing = Costing(os.path.join(ROOT, "registers.xml"))
+	filename = os.path.join(ROOT, program)
+	costs = costing.costs(filename, raw, emit)
+
+	memory = CountingMemory()
+	memory.map(0, 1 << 32)
+	sim = Simulator(costing.tables, memory)
+	sim.run(load_program(filename, costing.parser, raw, emit))
+	assert not sim.skipped
+	assert len(costs["engines"]) == sim.tasks == 3
+	assert costs["read_bytes"].sum() == memory.read
+	assert costs["write_bytes"].sum() == memory.written
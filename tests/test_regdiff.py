@@ -0,0 +1,40 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import numpy as np
+import pytest
+from gen_parser import load_parser
+from decode import FieldTables, load_records
+from regdiff import Capture, align, matching_runs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="module")
+def tables():
+	return FieldTables.from_parser(load_parser("", os.path.join(ROOT, "registers.xml")))
+
+def test_matching_runs_periodic():
+	a = [0, 1, 2, 3] * 50
+	b = list(a)
+	for i in (190, 101, 7):
+		del b[i]
+	runs = matching_runs(a, b)
+	assert sum(n for _, _, n in runs) == len(b)
+	for i, j, n in runs:
+		assert a[i:i + n] == b[j:j + n]
+
+# A capture repeated many times, with a few writes dropped: only those
+# writes may come out unmatched, not whole periods of tasks
+def test_align_periodic_deletions(tables, tmp_path):
+	records = np.tile(load_records(os.path.join(ROOT, "dump/gem4_regdump.bin")), 20)
+	dropped = [len(records) - 5, 15000, 9001, 123]
+	records.tofile(str(tmp_path / "a.bin"))
+	np.delete(records, dropped).tofile(str(tmp_path / "b.bin"))
+
+	a = Capture(str(tmp_path / "a.bin"), tables)
+	b = Capture(str(tmp_path / "b.bin"), tables)
+	ia, ib, only_a, only_b = align(a, b)
+	assert len(only_a) == len(dropped)
+	assert len(only_b) == 0
+	assert len(ia) == len(b.records)
+	assert (a.values[ia] == b.values[ib]).all()
@@ -0,0 +1,19 @@
+# SPDX-License-Identifier: MIT
+
+import os
+from perf import Costing, Model
+from roofline import roofline, summary, NO_TRAFFIC
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_no_traffic_ranked_last():
+	costs = Costing(os.path.join(ROOT, "registers.xml")).costs(os.path.join(ROOT, "dump/gem4_regdump.bin"), False, False)
+	model = Model()
+	rows = roofline(costs, model)
+	total = summary(costs, model, rows)
+	assert total["tasks"] == 23
+	assert total["memory_bound_tasks"] == 14
+	assert total["no_traffic_tasks"] == 9
+	bounds = [row["bound"] for row in rows]
+	assert bounds[-9:] == [NO_TRAFFIC] * 9
+	assert NO_TRAFFIC not in bounds[:-9]
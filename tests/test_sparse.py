@@ -0,0 +1,15 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import sparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The pure Python page scan used without numpy finds the same runs
+def test_nonzero_runs_without_numpy(monkeypatch):
+	buf = bytearray(sparse.read_dump(os.path.join(ROOT, "dump/gem2-dump")))
+	buf += bytes(2000) + b"\x01" + bytes(300)
+	expected = sparse.nonzero_runs(buf, len(buf), 512)
+	monkeypatch.setattr(sparse, "np", None)
+	assert sparse.nonzero_runs(buf, len(buf), 512) == expected
+	assert len(expected) == 2
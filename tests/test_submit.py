@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import numpy as np
+import pytest
+from gen_parser import load_parser, Error
+from decode import FieldTables
+from sparse import read_dump
+from reloc import Image
+from submit import SimBackend, run_image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The three chained tasks of dump/gem2-dump, the command buffer at 0xffff2000
+GEM2_BASE = 0xffff2000
+GEM2_WORDS = 257
+
+@pytest.fixture(scope="module")
+def tables():
+	return FieldTables.from_parser(load_parser("", os.path.join(ROOT, "registers.xml")))
+
+def gem2_tasks():
+	words = np.frombuffer(read_dump(os.path.join(ROOT, "dump/gem2-dump")), dtype="<u8").astype(np.uint64)
+	return words[:GEM2_WORDS]
+
+def test_chained_image_needs_commands(tables):
+	with pytest.raises(Error):
+		run_image(SimBackend(tables), Image.build(gem2_tasks(), tables))
+
+def test_chained_image(tables):
+	image = Image.build(gem2_tasks(), tables, [("commands", GEM2_BASE, GEM2_WORDS * 8)])
+	tasks, outputs = run_image(SimBackend(tables), image)
+	assert tasks == 3
+	assert list(outputs) == ["DPU_DST_BASE_ADDR"]
@@ -0,0 +1,21 @@
+# SPDX-License-Identifier: MIT
+
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def template(*args):
+	subprocess.run([sys.executable, "template.py"] + list(args), cwd=ROOT, check=True, capture_output=True)
+
+# regdump -> template -> regdump gives back every record, the ones whose
+# command word is all zeros included
+@pytest.mark.parametrize("regdump", ["dump/gem4_regdump.bin", "dump/gem2_regdump.bin"])
+def test_regdump_round_trip(tmp_path, regdump):
+	saved = str(tmp_path / "t.tmpl")
+	out = str(tmp_path / "regdump.bin")
+	template("build", "--xml", "registers.xml", regdump, "--save", saved)
+	template("expand", saved, "--regdump", out)
+	assert open(out, "rb").read() == open(os.path.join(ROOT, regdump), "rb").read()
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+#
+# SPDX-License-Identifier: MIT
+#
+# Watches GEM objects for changes. Every poll hashes each page of the
+# mapped buffers, and only pages whose hash changed are appended to a
+# time-ordered delta log, from which any intermediate state of the
+# buffers can be rebuilt.
+
+import sys
+import os
+import time
+import struct
+import zlib
+import argparse
+import numpy as np
+from gen_parser import Error
+from sparse import write_dump, CODECS
+
+WATCH_MAGIC = b"NPUWATCH"
+WATCH_VERSION = 1
+WATCH_PAGE_SIZE = 4096
+
+# Pages are hashed this many at a time, to bound the temporaries
+HASH_BLOCK = 256
+
+# magic, version, page size
+LOG_HEADER = struct.Struct("<8sHI")
+# time, number of pages that follow
+FRAME = struct.Struct("<dI")
+# flink, buffer size, page index, length of the data that follows
+PAGE = struct.Struct("<IQII")
+
+# Multiply-and-add over the 64-bit words of a page, with odd multipliers
+# so that any change to a single word changes the hash
+def page_multipliers(page_size):
+	rng = np.random.default_rng(0x4e5055)
+	return rng.integers(0, 1 << 63, size=page_size // 8, dtype=np.uint64) | np.uint64(1)
+
+def page_hashes(buf, size, page_size, mult):
+	full = size // page_size
+	hashes = np.empty(-(-size // page_size), dtype=np.uint64)
+	words = np.frombuffer(buf, dtype="<u8", count=full * (page_size // 8)).reshape(full, page_size // 8)
+	for start in range(0, full, HASH_BLOCK):
+		hashes[start:start + HASH_BLOCK] = (words[start:start + HASH_BLOCK] * mult).sum(axis=1, dtype=np.uint64)
+	del words
+	if full < len(hashes):
+		with memoryview(buf) as view:
+			hashes[full] = zlib.crc32(view[full * page_size:size])
+	return hashes
+
+class Watcher(object):
+	# Keeps the GEM objects of flinks mapped and logs their changes. The
+	# log starts from all zeros, so the first poll records every non-zero
+	# page.
+	def __init__(self, dev, flinks, log, page_size=WATCH_PAGE_SIZE):
+		self.dev = dev
+		self.page_size = page_size
+		self.mult = page_multipliers(page_size)
+		self.log = log
+		self.log.write(LOG_HEADER.pack(WATCH_MAGIC, WATCH_VERSION, page_size))
+
+		# All of them stay mapped for the whole watch
+		dev.max_gems = max(dev.max_gems, len(flinks))
+		self.gems = [dev.gem(flink) for flink in flinks]
+		self.hashes = [page_hashes(bytes(gem.size), gem.size, page_size, self.mult) for gem in self.gems]
+
+		self.polls = 0
+		self.pages = 0
+		self.poll_time = 0.0
+
+	def poll(self):
+		start = time.perf_counter()
+		changes = []
+		for n, gem in enumerate(self.gems):
+			hashes = page_hashes(gem.buf, gem.size, self.page_size, self.mult)
+			pages = np.flatnonzero(hashes != self.hashes[n]).tolist()
+			for page in pages:
+				offset = page * self.page_size
+				changes.append((gem, page, gem.buf[offset:min(offset + self.page_size, gem.size)]))
+			# An empty entry, so that buffers that are all zeros are in the log too
+			if self.polls == 0 and not pages:
+				changes.append((gem, 0, b""))
+			self.hashes[n] = hashes
+
+		self.log.write(FRAME.pack(time.time(), len(changes)))
+		for gem, page, data in changes:
+			self.log.write(PAGE.pack(gem.flink, gem.size, page, len(data)))
+			self.log.write(data)
+
+		self.polls += 1
+		self.pages += len(changes)
+		self.poll_time += time.perf_counter() - start
+		return len(changes)
+
+	# Polls every interval seconds, on a fixed schedule rather than
+	# sleeping interval between the end of one poll and the next
+	def run(self, interval, count=None):
+		deadline = time.monotonic()
+		while count is None or self.polls < count:
+			self.poll()
+			self.log.flush()
+			deadline += interval
+			delay = deadline - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				deadline = time.monotonic()
+
+	def stats(self):
+		mean = 1000.0 * self.poll_time / self.polls if self.polls else 0.0
+		return "%d polls, %d pages logged, %.3f ms per poll" % (self.polls, self.pages, mean)
+
+class DeltaLog(object):
+	# Index of a watch log. Page data stays on disk until a state is built.
+	def __init__(self, filename):
+		self.filename = filename
+		self.frames = []
+		with open(filename, "rb") as f:
+			end = os.fstat(f.fileno()).st_size
+			header = f.read(LOG_HEADER.size)
+			if len(header) < LOG_HEADER.size or not header.startswith(WATCH_MAGIC):
+				raise Error("%s is not a watch log" % filename)
+			_, version, self.page_size = LOG_HEADER.unpack(header)
+			if version != WATCH_VERSION:
+				raise Error("%s: unsupported watch log version %d" % (filename, version))
+
+			# A frame cut short by stopping the watch is dropped
+			while True:
+				frame = f.read(FRAME.size)
+				if len(frame) < FRAME.size:
+					break
+				t, count = FRAME.unpack(frame)
+				pages = []
+				for _ in range(count):
+					entry = f.read(PAGE.size)
+					if len(entry) < PAGE.size:
+						break
+					flink, size, page, length = PAGE.unpack(entry)
+					pages.append((flink, size, page, f.tell(), length))
+					f.seek(length, os.SEEK_CUR)
+				if len(pages) < count or f.tell() > end:
+					break
+				self.frames.append((t, pages))
+
+	def __len__(self):
+		return len(self.frames)
+
+	def times(self):
+		return [t for t, _ in self.frames]
+
+	# Index of the last frame taken at or before t
+	def frame_at(self, t):
+		i = np.searchsorted(np.array(self.times()), t, side="right") - 1
+		return max(0, int(i))
+
+	# {flink: bytearray} after applying frames 0..frame
+	def state(self, frame):
+		buffers = {}
+		with open(self.filename, "rb") as f:
+			for _, pages in self.frames[:frame + 1]:
+				for flink, size, page, offset, length in pages:
+					buf = buffers.get(flink)
+					if buf is None:
+						buf = buffers[flink] = bytearray(size)
+					f.seek(offset)
+					start = page * self.page_size
+					buf[start:start + length] = f.read(length)
+		return buffers
+
+	def changed(self, frame):
+		return sorted(set((flink, page) for flink, _, page, _, _ in self.frames[frame][1]))
+
+def info_main(args):
+	log = DeltaLog(args.log)
+	times = log.times()
+	print("%s: %d frames, %d byte pages" % (args.log, len(log), log.page_size))
+	for n, (t, pages) in enumerate(log.frames):
+		flinks = sorted(set(p[0] for p in pages))
+		print("frame %d +%.3fs: %d pages%s" % (n, t - times[0], len(pages),
+						   (" in gem " + " ".join(str(f) for f in flinks)) if flinks else ""))
+
+def replay_main(args):
+	log = DeltaLog(args.log)
+	if args.time is not None:
+		frame = log.frame_at(log.times()[0] + args.time)
+	else:
+		frame = args.frame if args.frame >= 0 else len(log) + args.frame
+	if not 0 <= frame < len(log):
+		raise Error("no frame %d, the log has %d" % (frame, len(log)))
+
+	os.makedirs(args.out, exist_ok=True)
+	for flink, buf in sorted(log.state(frame).items()):
+		write_dump(os.path.join(args.out, "gem%d-dump" % flink), buf, codec=args.codec)
+	print("frame %d written to %s" % (frame, args.out), file=sys.stderr)
+
+def main():
+	parser = argparse.ArgumentParser(description="Inspect and replay GEM watch logs")
+	subparsers = parser.add_subparsers(required=True)
+
+	parser_info = subparsers.add_parser('info', help='list the frames of a log')
+	parser_info.add_argument('log')
+	parser_info.set_defaults(func=info_main)
+
+	parser_replay = subparsers.add_parser('replay', help='write out the buffers as of one frame')
+	parser_replay.add_argument('--frame', type=int, default=-1, help='frame number, negative counts from the end')
+	parser_replay.add_argument('--time', type=float, help='seconds since the first frame, instead of --frame')
+	parser_replay.add_argument('--codec', choices=CODECS.keys(), help='write sparse dumps')
+	parser_replay.add_argument('--out', required=True, help='directory for the gemN-dump files')
+	parser_replay.add_argument('log')
+	parser_replay.set_defaults(func=replay_main)
+
+	args = parser.parse_args()
+	try:
+		args.func(args)
+	except Error as e:
+		print(e.message, file=sys.stderr)
+		exit(1)
+
+if __name__ == '__main__':
+	main()